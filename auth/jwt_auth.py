@@ -1,12 +1,130 @@
+import os
+import time
+import logging
+
+from asgiref.sync import sync_to_async
 from ninja.security import HttpBearer
+from rest_framework_simplejwt.models import TokenUser
 from rest_framework_simplejwt.tokens import AccessToken
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from tektome_ocr.lru import LocalLRU
+from tektome_ocr.metrics import count_cache, external_call
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds an authenticated user stays cached in process and in Redis
+JWT_USER_CACHE_TTL = int(os.getenv("JWT_USER_CACHE_TTL", 60))
+# Users kept in process, the least recently used are evicted beyond it
+JWT_USER_CACHE_LOCAL_SIZE = int(os.getenv("JWT_USER_CACHE_LOCAL_SIZE", 10000))
+
+# user_id -> (expiry time, user), bounded by the number of users
+_local_users = LocalLRU(JWT_USER_CACHE_LOCAL_SIZE, sizeof=lambda entry: 1)
+
+
+def user_cache_key(user_id):
+    return f"jwt_user:{user_id}"
+
+
+def _local_user(user_id, now):
+    """
+        Get a user from the in-process cache, dropping it once expired.
+    """
+    entry = _local_users.get(user_id)
+    if entry is None:
+        return None
+    if entry[0] <= now:
+        _local_users.pop(user_id)
+        return None
+    count_cache("jwt_user", "local_hit")
+    return entry[1]
+
+
+def get_user(user_id):
+    """
+        Get a user by ID from the in-process cache, then the shared Redis
+        cache, and only then from the database.
+
+        :param user_id: ID of the user from the token claims.
+        :return: The User instance.
+    """
+    now = time.monotonic()
+    user = _local_user(user_id, now)
+    if user is not None:
+        return user
+
+    try:
+        with external_call("redis", "user_cache_read"):
+            user = cache.get(user_cache_key(user_id))
+    except Exception as e:
+        logger.warning(f"User cache lookup skipped: {e}")
+        user = None
+
+    if user is None:
+        count_cache("jwt_user", "miss")
+        with external_call("database", "user_lookup"):
+            user = User.objects.get(id=user_id)
+        try:
+            cache.set(user_cache_key(user_id), user, JWT_USER_CACHE_TTL)
+        except Exception as e:
+            logger.warning(f"User cache store skipped: {e}")
+    else:
+        count_cache("jwt_user", "redis_hit")
+
+    _local_users.put(user_id, (now + JWT_USER_CACHE_TTL, user))
+    return user
+
+
+async def aget_user(user_id):
+    """
+        Async version of `get_user`. Users cached in process are returned
+        without leaving the event loop.
+    """
+    user = _local_user(user_id, time.monotonic())
+    if user is not None:
+        return user
+    return await sync_to_async(get_user)(user_id)
+
+
+def invalidate_user(user_id):
+    """
+        Drop a user from the caches so that the next request reads it from the
+        database.
+
+        :param user_id: ID of the changed user.
+    """
+    _local_users.pop(user_id)
+    try:
+        cache.delete(user_cache_key(user_id))
+    except Exception as e:
+        logger.warning(f"User cache invalidation skipped: {e}")
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_changed_user(sender, instance, **kwargs):
+    invalidate_user(instance.id)
+
+
+@receiver(post_save, sender=BlacklistedToken)
+def invalidate_blacklisted_user(sender, instance, **kwargs):
+    invalidate_user(instance.token.user_id)
 
 
 class JWTAuth(HttpBearer):
     """
         Custom authentication class for JWT-based authentication.
         Verifies and decodes the JWT token from the request header to authenticate the user.
+
+        With JWT_AUTH_STATELESS enabled the user is built from the verified
+        token claims without any lookup, otherwise it is read through a
+        short-lived cache.
     """
     def authenticate(self, request, token):
         """
@@ -19,9 +137,27 @@ class JWTAuth(HttpBearer):
         try:
             # Decode the JWT token
             access_token = AccessToken(token)
+            if settings.JWT_AUTH_STATELESS:
+                # Trust the claims of the verified token
+                return TokenUser(access_token)
             # Get the user from the token
-            user = User.objects.get(id=access_token["user_id"])
+            user = get_user(access_token["user_id"])
             return user
-        except Exception as e:
+        except Exception:
             # If token is invalid or expired
             return None
+
+
+class AsyncJWTAuth(JWTAuth):
+    """
+        JWTAuth for async endpoints, reading the user without blocking the
+        event loop.
+    """
+    async def authenticate(self, request, token):
+        try:
+            access_token = AccessToken(token)
+            if settings.JWT_AUTH_STATELESS:
+                return TokenUser(access_token)
+            return await aget_user(access_token["user_id"])
+        except Exception:
+            return None
@@ -0,0 +1,175 @@
+import os
+import logging
+import weakref
+
+import redis
+
+from tektome_ocr.async_clients import get_redis
+from tektome_ocr.clients import get_redis_client
+from tektome_ocr.metrics import RATE_LIMIT_REJECTIONS, external_call
+
+
+logger = logging.getLogger(__name__)
+
+# Redis shared by all web workers for rate limiting
+r = get_redis_client()
+
+# Default rate limiting parameters
+RATE_LIMIT_THRESHOLD = os.getenv("RATE_LIMIT_THRESHOLD")
+RATE_LIMIT_TIME_WINDOW = os.getenv("RATE_LIMIT_TIME_WINDOW")
+
+
+def get_rate_limit(endpoint):
+    """
+        Get the rate limit of an endpoint. Each endpoint can override the
+        defaults with RATE_LIMIT_<ENDPOINT>_THRESHOLD and
+        RATE_LIMIT_<ENDPOINT>_TIME_WINDOW environment variables.
+
+        :param endpoint: Name of the endpoint, e.g. "ocr", "extract" or
+                         "upload".
+        :return: Tuple of (allowed requests, time window in seconds).
+    """
+    prefix = f"RATE_LIMIT_{endpoint.upper()}"
+    threshold = os.getenv(f"{prefix}_THRESHOLD", RATE_LIMIT_THRESHOLD)
+    time_window = os.getenv(f"{prefix}_TIME_WINDOW", RATE_LIMIT_TIME_WINDOW)
+    return int(threshold), int(time_window)
+
+
+# Generic cell rate algorithm (GCRA) over every key at once. Each key stores
+# its theoretical arrival time (TAT) in microseconds. A request is allowed
+# when no key would exceed `limit` requests per `period`, in which case all
+# keys are advanced; a rejected request consumes nothing.
+# Returns {allowed, retry after in milliseconds}.
+GCRA_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local period = tonumber(ARGV[2])
+local interval = math.floor(period / limit)
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000000 + tonumber(time[2])
+
+local tats = {}
+local retry_after = 0
+for i, key in ipairs(KEYS) do
+    local tat = math.max(tonumber(redis.call('GET', key)) or now, now)
+    tats[i] = tat + interval
+    local allow_at = tats[i] - period
+    if allow_at > now then
+        retry_after = math.max(retry_after, allow_at - now)
+    end
+end
+
+if retry_after > 0 then
+    return {0, math.ceil(retry_after / 1000)}
+end
+
+for i, key in ipairs(KEYS) do
+    local ttl = math.ceil((tats[i] - now) / 1000)
+    redis.call('SET', key, string.format('%.0f', tats[i]), 'PX', ttl)
+end
+return {1, 0}
+"""
+
+gcra = r.register_script(GCRA_SCRIPT)
+
+# GCRA script of every async client, registered on its first request
+_async_gcra = weakref.WeakKeyDictionary()
+
+
+def acquire(keys, limit, period):
+    """
+        Atomically take one request from the rate limits of all keys, in a
+        single Redis round trip.
+
+        :param keys: Redis keys of the identities making the request.
+        :param limit: Number of requests allowed per period.
+        :param period: Length of the period in seconds.
+        :return: Tuple of (allowed, seconds until the request would be
+                 allowed).
+    """
+    allowed, retry_after = gcra(
+        keys=keys, args=[limit, period * 1000000], client=r
+    )
+    return bool(allowed), retry_after / 1000
+
+
+async def aacquire(keys, limit, period):
+    """
+        Async version of `acquire`, on the Redis client of the event loop.
+    """
+    client = get_redis()
+    script = _async_gcra.get(client)
+    if script is None:
+        script = _async_gcra[client] = client.register_script(GCRA_SCRIPT)
+    allowed, retry_after = await script(
+        keys=keys, args=[limit, period * 1000000]
+    )
+    return bool(allowed), retry_after / 1000
+
+
+def rate_limit_keys(client_ip, user_id, endpoint):
+    keys = [f"ratelimit:{endpoint}:ip:{client_ip}"]
+    if user_id is not None:
+        keys.append(f"ratelimit:{endpoint}:user:{user_id}")
+    return keys
+
+
+def check_rate_limit(client_ip, user_id=None, endpoint="ocr"):
+    """
+        Check if the client has exceeded the rate limit of an endpoint. The
+        limit applies both to the client IP and to the authenticated user.
+
+        :param client_ip: IP address of the client making the request.
+        :param user_id: ID of the authenticated user, if any.
+        :param endpoint: Name of the endpoint, selecting its rate limit.
+        :return: Boolean indicating if the request is allowed.
+    """
+    keys = rate_limit_keys(client_ip, user_id, endpoint)
+    limit, period = get_rate_limit(endpoint)
+    try:
+        with external_call("redis", "rate_limit"):
+            allowed, retry_after = acquire(keys, limit, period)
+    except redis.RedisError as e:
+        # Do not take the API down with the rate limiter
+        logger.warning(f"Rate limit check skipped: {e}")
+        return True
+
+    if not allowed:
+        RATE_LIMIT_REJECTIONS.labels(endpoint).inc()
+        logger.info(
+            f"Rate limit exceeded on {endpoint} for {keys}, "
+            f"retry in {retry_after}s"
+        )
+    return allowed
+
+
+async def acheck_rate_limit(client_ip, user_id=None, endpoint="ocr"):
+    """
+        Async version of `check_rate_limit`, for async endpoints.
+    """
+    keys = rate_limit_keys(client_ip, user_id, endpoint)
+    limit, period = get_rate_limit(endpoint)
+    try:
+        with external_call("redis", "rate_limit"):
+            allowed, retry_after = await aacquire(keys, limit, period)
+    except redis.RedisError as e:
+        logger.warning(f"Rate limit check skipped: {e}")
+        return True
+
+    if not allowed:
+        RATE_LIMIT_REJECTIONS.labels(endpoint).inc()
+        logger.info(
+            f"Rate limit exceeded on {endpoint} for {keys}, "
+            f"retry in {retry_after}s"
+        )
+    return allowed
+
+
+def client_identity(request):
+    """
+        Get the identities a request is rate limited by.
+
+        :param request: HTTP request, authenticated with JWTAuth.
+        :return: Tuple of (client IP, user ID or None).
+    """
+    user = getattr(request, "auth", None)
+    return request.META.get("REMOTE_ADDR"), getattr(user, "id", None)
@@ -0,0 +1,101 @@
+import pytest
+from unittest.mock import patch
+from django.contrib.auth.models import User
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import RequestFactory
+from rest_framework_simplejwt.tokens import AccessToken
+
+from auth import jwt_auth
+from auth.jwt_auth import JWTAuth
+
+
+@pytest.fixture(autouse=True)
+def user_cache():
+    # Use an in-memory cache instead of Redis and start with empty caches
+    jwt_auth._local_users.clear()
+    with patch("auth.jwt_auth.cache", LocMemCache("users", {})) as mock_cache:
+        yield mock_cache
+
+
+# Test that the user is only read from the database on the first request
+@pytest.mark.django_db
+def test_authenticate_caches_user(django_assert_num_queries):
+    user = User.objects.create_user(username="alice", password="secret")
+    token = str(AccessToken.for_user(user))
+    request = RequestFactory().post("/extract")
+
+    with django_assert_num_queries(1):
+        assert JWTAuth().authenticate(request, token) == user
+
+    with django_assert_num_queries(0):
+        for _ in range(10):
+            assert JWTAuth().authenticate(request, token) == user
+
+    # Another process only has the shared cache
+    jwt_auth._local_users.clear()
+    with django_assert_num_queries(0):
+        assert JWTAuth().authenticate(request, token) == user
+
+
+# Test that changing a user invalidates the cached copy
+@pytest.mark.django_db
+def test_authenticate_invalidates_changed_user():
+    user = User.objects.create_user(username="alice", password="secret")
+    token = str(AccessToken.for_user(user))
+
+    assert (
+        JWTAuth().authenticate(RequestFactory().get("/"), token).first_name
+        == ""
+    )
+
+    user.first_name = "Alice"
+    user.save()
+
+    assert (
+        JWTAuth().authenticate(RequestFactory().get("/"), token).first_name
+        == "Alice"
+    )
+
+
+# Test that the in-process cache is bounded and drops expired users
+@pytest.mark.django_db
+def test_local_user_cache_is_bounded(monkeypatch):
+    from tektome_ocr.lru import LocalLRU
+
+    monkeypatch.setattr(
+        jwt_auth, "_local_users", LocalLRU(2, sizeof=lambda entry: 1)
+    )
+    users = [
+        User.objects.create_user(username=f"user{i}", password="secret")
+        for i in range(3)
+    ]
+    for user in users:
+        assert jwt_auth.get_user(user.id) == user
+
+    assert len(jwt_auth._local_users) == 2
+    assert jwt_auth._local_users.get(users[0].id) is None
+
+    # Expired users are removed when they are looked up
+    expiry, user = jwt_auth._local_users.get(users[1].id)
+    jwt_auth._local_users.put(users[1].id, (expiry - 3600, user))
+    assert jwt_auth._local_user(users[1].id, jwt_auth.time.monotonic()) is None
+    assert len(jwt_auth._local_users) == 1
+
+
+# Test the stateless mode that trusts the token claims
+@pytest.mark.django_db
+def test_authenticate_stateless(settings, django_assert_num_queries):
+    settings.JWT_AUTH_STATELESS = True
+    user = User.objects.create_user(username="alice", password="secret")
+    token = str(AccessToken.for_user(user))
+
+    with django_assert_num_queries(0):
+        authenticated = JWTAuth().authenticate(
+            RequestFactory().get("/"), token
+        )
+
+    assert authenticated.id == user.id
+    assert (
+        JWTAuth().authenticate(RequestFactory().get("/"), "not-a-token")
+        is None
+    )
@@ -0,0 +1,554 @@
+"""
+Load benchmark of the /mock_ocr/extract, /mock_ocr/ocr and /file_upload/upload
+endpoints, without cloud accounts.
+
+Requests go through the ASGI application in this process, like a single
+uvicorn worker, with local stand-ins for the external services:
+
+    - OpenAI: deterministic embeddings returned after --openai-latency-ms
+    - Pinecone: the local vector store, answering after --vector-latency-ms
+    - S3: moto, in memory (uploaded objects are deleted after each request)
+    - Redis: fakeredis, or a real Redis with --redis-url
+    - Celery: OCR tasks run eagerly, within the /ocr request
+
+Workloads:
+
+    ingest        --files OCR documents submitted to /ocr, one at a time
+    extract_hot   the same query repeated, served from the result cache
+    extract_cold  a new query per request: embedding, vector and BM25 search
+    upload        --uploads files of --upload-mb MB posted to
+                  /file_upload/upload
+
+Each workload reports its latency percentiles, requests per second, errors,
+and the RSS of the process once done. The results are printed as JSON; with
+--baseline, the script exits with status 1 when a workload is slower than
+the baseline results by more than --tolerance.
+
+Usage:
+    python benchmarks/bench_endpoints.py [--workloads extract_hot extract_cold]
+        [--requests 500] [--concurrency 16] [--output results.json]
+        [--baseline previous.json]
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import argparse
+import resource
+import tempfile
+from unittest.mock import patch
+from urllib.parse import urlencode, urlparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tektome_ocr.settings")
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+os.environ.setdefault("AWS_BUCKET_NAME", "benchmark")
+os.environ.setdefault("AWS_S3_REGION_NAME", "us-east-1")
+os.environ["VECTOR_STORE_BACKEND"] = "local"
+# Jobs run in this process, their results kept in memory for /jobs
+os.environ["CELERY_RESULT_BACKEND"] = "cache+memory://"
+# Requests are measured, not rate limited
+os.environ["RATE_LIMIT_THRESHOLD"] = str(10**6)
+os.environ["RATE_LIMIT_TIME_WINDOW"] = "60"
+
+WORKLOADS = ["ingest", "extract_hot", "extract_cold", "upload"]
+
+# Words of the synthetic OCR documents, with drawing codes for BM25
+WORDS = (
+    "door window wall floor ceiling room stair beam column slab finish "
+    "concrete steel timber glass level section detail elevation plan note"
+).split()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workloads", nargs="+", choices=WORKLOADS, default=WORKLOADS
+    )
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument("--paragraphs", type=int, default=200)
+    parser.add_argument("--uploads", type=int, default=4)
+    parser.add_argument("--upload-mb", type=int, default=64)
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--openai-latency-ms", type=float, default=50)
+    parser.add_argument("--vector-latency-ms", type=float, default=10)
+    parser.add_argument(
+        "--redis-url", help="Use this Redis instead of fakeredis"
+    )
+    parser.add_argument("--output", help="Also write the results to this file")
+    parser.add_argument(
+        "--baseline", help="Results of a previous run to compare with"
+    )
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    return parser.parse_args()
+
+
+def fake_embedding(text, dimension):
+    # Same text, same vector, like the real model
+    seed = int.from_bytes(
+        hashlib.sha256(text.encode("utf-8")).digest()[:8], "little"
+    )
+    vector = np.random.default_rng(seed).standard_normal(dimension)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class FakeOpenAI:
+    """
+        Stand-in for openai.Embedding, answering after a fixed latency.
+    """
+
+    def __init__(self, dimension, latency):
+        self.dimension = dimension
+        self.latency = latency
+        self.requests = 0
+
+    def _response(self, input):
+        self.requests += 1
+        return {
+            "data": [
+                {"index": i, "embedding": fake_embedding(text, self.dimension)}
+                for i, text in enumerate(input)
+            ]
+        }
+
+    def create(self, input, model):
+        time.sleep(self.latency)
+        return self._response(input)
+
+    async def acreate(self, input, model):
+        await asyncio.sleep(self.latency)
+        return self._response(input)
+
+
+class SlowIndex:
+    """
+        Vector index answering every call after a fixed latency, like a
+        remote Pinecone index.
+    """
+
+    def __init__(self, index, latency):
+        self._index = index
+        self.latency = latency
+
+    def __getattr__(self, name):
+        method = getattr(self._index, name)
+
+        def call(*args, **kwargs):
+            time.sleep(self.latency)
+            return method(*args, **kwargs)
+
+        return call
+
+
+def use_fake_redis():
+    """
+        Point the sync Redis client of the app and every async Redis client
+        created from a URL to one in-memory fakeredis server.
+    """
+    import fakeredis
+    import redis
+
+    server = fakeredis.FakeServer()
+    client = fakeredis.FakeStrictRedis(server=server)
+    patch("tektome_ocr.clients.get_redis_client", lambda: client).start()
+    patch.object(
+        redis.asyncio.StrictRedis,
+        "from_url",
+        lambda url, **kwargs: fakeredis.aioredis.FakeRedis(server=server),
+    ).start()
+
+
+def write_ocr_documents(path, files, paragraphs, rng):
+    # Azure-style OCR results read by the OCR task from ./sample_ocr
+    os.makedirs(os.path.join(path, "sample_ocr"), exist_ok=True)
+    for i in range(files):
+        units, offset = [], 0
+        for j in range(paragraphs):
+            words = rng.choice(WORDS, size=30).tolist()
+            words[rng.integers(30)] = f"A-{i}{j:03d}"
+            content = " ".join(words)
+            units.append(
+                {
+                    "content": content,
+                    "boundingRegions": [{"pageNumber": j // 20 + 1}],
+                    "spans": [{"offset": offset, "length": len(content)}],
+                }
+            )
+            offset += len(content) + 1
+        with open(os.path.join(path, "sample_ocr", f"doc_{i}.json"), "w") as f:
+            json.dump(
+                {"analyzeResult": {"content": "", "paragraphs": units}}, f
+            )
+
+
+def multipart_body(field, file_name, content_type, size):
+    """
+        Build a multipart/form-data body holding one file of random bytes.
+
+        :return: Tuple of (content type header, body length, chunk generator).
+    """
+    boundary = uuid.uuid4().hex
+    head = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="{field}"; '
+        f'filename="{file_name}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    block = os.urandom(1024 * 1024)
+
+    def chunks():
+        yield head
+        for start in range(0, size, len(block)):
+            yield block[:min(len(block), size - start)]
+        yield tail
+
+    return (
+        f"multipart/form-data; boundary={boundary}",
+        len(head) + size + len(tail),
+        chunks,
+    )
+
+
+class Client:
+    """
+        Minimal ASGI client calling the application in this process.
+    """
+
+    def __init__(self, application, token):
+        self.application = application
+        self.token = token
+
+    async def request(self, method, path, query=None, headers=(), body=None):
+        """
+            :param body: Callable returning an iterable of body chunks.
+            :return: Tuple of (status code, parsed JSON body or None).
+        """
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "root_path": "",
+            "query_string": urlencode(query or {}).encode(),
+            "headers": [
+                (b"host", b"localhost"),
+                (b"authorization", f"Bearer {self.token}".encode()),
+                *[(name.encode(), value.encode()) for name, value in headers],
+            ],
+            "client": ("127.0.0.1", 50000),
+            "server": ("localhost", 80),
+        }
+        chunks = iter(body() if body is not None else ())
+        body_sent = False
+        done = asyncio.Event()
+        response = {"status": None, "body": b""}
+
+        async def receive():
+            nonlocal body_sent
+            chunk = next(chunks, None)
+            if chunk is not None:
+                return {
+                    "type": "http.request",
+                    "body": chunk,
+                    "more_body": True,
+                }
+            if not body_sent:
+                body_sent = True
+                return {
+                    "type": "http.request",
+                    "body": b"",
+                    "more_body": False,
+                }
+            await done.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                response["body"] += message.get("body", b"")
+
+        await self.application(scope, receive, send)
+        done.set()
+        try:
+            return response["status"], json.loads(response["body"])
+        except ValueError:
+            return response["status"], None
+
+
+def rss_mb():
+    # Current resident memory of the process, on Linux
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return round(int(line.split()[1]) / 1024, 1)
+    return None
+
+
+async def run_workload(name, calls, concurrency):
+    """
+        Run request coroutines with at most `concurrency` in flight.
+
+        :param calls: List of callables returning a coroutine of (status,
+                      body).
+        :return: Dict with the latency percentiles, throughput and errors, and
+                 the responses in the order of the calls.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = [0.0] * len(calls)
+    responses = [None] * len(calls)
+
+    async def one(i):
+        async with semaphore:
+            start = time.perf_counter()
+            responses[i] = await calls[i]()
+            latencies[i] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(len(calls))))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    errors = sum(1 for status, _ in responses if status != 200)
+    return {
+        "workload": name,
+        "requests": len(calls),
+        "concurrency": concurrency,
+        "errors": errors,
+        "p50_ms": round(float(np.percentile(latencies, 50)), 2),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 2),
+        "rps": round(len(calls) / elapsed, 1),
+        "rss_mb": rss_mb(),
+    }, responses
+
+
+def compare(results, baseline, tolerance):
+    """
+        :return: List of the regressions of the results from the baseline.
+    """
+    previous = {result["workload"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        base = previous.get(result["workload"])
+        if base is None:
+            continue
+        if result["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{result['workload']}: p99 {result['p99_ms']} ms, "
+                f"was {base['p99_ms']} ms"
+            )
+        if result["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(
+                f"{result['workload']}: {result['rps']} requests/s, "
+                f"was {base['rps']}"
+            )
+        if result["errors"] > base["errors"]:
+            regressions.append(
+                f"{result['workload']}: {result['errors']} errors, "
+                f"was {base['errors']}"
+            )
+    return regressions
+
+
+async def benchmark(args, client, fake_openai, s3):
+    from django.conf import settings
+
+    results = []
+    # Extract workloads search documents ingested beforehand
+    files = args.files if "ingest" in args.workloads else min(args.files, 5)
+    ingest_calls = [
+        lambda i=i: client.request(
+            "POST",
+            "/mock_ocr/ocr",
+            {"signed_url": f"https://bench.local/doc_{i}.pdf"},
+        )
+        for i in range(files)
+    ]
+    ingest, responses = await run_workload("ingest", ingest_calls, 1)
+    if "ingest" in args.workloads:
+        # Seconds per stage of the OCR task, from the job status
+        timings = {}
+        for status, response in responses:
+            if status != 200:
+                continue
+            _, job = await client.request(
+                "GET", f"/mock_ocr/jobs/{response['job_id']}"
+            )
+            for stage, seconds in job.get("timings", {}).items():
+                timings[stage] = timings.get(stage, 0.0) + seconds
+        ingest["stage_seconds"] = {
+            stage: round(seconds / len(responses), 4)
+            for stage, seconds in timings.items()
+        }
+        results.append(ingest)
+
+    file_ids = [f"document_doc_{i}.pdf" for i in range(files)]
+
+    if "extract_hot" in args.workloads:
+        calls = [
+            lambda i=i: client.request(
+                "POST",
+                "/mock_ocr/extract",
+                {"query": "door A-1001", "file_id": file_ids[0]},
+            )
+            for i in range(args.requests)
+        ]
+        # The first request fills the result cache
+        await calls[0]()
+        result, _ = await run_workload("extract_hot", calls, args.concurrency)
+        results.append(result)
+
+    if "extract_cold" in args.workloads:
+        requests_before = fake_openai.requests
+        calls = [
+            lambda i=i: client.request(
+                "POST",
+                "/mock_ocr/extract",
+                {
+                    "query": f"{WORDS[i % len(WORDS)]} A-{i % files}{i:03d} "
+                    f"{uuid.uuid4().hex}",
+                    "file_id": file_ids[i % files],
+                },
+            )
+            for i in range(args.requests)
+        ]
+        result, _ = await run_workload("extract_cold", calls, args.concurrency)
+        result["openai_requests"] = fake_openai.requests - requests_before
+        results.append(result)
+
+    if "upload" in args.workloads:
+        size = args.upload_mb * 1024 * 1024
+
+        async def upload():
+            content_type, length, chunks = multipart_body(
+                "files", "drawing.pdf", "application/pdf", size
+            )
+            status, response = await client.request(
+                "POST",
+                "/file_upload/upload",
+                headers=[
+                    ("content-type", content_type),
+                    ("content-length", str(length)),
+                ],
+                body=chunks,
+            )
+            # moto keeps objects in memory, they would inflate the RSS
+            for url in (response or {}).get("uploaded_files", []):
+                s3.delete_object(
+                    Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+                    Key=urlparse(url).path.lstrip("/"),
+                )
+            return status, response
+
+        result, _ = await run_workload("upload", [upload] * args.uploads, 1)
+        result["mb_per_s"] = round(result["rps"] * args.upload_mb, 1)
+        results.append(result)
+
+    return results
+
+
+def main():
+    args = parse_args()
+
+    if args.redis_url:
+        os.environ["REDIS_URL"] = args.redis_url
+    else:
+        use_fake_redis()
+
+    # S3 clients must be created once moto intercepts requests
+    from moto import mock_aws
+
+    mock_aws().start()
+
+    import django
+    from django.conf import settings
+
+    workdir = tempfile.mkdtemp(prefix="bench_endpoints_")
+    settings.DATABASES["default"]["NAME"] = os.path.join(workdir, "db.sqlite3")
+    settings.VECTOR_STORE_PATH = os.path.join(workdir, "vector_store")
+    settings.ALLOWED_HOSTS = ["localhost"]
+    if not args.redis_url:
+        settings.CACHES = {
+            "default": {
+                "BACKEND": "django.core.cache.backends.locmem.LocMemCache"
+            }
+        }
+    django.setup()
+
+    import boto3
+    from django.contrib.auth.models import User
+    from django.core.management import call_command
+    from rest_framework_simplejwt.tokens import AccessToken
+
+    from tektome_ocr.asgi import application
+    from tektome_ocr.celery import app
+    from mock_ocr import tasks, views
+
+    app.conf.update(
+        task_always_eager=True,
+        task_eager_propagates=True,
+        task_store_eager_result=True,
+    )
+
+    fake_openai = FakeOpenAI(args.dimension, args.openai_latency_ms / 1000)
+    patch("openai.Embedding.create", fake_openai.create).start()
+    patch("openai.Embedding.acreate", fake_openai.acreate).start()
+    index = SlowIndex(tasks.index, args.vector_latency_ms / 1000)
+    patch.object(tasks, "index", index).start()
+    patch.object(views, "index", index).start()
+
+    s3 = boto3.client("s3", region_name=settings.AWS_S3_REGION_NAME)
+    s3.create_bucket(Bucket=settings.AWS_STORAGE_BUCKET_NAME)
+
+    call_command("migrate", verbosity=0)
+    user = User.objects.create_user(username="benchmark", password="benchmark")
+    client = Client(application, str(AccessToken.for_user(user)))
+
+    write_ocr_documents(
+        workdir, args.files, args.paragraphs, np.random.default_rng(0)
+    )
+    os.chdir(workdir)
+
+    results = asyncio.run(benchmark(args, client, fake_openai, s3))
+    output = {
+        "config": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "baseline")
+        },
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+        "results": results,
+    }
+    print(json.dumps(output, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Benchmark of JWTAuth.authenticate on an in-memory SQLite database.
+
+Compares the previous behaviour (one database query per request) with the
+cached and the stateless modes, and reports requests per second.
+
+Usage:
+    python benchmarks/bench_jwt_auth.py [--requests 20000]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tektome_ocr.settings")
+os.environ.setdefault("SECRET_KEY", "benchmark")
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+settings.DATABASES["default"]["NAME"] = ":memory:"
+settings.CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+}
+django.setup()
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.test import RequestFactory  # noqa: E402
+from rest_framework_simplejwt.tokens import AccessToken  # noqa: E402
+
+from auth import jwt_auth  # noqa: E402
+from auth.jwt_auth import JWTAuth  # noqa: E402
+
+
+def run(label, requests, token, request):
+    auth = JWTAuth()
+    start = time.perf_counter()
+    for _ in range(requests):
+        assert auth.authenticate(request, token) is not None
+    elapsed = time.perf_counter() - start
+    return {
+        "mode": label,
+        "requests": requests,
+        "rps": round(requests / elapsed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+
+    call_command("migrate", verbosity=0)
+    user = User.objects.create_user(username="benchmark", password="benchmark")
+    token = str(AccessToken.for_user(user))
+    request = RequestFactory().post("/mock_ocr/extract")
+
+    results = []
+
+    # Previous behaviour: every request reads the user from the database
+    settings.JWT_AUTH_STATELESS = False
+    with patch.object(
+        jwt_auth, "get_user", lambda user_id: User.objects.get(id=user_id)
+    ):
+        results.append(run("database", args.requests, token, request))
+
+    results.append(run("cached", args.requests, token, request))
+
+    settings.JWT_AUTH_STATELESS = True
+    results.append(run("stateless", args.requests, token, request))
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
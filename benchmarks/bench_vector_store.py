@@ -0,0 +1,147 @@
+"""
+Recall vs latency benchmark of the local vector store.
+
+Builds a namespace of clustered random vectors, then compares the exhaustive
+search with the IVF index at several nprobe values, reporting recall@k
+against the exact results and the query latency percentiles.
+
+Usage:
+    python benchmarks/bench_vector_store.py [--vectors 200000]
+        [--dimension 1536]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tektome_ocr.settings")
+os.environ.setdefault("SECRET_KEY", "benchmark")
+
+from mock_ocr.vector_store import LocalVectorStore  # noqa: E402
+
+
+def make_vectors(rng, count, dimension, clusters, noise):
+    # Embeddings of related chunks are close together
+    centers = rng.normal(size=(clusters, dimension)).astype(np.float32)
+    labels = rng.integers(0, clusters, count)
+    noise = rng.normal(scale=noise, size=(count, dimension)).astype(np.float32)
+    return centers[labels] + noise
+
+
+def run(label, store, queries, exact, top_k, **kwargs):
+    latencies = []
+    recall = 0
+    for query, expected in zip(queries, exact):
+        start = time.perf_counter()
+        results = store.query(query, top_k=top_k, namespace="bench", **kwargs)
+        latencies.append(time.perf_counter() - start)
+        found = {match["id"] for match in results["matches"]}
+        recall += len(found & expected) / top_k
+    latencies = np.array(latencies) * 1000
+    return {
+        "mode": label,
+        "recall": round(recall / len(queries), 4),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 2),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vectors", type=int, default=200000)
+    parser.add_argument("--dimension", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--clusters", type=int, default=1000)
+    parser.add_argument("--noise", type=float, default=1.0)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument(
+        "--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32, 64]
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = make_vectors(
+        rng, args.vectors, args.dimension, args.clusters, args.noise
+    )
+    path = tempfile.mkdtemp(prefix="bench_vector_store_")
+
+    start = time.perf_counter()
+    store = LocalVectorStore(path, ivf_min_size=args.vectors)
+    for offset in range(0, args.vectors, 1000):
+        store.upsert(
+            [
+                (f"v{i}", vectors[i], {"file_id": f"file_{i % 1000}"})
+                for i in range(offset, min(offset + 1000, args.vectors))
+            ],
+            namespace="bench",
+        )
+    store.train(namespace="bench")
+    build_seconds = time.perf_counter() - start
+
+    # A fresh store maps the files like a newly started worker
+    start = time.perf_counter()
+    reader = LocalVectorStore(path)
+    reader._load("bench")
+    load_seconds = time.perf_counter() - start
+
+    queries = vectors[rng.integers(0, args.vectors, args.queries)]
+    queries += rng.normal(scale=0.2, size=queries.shape).astype(np.float32)
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    exact = [
+        {f"v{i}" for i in np.argsort(-(normalized @ query))[:args.top_k]}
+        for query in queries
+    ]
+    file_rows = np.arange(1, args.vectors, 1000)
+    exact_in_file = []
+    for query in queries:
+        best = np.argsort(-(normalized[file_rows] @ query))[:args.top_k]
+        exact_in_file.append({f"v{i}" for i in file_rows[best]})
+
+    exhaustive = LocalVectorStore(path, ivf_min_size=args.vectors + 1)
+    exhaustive._load("bench").centroids = None
+    results = [run("exact", exhaustive, queries, exact, args.top_k)]
+    for nprobe in args.nprobe:
+        results.append(
+            run(
+                f"ivf nprobe={nprobe}",
+                reader,
+                queries,
+                exact,
+                args.top_k,
+                nprobe=nprobe,
+            )
+        )
+    results.append(
+        run(
+            "filtered by file_id",
+            reader,
+            queries,
+            exact_in_file,
+            args.top_k,
+            filter={"file_id": "file_1"},
+        )
+    )
+
+    print(
+        json.dumps(
+            {
+                "vectors": args.vectors,
+                "dimension": args.dimension,
+                "lists": len(reader._load("bench").centroids),
+                "build_seconds": round(build_seconds, 2),
+                "load_seconds": round(load_seconds, 3),
+                "results": results,
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+from boto3.s3.transfer import TransferConfig
+from django.conf import settings
+from storages.backends.s3boto3 import S3Boto3Storage
+
+
+class MultipartS3Storage(S3Boto3Storage):
+    """
+    S3 storage streaming uploads as multipart uploads, buffering at most
+    AWS_S3_MULTIPART_CONCURRENCY parts in memory. The transfer config is built
+    with the storage, on first use, so that loading the settings does not
+    import boto3.
+    """
+
+    def get_default_settings(self):
+        defaults = super().get_default_settings()
+        transfer_config = TransferConfig(
+            multipart_threshold=settings.AWS_S3_MULTIPART_PART_SIZE,
+            multipart_chunksize=settings.AWS_S3_MULTIPART_PART_SIZE,
+            max_concurrency=settings.AWS_S3_MULTIPART_CONCURRENCY,
+        )
+        transfer_config.max_in_memory_upload_chunks = (
+            settings.AWS_S3_MULTIPART_CONCURRENCY
+        )
+        defaults["transfer_config"] = transfer_config
+        return defaults
@@ -1,12 +1,42 @@
 import pytest
-from unittest.mock import patch, MagicMock
+import threading
+import boto3
+import requests
+from moto import mock_aws
+from unittest.mock import patch, AsyncMock, MagicMock
+from asgiref.sync import async_to_sync
+from django.core.cache.backends.locmem import LocMemCache
 from django.core.files.uploadedfile import UploadedFile
 from django.test import RequestFactory
+from ninja.errors import HttpError
 from file_upload.views import (
     upload_file,
+    upload_files_batch,
+    presign_upload,
+    complete_upload,
 )
 
 
+@pytest.fixture(autouse=True)
+def rate_limit_redis():
+    # Allow every request unless a test configures the rate limiter
+    with patch("auth.rate_limit.r") as mock_rate_limit_redis, patch(
+        "auth.rate_limit.get_redis"
+    ) as mock_async_redis:
+        mock_rate_limit_redis.evalsha.return_value = [1, 0]
+        mock_async_redis.return_value.register_script.return_value = AsyncMock(
+            return_value=[1, 0]
+        )
+        yield mock_rate_limit_redis
+
+
+@pytest.fixture(autouse=True)
+def document_registry():
+    # Record content hashes of uploaded files on a mock
+    with patch("mock_ocr.documents.r") as mock_registry_redis:
+        yield mock_registry_redis
+
+
 @pytest.mark.django_db
 @patch("file_upload.views.default_storage")  # Mock Django's default storage
 @patch("file_upload.views.generate_signed_url")  # Mock the generate_signed_url function
@@ -24,7 +54,7 @@ def test_upload_file_success(mock_generate_signed_url, mock_default_storage):
     request = factory.post("/upload", {"files": [mock_file]})
 
     # Call the upload_file function
-    response = upload_file(request, files=[mock_file])
+    response = async_to_sync(upload_file)(request, files=[mock_file])
 
     # Verify the response
     assert response == {"uploaded_files": ["http://mockurl.com/signed_url"]}
@@ -64,7 +94,9 @@ def test_upload_multiple_files(mock_generate_signed_url, mock_default_storage):
     request = factory.post("/upload", {"files": [mock_file1, mock_file2]})
 
     # Call the upload_file function
-    response = upload_file(request, files=[mock_file1, mock_file2])
+    response = async_to_sync(upload_file)(
+        request, files=[mock_file1, mock_file2]
+    )
 
     # Verify the response
     assert response == {
@@ -81,3 +113,222 @@ def test_upload_multiple_files(mock_generate_signed_url, mock_default_storage):
     # Ensure the content is correct for each call by comparing the read output
     assert calls[0][0][1].read() == b"mock file content 1"
     assert calls[1][0][1].read() == b"mock file content 2"
+
+
+@pytest.mark.django_db
+@patch("file_upload.views.default_storage")  # Mock Django's default storage
+@patch(
+    "file_upload.views.generate_signed_url"
+)  # Mock the generate_signed_url function
+def test_upload_file_is_streamed_to_storage(
+    mock_generate_signed_url, mock_default_storage
+):
+    mock_generate_signed_url.return_value = "http://mockurl.com/signed_url"
+
+    mock_file = MagicMock(spec=UploadedFile)
+    mock_file.name = "scan.tiff"
+
+    async_to_sync(upload_file)(
+        RequestFactory().post("/upload"), files=[mock_file]
+    )
+
+    # The uploaded file is handed to storage as-is instead of being read into
+    # memory
+    assert mock_default_storage.save.call_args[0][1] is mock_file
+    mock_file.read.assert_not_called()
+
+
+@pytest.mark.django_db
+@patch("file_upload.views.default_storage")  # Mock Django's default storage
+@patch(
+    "file_upload.views.generate_signed_url"
+)  # Mock the generate_signed_url function
+def test_upload_records_content_hash(
+    mock_generate_signed_url, mock_default_storage, document_registry
+):
+    import hashlib
+    from mock_ocr.documents import upload_key
+
+    mock_file = MagicMock(spec=UploadedFile)
+    mock_file.name = "scan.pdf"
+    mock_file.chunks.return_value = [b"mock ", b"file content"]
+    mock_default_storage.save.side_effect = lambda name, file: name
+
+    async_to_sync(upload_file)(
+        RequestFactory().post("/upload"), files=[mock_file]
+    )
+
+    # The content hash is keyed by the stored name and the file is rewound
+    # before storing
+    name = mock_default_storage.save.call_args[0][0]
+    document_registry.set.assert_called_once_with(
+        upload_key(name), hashlib.sha256(b"mock file content").hexdigest()
+    )
+    mock_file.seek.assert_called_once_with(0)
+
+
+@pytest.mark.django_db
+@patch("file_upload.views.default_storage")  # Mock Django's default storage
+def test_upload_rejects_bad_type_before_storing(mock_default_storage):
+    mock_file1 = MagicMock(spec=UploadedFile)
+    mock_file1.name = "file1.pdf"
+    mock_file2 = MagicMock(spec=UploadedFile)
+    mock_file2.name = "file2.exe"
+
+    with pytest.raises(HttpError) as excinfo:
+        async_to_sync(upload_file)(
+            RequestFactory().post("/upload"), files=[mock_file1, mock_file2]
+        )
+
+    assert excinfo.value.status_code == 400
+    assert str(excinfo.value) == "File type exe is not allowed"
+    mock_default_storage.save.assert_not_called()
+
+
+@pytest.mark.django_db
+@patch("file_upload.views.default_storage")  # Mock Django's default storage
+@patch(
+    "file_upload.views.generate_signed_url"
+)  # Mock the generate_signed_url function
+def test_upload_batch_reports_each_file(
+    mock_generate_signed_url, mock_default_storage
+):
+    mock_generate_signed_url.side_effect = (
+        lambda name: f"http://mockurl.com/{name}"
+    )
+
+    # Both uploads must be in flight at the same time to get past the barrier
+    barrier = threading.Barrier(2, timeout=5)
+
+    def save(name, file):
+        barrier.wait()
+        if file.name == "broken.png":
+            raise IOError("connection reset")
+        return name
+
+    mock_default_storage.save.side_effect = save
+
+    mock_file1 = MagicMock(spec=UploadedFile)
+    mock_file1.name = "file1.pdf"
+    mock_file1.size = 19
+    mock_file2 = MagicMock(spec=UploadedFile)
+    mock_file2.name = "broken.png"
+    mock_file2.size = 7
+
+    response = upload_files_batch(
+        RequestFactory().post("/upload_batch"), files=[mock_file1, mock_file2]
+    )
+
+    first, second = response["files"]
+    assert first["name"] == "file1.pdf"
+    assert first["url"].startswith("http://mockurl.com/") and first[
+        "url"
+    ].endswith(".pdf")
+    assert first["size"] == 19 and first["error"] is None
+    assert second["name"] == "broken.png"
+    assert second["url"] is None and second["error"] == "connection reset"
+    assert first["duration"] >= 0 and second["duration"] >= 0
+
+
+@pytest.mark.django_db
+@patch("mock_ocr.views.process_ocr_task")
+def test_direct_upload_through_presigned_post(
+    mock_celery, settings, document_registry
+):
+    import base64
+    import hashlib
+    import fakeredis
+    from mock_ocr.documents import upload_key
+
+    mock_celery.delay.return_value.id = "job-1"
+    settings.AWS_STORAGE_BUCKET_NAME = "test-bucket"
+    request = RequestFactory().post("/presign")
+    request.auth = MagicMock(id=1)
+
+    with mock_aws(), patch(
+        "file_upload.views.cache", LocMemCache("uploads", {})
+    ):
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket="test-bucket")
+        head_object, get_object = s3.head_object, s3.get_object
+
+        # moto keeps no checksum of POST uploads, return the one S3 stores
+        def head_with_checksum(**kwargs):
+            head = head_object(**kwargs)
+            body = get_object(Bucket=kwargs["Bucket"], Key=kwargs["Key"])
+            digest = hashlib.sha256(body["Body"].read()).digest()
+            head["ChecksumSHA256"] = base64.b64encode(digest).decode()
+            return head
+
+        s3.head_object = MagicMock(side_effect=head_with_checksum)
+        sha256 = hashlib.sha256(b"pdf content").hexdigest()
+
+        with patch("file_upload.views.s3_client", s3):
+            presigned = presign_upload(
+                request, file_name="drawing.PDF", sha256=sha256, size=11
+            )
+            assert presigned["key"].endswith(".pdf")
+            assert presigned["fields"]["Content-Type"] == "application/pdf"
+            assert base64.b64decode(
+                presigned["fields"]["x-amz-checksum-sha256"]
+            ) == bytes.fromhex(sha256)
+
+            # Completing before the object exists is rejected
+            with pytest.raises(HttpError) as excinfo:
+                complete_upload(request, key=presigned["key"])
+            assert excinfo.value.status_code == 404
+
+            # The client uploads straight to S3
+            response = requests.post(
+                presigned["url"],
+                data=presigned["fields"],
+                files={"file": ("drawing.pdf", b"pdf content")},
+            )
+            assert response.status_code == 204
+
+            # The upload is submitted like /ocr submissions
+            # The hash is read from the checksum S3 verified, the file is not
+            # downloaded
+            s3.get_object = MagicMock(side_effect=AssertionError)
+            with patch(
+                "mock_ocr.documents.get_redis",
+                lambda: fakeredis.aioredis.FakeRedis(),
+            ):
+                result = complete_upload(
+                    request, key=presigned["key"], process=True
+                )
+            assert s3.head_object.call_args.kwargs["ChecksumMode"] == (
+                "ENABLED"
+            )
+
+    assert result["size"] == 11
+    assert result["ocr_submitted"] is True
+    assert result["job_id"] == "job-1"
+    mock_celery.delay.assert_called_once_with(
+        result["url"], 0, webhook_url=None
+    )
+    document_registry.set.assert_called_once_with(
+        upload_key(presigned["key"]),
+        hashlib.sha256(b"pdf content").hexdigest(),
+    )
+
+
+@pytest.mark.django_db
+def test_presign_rejects_bad_type():
+    with pytest.raises(HttpError) as excinfo:
+        presign_upload(
+            RequestFactory().post("/presign"),
+            file_name="script.exe",
+            sha256="0" * 64,
+        )
+
+    assert excinfo.value.status_code == 400
+
+    with pytest.raises(HttpError) as excinfo:
+        presign_upload(
+            RequestFactory().post("/presign"),
+            file_name="drawing.pdf",
+            sha256="not-a-hash",
+        )
+
+    assert excinfo.value.status_code == 400
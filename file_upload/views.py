@@ -1,16 +1,36 @@
 from ninja import NinjaAPI, File
 from typing import List
+from concurrent.futures import ThreadPoolExecutor
 
+from asgiref.sync import async_to_sync, sync_to_async
 from ninja.errors import HttpError
 from ninja.files import UploadedFile
 from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
+from django.core.cache import cache
 from django.conf import settings
-import boto3
+from botocore.exceptions import ClientError
 
+import os
+import re
+import time
 import uuid
+import base64
 
-from auth.jwt_auth import JWTAuth
+from auth.jwt_auth import AsyncJWTAuth, JWTAuth
+from auth.rate_limit import (
+    acheck_rate_limit,
+    check_rate_limit,
+    client_identity,
+)
+from mock_ocr.views import submit_document
+from mock_ocr.documents import (
+    adocument_exists,
+    hash_file,
+    register_revision,
+    register_upload,
+)
+from tektome_ocr.clients import LazyClient, get_s3_client
+from tektome_ocr.metrics import external_call
 
 
 api = NinjaAPI(urls_namespace="file_upload")
@@ -18,7 +38,30 @@ api = NinjaAPI(urls_namespace="file_upload")
 # Allowed file types
 ALLOWED_FILE_TYPES = ["pdf", "tiff", "png", "jpeg", "jpg"]
 
-s3_client = boto3.client("s3", region_name=settings.AWS_S3_REGION_NAME)
+# Content type required for each allowed file type on direct uploads
+CONTENT_TYPES = {
+    "pdf": "application/pdf",
+    "tiff": "image/tiff",
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "jpg": "image/jpeg",
+}
+
+# Direct upload limits
+FILE_UPLOAD_MAX_SIZE = int(
+    os.getenv("FILE_UPLOAD_MAX_SIZE", 500 * 1024 * 1024)
+)
+PRESIGNED_POST_EXPIRY = 3600  # 1 hour
+# Seconds a completed direct upload stays registered, to answer repeated
+# completions of the same key
+DIRECT_UPLOAD_REGISTRY_TTL = int(
+    os.getenv("DIRECT_UPLOAD_REGISTRY_TTL", 24 * 3600)
+)
+
+# Number of files uploaded at the same time by the batch upload endpoint
+FILE_UPLOAD_CONCURRENCY = int(os.getenv("FILE_UPLOAD_CONCURRENCY", 8))
+
+s3_client = LazyClient(get_s3_client)
 
 
 def generate_signed_url(file_name):
@@ -41,17 +84,90 @@ def generate_signed_url(file_name):
     )
 
 
+def get_file_type(file_name):
+    """
+    Returns the lowercase extension of a file name.
+    """
+    return file_name.split(".")[-1].lower()
+
+
+def validate_file_types(files):
+    """
+    Validates the extension of every file before any of them is uploaded.
+
+    :param files: A list of UploadedFile objects.
+    :return: A list with the lowercase extension of each file. If any file type
+             is not allowed, an HTTP 400 error listing all of them is raised.
+    """
+    extensions = [get_file_type(file.name) for file in files]
+    rejected = sorted(
+        {ext for ext in extensions if ext not in ALLOWED_FILE_TYPES}
+    )
+    if rejected:
+        raise HttpError(400, f"File type {', '.join(rejected)} is not allowed")
+    return extensions
+
+
+def save_file(file_name, file, replaces=None):
+    """
+    Saves a file to storage and records the hash of its content, so that
+    resubmitting the same content for OCR is recognized and skipped.
+
+    :param file_name: The unique name to store the file under.
+    :param file: The UploadedFile to store.
+    :param replaces: Optional ID of the document the file is a new revision of.
+    :return: The name of the stored file.
+    """
+    content_hash = hash_file(file)
+    with external_call("s3", "upload"):
+        file_path = default_storage.save(file_name, file)
+    register_upload(file_name, content_hash)
+    if replaces:
+        register_revision(file_name, replaces)
+    return file_path
+
+
+def store_file(file, ext):
+    """
+    Saves a single file to storage under a unique name and signs its URL.
+
+    :param file: The UploadedFile to store.
+    :param ext: The validated extension of the file.
+    :return: A dict with the file name, signed URL, size in bytes and upload
+             duration in seconds. If the upload fails, the URL is None and the
+             error message is returned instead.
+    """
+    start = time.perf_counter()
+    result = {"name": file.name, "url": None, "size": file.size, "error": None}
+    try:
+        # Create a unique filename to avoid conflicts and ensure sanitization
+        unique_filename = str(uuid.uuid4()) + "." + ext
+        save_file(unique_filename, file)
+        result["url"] = generate_signed_url(unique_filename)
+    except Exception as e:
+        result["error"] = str(e)
+    result["duration"] = round(time.perf_counter() - start, 3)
+    return result
+
+
 # Upload endpoint
-@api.post("/upload", auth=JWTAuth())
-def upload_file(request, files: List[UploadedFile] = File(...)):
+@api.post("/upload", auth=AsyncJWTAuth())
+async def upload_file(
+    request, files: List[UploadedFile] = File(...), replaces: str = None
+):
     """
     Handles file uploads and returns signed URLs for the uploaded files.
 
     :param request: The request object containing authentication and other request-specific data.
     :param files: A list of UploadedFile objects representing the files to be uploaded.
                   These files are validated and processed for uploading to storage (e.g., S3).
+    :param replaces: Optional document_id of an ingested document the single
+                     uploaded file is a new revision of. Submitting the file
+                     for OCR then re-ingests that document, only embedding the
+                     chunks whose text changed.
     :return: JSON response with a list of signed URLs for the uploaded files.
-             If file validation fails, an HTTP 400 error is raised.
+             If file validation fails, an HTTP 400 error is raised, and an HTTP
+             404 error if the replaced document is unknown.
              Example response:
              {
                  "uploaded_files": [
@@ -60,22 +176,252 @@ def upload_file(request, files: List[UploadedFile] = File(...)):
                  ]
              }
     """
+    # Check if the client IP or user is exceeding the rate limit
+    if not await acheck_rate_limit(
+        *client_identity(request), endpoint="upload"
+    ):
+        raise HttpError(429, "Rate limit exceeded. Please try again later.")
+
     file_urls = []
 
-    for file in files:
-        # Get the file extension and validate it
-        ext = file.name.split(".")[-1].lower()
-        if ext not in ALLOWED_FILE_TYPES:
-            raise HttpError(400, f"File type {ext} is not allowed")
+    # Validate every file before any bytes are stored
+    extensions = validate_file_types(files)
+    if replaces:
+        if len(files) != 1:
+            raise HttpError(400, "Only one file can replace a document")
+        if not await adocument_exists(replaces):
+            raise HttpError(404, "Document not found")
 
+    for file, ext in zip(files, extensions):
         # Create a unique filename to avoid conflicts and ensure sanitization
         unique_filename = str(uuid.uuid4()) + "." + ext
 
-        # Save the file using default Django storage
-        file_path = default_storage.save(unique_filename, ContentFile(file.read()))
+        # Stream the file to storage (S3 multipart upload) without reading it
+        # into memory, on a thread so that the event loop keeps serving other
+        # requests
+        file_path = await sync_to_async(save_file, thread_sensitive=False)(
+            unique_filename, file, replaces
+        )
 
         # Retrieve signed url from S3
         file_url = generate_signed_url(unique_filename)
         file_urls.append(file_url)
 
     return {"uploaded_files": file_urls}
+
+
+# Concurrent upload endpoint
+@api.post("/upload_batch", auth=JWTAuth())
+def upload_files_batch(request, files: List[UploadedFile] = File(...)):
+    """
+    Uploads all files concurrently on a bounded worker pool and reports the
+    outcome of each file.
+
+    :param request: The request object containing authentication and other
+                    request-specific data.
+    :param files: A list of UploadedFile objects representing the files to be
+                  uploaded. All file types are validated before any file is
+                  uploaded.
+    :return: JSON response with one result per file, in the order the files
+             were sent. If file validation fails, an HTTP 400 error is raised
+             and nothing is stored.
+             Example response:
+             {
+                 "files": [
+                     {
+                         "name": "drawing.pdf",
+                         "url": "https://s3-bucket-url.com/signed-url1",
+                         "size": 1048576,
+                         "duration": 0.412,
+                         "error": null
+                     }
+                 ]
+             }
+    """
+    # Check if the client IP or user is exceeding the rate limit
+    if not check_rate_limit(*client_identity(request), endpoint="upload"):
+        raise HttpError(429, "Rate limit exceeded. Please try again later.")
+
+    extensions = validate_file_types(files)
+
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(FILE_UPLOAD_CONCURRENCY, len(files)))
+    ) as executor:
+        results = list(executor.map(store_file, files, extensions))
+
+    return {"files": results}
+
+
+def upload_registry_key(key):
+    """
+    Returns the cache key under which a direct upload is registered.
+    """
+    return f"upload:{key}"
+
+
+# Direct upload endpoint
+@api.post("/presign", auth=JWTAuth())
+def presign_upload(request, file_name: str, sha256: str, size: int = None):
+    """
+    Hands out a presigned POST so that the client uploads a file straight to
+    S3, without the file going through the application servers.
+
+    :param request: The request object containing authentication and other
+                    request-specific data.
+    :param file_name: The original name of the file, used to validate its type.
+    :param sha256: Hex SHA-256 of the file content. S3 rejects uploads whose
+                   content does not match it, so that the application records
+                   the hash without downloading the file.
+    :param size: Optional size of the file in bytes, checked against the
+                 maximum upload size.
+    :return: JSON response with the S3 key, the URL to POST to and the form
+             fields to send with the file. S3 rejects the upload if its content
+             type, size or checksum does not match the policy.
+             Example response:
+             {
+                 "key": "0b6c...e1.pdf",
+                 "url": "https://bucket-name.s3.amazonaws.com/",
+                 "fields": {
+                     "Content-Type": "application/pdf",
+                     "x-amz-checksum-algorithm": "SHA256",
+                     "x-amz-checksum-sha256": "nMoGzmsJ...rl8=",
+                     "key": "0b6c...e1.pdf",
+                     "policy": "...",
+                     ...
+                 },
+                 "expires_in": 3600
+             }
+    """
+    ext = get_file_type(file_name)
+    if ext not in ALLOWED_FILE_TYPES:
+        raise HttpError(400, f"File type {ext} is not allowed")
+    if size is not None and not 0 < size <= FILE_UPLOAD_MAX_SIZE:
+        raise HttpError(
+            400,
+            f"File size must be between 1 and {FILE_UPLOAD_MAX_SIZE} bytes",
+        )
+    sha256 = sha256.lower()
+    if not re.fullmatch(r"[0-9a-f]{64}", sha256):
+        raise HttpError(400, "sha256 must be the hex SHA-256 of the file")
+
+    key = str(uuid.uuid4()) + "." + ext
+    content_type = CONTENT_TYPES[ext]
+    # S3 computes the checksum of the uploaded content and refuses the upload
+    # unless it is the one in the policy
+    checksum = base64.b64encode(bytes.fromhex(sha256)).decode()
+    fields = {
+        "Content-Type": content_type,
+        "x-amz-checksum-algorithm": "SHA256",
+        "x-amz-checksum-sha256": checksum,
+    }
+    presigned_post = s3_client.generate_presigned_post(
+        Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+        Key=key,
+        Fields=fields,
+        Conditions=[
+            *({name: value} for name, value in fields.items()),
+            ["content-length-range", 1, FILE_UPLOAD_MAX_SIZE],
+        ],
+        ExpiresIn=PRESIGNED_POST_EXPIRY,
+    )
+
+    # Remember who may complete this upload
+    cache.set(
+        upload_registry_key(key),
+        {
+            "status": "pending",
+            "name": file_name,
+            "sha256": sha256,
+            "user_id": getattr(request.auth, "id", None),
+        },
+        timeout=PRESIGNED_POST_EXPIRY * 2,
+    )
+
+    return {
+        "key": key,
+        "url": presigned_post["url"],
+        "fields": presigned_post["fields"],
+        "expires_in": PRESIGNED_POST_EXPIRY,
+    }
+
+
+# Direct upload completion endpoint
+@api.post("/complete", auth=JWTAuth())
+def complete_upload(request, key: str, process: bool = False):
+    """
+    Registers a file uploaded through a presigned POST and optionally submits
+    it for OCR.
+
+    :param request: The request object containing authentication and other
+                    request-specific data.
+    :param key: The S3 key returned by the presign endpoint.
+    :param process: Whether to submit the file to the OCR task right away, like
+                    /ocr does: files whose content is already ingested, or
+                    being ingested, return the job of that ingestion instead of
+                    starting a new one.
+    :return: JSON response with the signed URL and size of the uploaded file,
+             and the ID of the OCR job when the file is submitted. An HTTP 404
+             error is raised if the upload is unknown or the object is not in
+             S3 yet, and an HTTP 400 error if the stored object does not match
+             the allowed type, size or checksum.
+             Example response:
+             {
+                 "key": "0b6c...e1.pdf",
+                 "url": "https://s3-bucket-url.com/signed-url",
+                 "size": 1048576,
+                 "ocr_submitted": true,
+                 "job_id": "5f0c...9a"
+             }
+    """
+    entry = cache.get(upload_registry_key(key))
+    if not entry or entry["user_id"] != getattr(request.auth, "id", None):
+        raise HttpError(404, "Upload not found")
+
+    try:
+        head = s3_client.head_object(
+            Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+            Key=key,
+            ChecksumMode="ENABLED",
+        )
+    except ClientError:
+        raise HttpError(404, "File has not been uploaded yet")
+
+    # S3 already enforces the policy, double check before accepting the object
+    ext = key.split(".")[-1]
+    checksum = head.get("ChecksumSHA256") or ""
+    if (
+        head["ContentLength"] > FILE_UPLOAD_MAX_SIZE
+        or head.get("ContentType") != CONTENT_TYPES.get(ext)
+        or base64.b64decode(checksum).hex() != entry["sha256"]
+    ):
+        s3_client.delete_object(
+            Bucket=settings.AWS_STORAGE_BUCKET_NAME, Key=key
+        )
+        raise HttpError(
+            400,
+            "Uploaded file does not match the allowed type, size or checksum",
+        )
+
+    # Record the content hash like uploads through the application do, once
+    # per upload. S3 verified it, the file is not downloaded.
+    if entry["status"] == "pending":
+        register_upload(key, entry["sha256"])
+
+    file_url = generate_signed_url(key)
+    entry.update(status="uploaded", size=head["ContentLength"])
+
+    if process:
+        submission = async_to_sync(submit_document)(file_url)
+        entry.update(status="submitted", job_id=submission["job_id"])
+
+    cache.set(
+        upload_registry_key(key), entry, timeout=DIRECT_UPLOAD_REGISTRY_TTL
+    )
+
+    return {
+        "key": key,
+        "url": file_url,
+        "size": head["ContentLength"],
+        "ocr_submitted": process,
+        "job_id": entry.get("job_id"),
+    }
@@ -0,0 +1,183 @@
+import os
+import re
+
+
+# Chunking parameters (approximate tokens, see estimate_tokens)
+OCR_CHUNK_MAX_TOKENS = int(os.getenv("OCR_CHUNK_MAX_TOKENS", 512))
+OCR_CHUNK_OVERLAP_TOKENS = int(os.getenv("OCR_CHUNK_OVERLAP_TOKENS", 64))
+
+# Average characters per token for the ada-002 tokenizer on English text
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+    """
+        Estimate the number of model tokens in a piece of text.
+
+        :param text: Text to measure.
+        :return: Approximate token count (at least 1 for non-empty text).
+    """
+    if not text:
+        return 0
+    return max(1, (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN)
+
+
+def _span_bounds(spans, default_offset=0, default_length=0):
+    """
+        Collapse a list of Azure-style spans into a single (offset, length)
+        pair.
+    """
+    if not spans:
+        return default_offset, default_length
+    if isinstance(spans, dict):
+        spans = [spans]
+    start = spans[0]["offset"]
+    end = spans[-1]["offset"] + spans[-1]["length"]
+    return start, end - start
+
+
+def _unit(text, page, offset, length):
+    return {"text": text, "page": page, "offset": offset, "length": length}
+
+
+def paragraph_units(paragraphs):
+    for paragraph in paragraphs:
+        regions = paragraph.get("boundingRegions") or [{}]
+        offset, length = _span_bounds(paragraph.get("spans"))
+        yield _unit(
+            paragraph.get("content", ""),
+            regions[0].get("pageNumber", 1),
+            offset,
+            length,
+        )
+
+
+def page_units(pages, get_content):
+    """
+        Yield the lines of every page, or the text of its spans within the
+        content returned by `get_content` for pages without lines.
+    """
+    content = None
+    for page in pages:
+        page_number = page.get("pageNumber", 1)
+        lines = page.get("lines")
+        if lines:
+            for line in lines:
+                offset, length = _span_bounds(
+                    line.get("spans") or line.get("span")
+                )
+                yield _unit(
+                    line.get("content", ""), page_number, offset, length
+                )
+        else:
+            if content is None:
+                content = get_content()
+            for span in page.get("spans", []):
+                text = content[span["offset"]:span["offset"] + span["length"]]
+                yield _unit(text, page_number, span["offset"], span["length"])
+
+
+def content_units(content):
+    for match in re.finditer(r"[^\n]+(?:\n[^\n]+)*", content):
+        yield _unit(match.group(0), 1, match.start(), len(match.group(0)))
+
+
+def _split_oversized(unit, max_tokens):
+    """
+        Split a unit that exceeds the token budget on word boundaries.
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    text = unit["text"]
+    start = end = None
+    for word in re.finditer(r"\S+", text):
+        if start is not None and word.end() - start > max_chars:
+            yield _unit(
+                text[start:end],
+                unit["page"],
+                unit["offset"] + start,
+                end - start,
+            )
+            start = None
+        if start is None:
+            start = word.start()
+        end = word.end()
+    if start is not None:
+        yield _unit(
+            text[start:end], unit["page"], unit["offset"] + start, end - start
+        )
+
+
+def _merge(window, chunk_index):
+    first, last = window[0][0], window[-1][0]
+    return {
+        "chunk_index": chunk_index,
+        "text": "\n".join(unit["text"] for unit, _ in window),
+        "page": first["page"],
+        "offset": first["offset"],
+        "length": last["offset"] + last["length"] - first["offset"],
+    }
+
+
+def chunk_units(
+    units,
+    max_tokens=OCR_CHUNK_MAX_TOKENS,
+    overlap_tokens=OCR_CHUNK_OVERLAP_TOKENS,
+):
+    """
+        Pack OCR units into page-local chunks that fit the embedding token
+        budget. Consecutive chunks of the same page share up to
+        `overlap_tokens` of trailing units so that text on a chunk boundary
+        stays retrievable.
+
+        :param units: Iterable of unit dicts as produced by read_ocr_units.
+        :param max_tokens: Maximum approximate tokens per chunk.
+        :param overlap_tokens: Approximate tokens carried over between chunks.
+        :return: Generator of chunk dicts with chunk_index, text, page, offset
+                 and length.
+    """
+    window = []
+    window_tokens = 0
+    chunk_index = 0
+
+    for unit in units:
+        if not unit["text"].strip():
+            continue
+
+        pieces = [unit]
+        if estimate_tokens(unit["text"]) > max_tokens:
+            pieces = _split_oversized(unit, max_tokens)
+
+        for piece in pieces:
+            piece_tokens = estimate_tokens(piece["text"])
+            new_page = bool(window) and piece["page"] != window[0][0]["page"]
+
+            if window and (
+                new_page or window_tokens + piece_tokens > max_tokens
+            ):
+                yield _merge(window, chunk_index)
+                chunk_index += 1
+
+                if new_page:
+                    window = []
+                else:
+                    # Keep the trailing units that fit in the overlap budget,
+                    # never the whole window, so every chunk makes progress
+                    tail = []
+                    tail_tokens = 0
+                    for entry in reversed(window[1:]):
+                        if tail_tokens + entry[1] > overlap_tokens:
+                            break
+                        tail.insert(0, entry)
+                        tail_tokens += entry[1]
+                    window = tail
+                window_tokens = sum(tokens for _, tokens in window)
+
+                # The overlap must never push the next chunk past the budget
+                while window and window_tokens + piece_tokens > max_tokens:
+                    window_tokens -= window.pop(0)[1]
+
+            window.append((piece, piece_tokens))
+            window_tokens += piece_tokens
+
+    if window:
+        yield _merge(window, chunk_index)
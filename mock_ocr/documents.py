@@ -0,0 +1,343 @@
+import os
+import time
+import hashlib
+import logging
+from collections import namedtuple
+from urllib.parse import urlparse
+
+import redis
+
+from tektome_ocr.async_clients import get_redis
+from tektome_ocr.clients import get_redis_client
+
+
+logger = logging.getLogger(__name__)
+
+# Redis holding the document registry: content hash -> ingest state
+r = get_redis_client()
+
+# Seconds an ingest job holds a document before another job may take it
+# over, covering the rate limit retries of the job
+DOCUMENT_INGEST_LEASE = int(os.getenv("DOCUMENT_INGEST_LEASE", 3600))
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Take a document for a job, unless it is ingested or held by another job.
+# ARGV: job_id, document_id, now, lease seconds
+CLAIM_SCRIPT = """
+local entry = redis.call('HMGET', KEYS[1],
+    'state', 'job_id', 'document_id', 'lease_until')
+if entry[1] == 'done' then
+    return {'done', entry[2], entry[3]}
+end
+if entry[1] == 'in_flight' and entry[2] ~= ARGV[1]
+        and tonumber(entry[4]) > tonumber(ARGV[3]) then
+    return {'in_flight', entry[2], entry[3]}
+end
+redis.call('HSET', KEYS[1], 'state', 'in_flight', 'job_id', ARGV[1],
+    'document_id', ARGV[2],
+    'lease_until', tonumber(ARGV[3]) + tonumber(ARGV[4]))
+return {'claimed', ARGV[1], ARGV[2]}
+"""
+
+# Set the state of a document only if it is still held by the same job
+# ARGV: job_id, state, vectors, key of the chunk fingerprints
+FINISH_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'job_id') == ARGV[1] then
+    redis.call('HSET', KEYS[1], 'state', ARGV[2], 'vectors', ARGV[3],
+        'chunks', ARGV[4])
+    return 1
+end
+return 0
+"""
+
+claim_script = r.register_script(CLAIM_SCRIPT)
+finish_script = r.register_script(FINISH_SCRIPT)
+
+Claim = namedtuple("Claim", ["state", "job_id", "document_id"])
+
+# Vectors of the new version of a document compared to the previous version:
+# unchanged IDs, {ID: previous ID with the same text}, IDs to embed, and
+# previous IDs that are gone
+ChunkDiff = namedtuple(
+    "ChunkDiff", ["unchanged", "moved", "changed", "deleted"]
+)
+
+
+def upload_key(name):
+    return f"ocr:upload:{name}"
+
+
+def document_key(content_hash):
+    return f"ocr:doc:{content_hash}"
+
+
+def version_key(document_id):
+    return f"ocr:version:{document_id}"
+
+
+def chunks_key(document_id):
+    return f"ocr:chunks:{document_id}"
+
+
+def revision_key(name):
+    return f"ocr:revision:{name}"
+
+
+def file_name_from_url(signed_url):
+    """
+        Name of the stored file a signed URL points to, without the query
+        string.
+    """
+    return os.path.basename(urlparse(signed_url).path)
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_stream(f):
+    """
+        Hash the content of a binary file object, a chunk at a time.
+    """
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_file(file):
+    """
+        Hash the content of an uploaded file chunk by chunk, then rewind it
+        so that it can be stored.
+
+        :param file: UploadedFile to hash.
+        :return: Hex SHA-256 of the file content.
+    """
+    digest = hashlib.sha256()
+    for chunk in file.chunks(HASH_CHUNK_SIZE):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def register_upload(name, content_hash):
+    """
+        Record the content hash of a stored file, so that the OCR task can
+        recognize its content from any signed URL of the file.
+    """
+    try:
+        r.set(upload_key(name), content_hash)
+    except redis.RedisError as e:
+        logger.warning(f"Document registry update of {name} skipped: {e}")
+
+
+def upload_hash(name):
+    """
+        :return: Content hash of a stored file, or None if it is unknown.
+    """
+    try:
+        content_hash = r.get(upload_key(name))
+    except redis.RedisError as e:
+        logger.warning(f"Document registry lookup of {name} skipped: {e}")
+        return None
+    return content_hash.decode() if content_hash is not None else None
+
+
+def register_revision(name, document_id):
+    """
+        Record that a stored file is a revision of a document, so that the
+        OCR task ingests it under the ID of that document.
+    """
+    try:
+        r.set(revision_key(name), document_id)
+    except redis.RedisError as e:
+        logger.warning(f"Revision registry update of {name} skipped: {e}")
+
+
+def revision_of(name):
+    """
+        :return: ID of the document a stored file is a revision of, or None
+                 if the file is not a revision or Redis is unavailable.
+    """
+    try:
+        document_id = r.get(revision_key(name))
+    except redis.RedisError as e:
+        logger.warning(f"Revision registry lookup of {name} skipped: {e}")
+        return None
+    return document_id.decode() if document_id is not None else None
+
+
+def claim_document(content_hash, job_id, document_id):
+    """
+        Take the ingestion of a document content for a job. Retries of the
+        job that holds the document take it again.
+
+        :param content_hash: Content hash of the document.
+        :param job_id: ID of the ingest job.
+        :param document_id: ID the vectors of the document are stored under.
+        :return: Claim with state "claimed" when the job should ingest the
+                 document, or "done" / "in_flight" with the job and document
+                 IDs of the ingestion it duplicates. Redis being unavailable
+                 lets every job ingest.
+    """
+    try:
+        state, owner, owner_document_id = claim_script(
+            keys=[document_key(content_hash)],
+            args=[job_id, document_id, time.time(), DOCUMENT_INGEST_LEASE],
+            client=r,
+        )
+    except redis.RedisError as e:
+        logger.warning(f"Document registry claim skipped: {e}")
+        return Claim("claimed", job_id, document_id)
+    return Claim(state.decode(), owner.decode(), owner_document_id.decode())
+
+
+def finish_document(content_hash, job_id, vectors, document_id):
+    """
+        Mark a document as ingested with its number of vectors, once every
+        vector was upserted (failed ingestions are released instead). The
+        entry keeps the key of the chunk fingerprints of the document, whose
+        fields are its vector IDs. The previous version of the document ID,
+        whose vectors were replaced, can then be ingested again; it is left
+        as it was when the job no longer holds the document.
+    """
+    if not _set_state(
+        content_hash, job_id, "done", vectors, chunks_key(document_id)
+    ):
+        return
+    try:
+        previous = r.getset(version_key(document_id), content_hash)
+        if previous is not None and previous.decode() != content_hash:
+            r.hset(document_key(previous.decode()), "state", "replaced")
+    except redis.RedisError as e:
+        logger.warning(
+            f"Document version update of {document_id} skipped: {e}"
+        )
+
+
+def release_document(content_hash, job_id):
+    """
+        Give up a document after a failed ingestion, so that it can be
+        submitted again.
+    """
+    _set_state(content_hash, job_id, "failed", 0, "")
+
+
+def _set_state(content_hash, job_id, state, vectors, chunks):
+    try:
+        return finish_script(
+            keys=[document_key(content_hash)],
+            args=[job_id, state, vectors, chunks],
+            client=r,
+        )
+    except redis.RedisError as e:
+        logger.warning(f"Document registry update skipped: {e}")
+        return 0
+
+
+def chunk_fingerprint(chunk):
+    """
+        Fingerprint of a chunk: the hash of its text, which alone determines
+        its embedding, then the hash of its location in the document.
+    """
+    text_hash = hash_bytes(chunk["text"].encode("utf-8"))[:32]
+    location = f"{chunk['page']}:{chunk['offset']}:{chunk['length']}"
+    return f"{text_hash}:{hash_bytes(location.encode())[:16]}"
+
+
+def get_chunk_fingerprints(document_id):
+    """
+        :return: Dict of the fingerprints of the vectors of a document by
+                 vector ID, empty if the document is unknown or Redis is
+                 unavailable.
+    """
+    try:
+        fingerprints = r.hgetall(chunks_key(document_id))
+    except redis.RedisError as e:
+        logger.warning(f"Chunk registry lookup of {document_id} skipped: {e}")
+        return {}
+    return {
+        key.decode(): value.decode() for key, value in fingerprints.items()
+    }
+
+
+def store_chunk_fingerprints(document_id, fingerprints):
+    """
+        Replace the fingerprints of the vectors of a document.
+    """
+    try:
+        pipe = r.pipeline()
+        pipe.delete(chunks_key(document_id))
+        if fingerprints:
+            pipe.hset(chunks_key(document_id), mapping=fingerprints)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Chunk registry update of {document_id} skipped: {e}")
+
+
+def diff_chunks(previous, current):
+    """
+        Compare the chunk fingerprints of two versions of a document.
+
+        :param previous: Fingerprints of the previous version by vector ID.
+        :param current: Fingerprints of the new version by vector ID.
+        :return: ChunkDiff. Vectors whose text is found in the previous
+                 version, under another ID or location, reuse its embedding.
+    """
+    by_text = {}
+    for vector_id, fingerprint in previous.items():
+        by_text.setdefault(fingerprint.split(":")[0], vector_id)
+
+    unchanged, moved, changed = [], {}, []
+    for vector_id, fingerprint in current.items():
+        text_hash = fingerprint.split(":")[0]
+        if previous.get(vector_id) == fingerprint:
+            unchanged.append(vector_id)
+        elif text_hash in by_text:
+            moved[vector_id] = by_text[text_hash]
+        else:
+            changed.append(vector_id)
+    deleted = [vector_id for vector_id in previous if vector_id not in current]
+    return ChunkDiff(unchanged, moved, changed, deleted)
+
+
+async def adocument_exists(document_id):
+    """
+        :return: Whether a document was ingested, and can be revised. Redis
+                 being unavailable lets every document be revised.
+    """
+    try:
+        return bool(await get_redis().exists(version_key(document_id)))
+    except redis.RedisError as e:
+        logger.warning(
+            f"Document version lookup of {document_id} skipped: {e}"
+        )
+        return True
+
+
+async def afind_document(name):
+    """
+        Get the registry entry of the content of a stored file when it is
+        ingested, or being ingested by a job that still holds it.
+
+        :param name: Name of the stored file.
+        :return: Dict with state, job_id and document_id, or None.
+    """
+    client = get_redis()
+    try:
+        content_hash = await client.get(upload_key(name))
+        if content_hash is None:
+            return None
+        entry = await client.hgetall(document_key(content_hash.decode()))
+    except redis.RedisError as e:
+        logger.warning(f"Document registry lookup of {name} skipped: {e}")
+        return None
+
+    entry = {key.decode(): value.decode() for key, value in entry.items()}
+    if entry.get("state") == "done" or (
+        entry.get("state") == "in_flight"
+        and float(entry["lease_until"]) > time.time()
+    ):
+        return entry
+    return None
@@ -0,0 +1,260 @@
+import os
+import hashlib
+import logging
+import threading
+import unicodedata
+
+import numpy as np
+import openai
+import redis
+
+from tektome_ocr.async_clients import get_http_session, get_redis
+from tektome_ocr.clients import get_redis_client
+from tektome_ocr.lru import LocalLRU
+from tektome_ocr.metrics import count_cache, external_call
+
+
+logger = logging.getLogger(__name__)
+
+openai.api_key = os.getenv("OPENAI_API_KEY")
+
+# Redis for the shared embedding cache
+r = get_redis_client()
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+# Number of inputs sent in a single embedding request
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 64))
+
+# Embedding cache parameters
+EMBEDDING_CACHE_TTL = int(os.getenv("EMBEDDING_CACHE_TTL", 7 * 24 * 3600))
+EMBEDDING_CACHE_LOCAL_MAX_BYTES = int(
+    os.getenv("EMBEDDING_CACHE_LOCAL_MAX_BYTES", 64 * 1024 * 1024)
+)
+
+
+local_cache = LocalLRU(EMBEDDING_CACHE_LOCAL_MAX_BYTES)
+
+_stats = {"local_hits": 0, "redis_hits": 0, "misses": 0}
+# Result label of each counter in the cache_requests_total metric
+_stat_results = {
+    "local_hits": "local_hit",
+    "redis_hits": "redis_hit",
+    "misses": "miss",
+}
+_stats_lock = threading.Lock()
+
+
+def _count(**counts):
+    with _stats_lock:
+        for name, count in counts.items():
+            _stats[name] += count
+    for name, count in counts.items():
+        count_cache("embedding", _stat_results[name], count)
+
+
+def get_embedding_cache_stats():
+    """
+        Get the embedding cache hit/miss counters of this process.
+
+        :return: Dict with local_hits, redis_hits, misses, entries and bytes.
+    """
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["entries"] = len(local_cache)
+    stats["bytes"] = local_cache.size
+    return stats
+
+
+def normalize_text(text):
+    """
+        Normalize text before hashing so that unicode and whitespace variants
+        of the same input share a cache entry.
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def embedding_cache_key(text, model=EMBEDDING_MODEL):
+    """
+        Build the cache key of an embedding from the model name and a hash of
+        the normalized text.
+    """
+    digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+    return f"emb:{model}:{digest}"
+
+
+def encode_embedding(embedding):
+    return np.asarray(embedding, dtype=np.float32).tobytes()
+
+
+def decode_embedding(blob):
+    return np.frombuffer(blob, dtype=np.float32).tolist()
+
+
+def iter_batches(items, batch_size):
+    """
+        Split a sequence into consecutive batches.
+
+        :param items: Sequence to split.
+        :param batch_size: Maximum number of items per batch.
+        :return: Generator of lists.
+    """
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def _request_embeddings(texts, model):
+    with external_call("openai", "embed"):
+        embedding_response = openai.Embedding.create(
+            input=list(texts), model=model
+        )
+    return _response_embeddings(embedding_response)
+
+
+async def _arequest_embeddings(texts, model):
+    # Reuse the pooled connections of the event loop
+    openai.aiosession.set(get_http_session())
+    with external_call("openai", "embed"):
+        embedding_response = await openai.Embedding.acreate(
+            input=list(texts), model=model
+        )
+    return _response_embeddings(embedding_response)
+
+
+def _response_embeddings(embedding_response):
+    data = sorted(
+        embedding_response["data"], key=lambda item: item.get("index", 0)
+    )
+    return [item["embedding"] for item in data]
+
+
+def _local_lookup(texts, model):
+    # Keys of the texts, and the blobs found in the in-process cache
+    keys = [embedding_cache_key(text, model) for text in texts]
+    blobs = {}
+    for key in keys:
+        if key not in blobs:
+            blob = local_cache.get(key)
+            if blob is not None:
+                blobs[key] = blob
+    return keys, blobs
+
+
+def _add_redis_hits(blobs, missing, found):
+    for key, blob in zip(missing, found):
+        if blob is not None:
+            blobs[key] = blob
+            local_cache.put(key, blob)
+
+
+def _texts_to_embed(keys, texts, blobs, local_hits):
+    # One input per distinct text that missed both caches
+    to_embed = {}
+    for key, text in zip(keys, texts):
+        if key not in blobs and key not in to_embed:
+            to_embed[key] = normalize_text(text)
+    _count(
+        local_hits=local_hits,
+        redis_hits=len(blobs) - local_hits,
+        misses=len(to_embed),
+    )
+    return to_embed
+
+
+def _remember(to_embed, embeddings):
+    # Cache fresh embeddings in process, returning the blobs for Redis
+    new_blobs = {}
+    for key, embedding in zip(to_embed, embeddings):
+        new_blobs[key] = encode_embedding(embedding)
+        local_cache.put(key, new_blobs[key])
+    return new_blobs
+
+
+def _results(keys, blobs, fresh):
+    return [
+        fresh[key] if key in fresh else decode_embedding(blobs[key])
+        for key in keys
+    ]
+
+
+def embed_texts(texts, model=EMBEDDING_MODEL, before_request=None):
+    """
+        Generate embeddings for several texts, reading them from the local and
+        Redis embedding caches first and requesting all remaining texts from
+        OpenAI in a single call.
+
+        :param texts: List of input strings.
+        :param model: Embedding model name.
+        :param before_request: Optional callable invoked with the texts that
+                               missed the cache, right before the OpenAI call.
+        :return: List of embeddings in the same order as `texts`.
+    """
+    # In-process cache
+    keys, blobs = _local_lookup(texts, model)
+    local_hits = len(blobs)
+
+    # Shared Redis cache
+    missing = [key for key in dict.fromkeys(keys) if key not in blobs]
+    if missing:
+        try:
+            with external_call("redis", "embedding_cache_read"):
+                blobs_found = r.mget(missing)
+            _add_redis_hits(blobs, missing, blobs_found)
+        except redis.RedisError as e:
+            logger.warning(f"Embedding cache lookup skipped: {e}")
+
+    # OpenAI for whatever is left
+    to_embed = _texts_to_embed(keys, texts, blobs, local_hits)
+    fresh = {}
+    if to_embed:
+        if before_request is not None:
+            before_request(list(to_embed.values()))
+        embeddings = _request_embeddings(to_embed.values(), model)
+        fresh = dict(zip(to_embed, embeddings))
+        new_blobs = _remember(to_embed, embeddings)
+
+        try:
+            pipe = r.pipeline(transaction=False)
+            for key, blob in new_blobs.items():
+                pipe.set(key, blob, ex=EMBEDDING_CACHE_TTL)
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Embedding cache store skipped: {e}")
+
+    return _results(keys, blobs, fresh)
+
+
+async def aembed_texts(texts, model=EMBEDDING_MODEL):
+    """
+        Async version of `embed_texts`, using the async Redis client and
+        HTTP session of the event loop.
+    """
+    keys, blobs = _local_lookup(texts, model)
+    local_hits = len(blobs)
+
+    client = get_redis()
+    missing = [key for key in dict.fromkeys(keys) if key not in blobs]
+    if missing:
+        try:
+            with external_call("redis", "embedding_cache_read"):
+                blobs_found = await client.mget(missing)
+            _add_redis_hits(blobs, missing, blobs_found)
+        except redis.RedisError as e:
+            logger.warning(f"Embedding cache lookup skipped: {e}")
+
+    to_embed = _texts_to_embed(keys, texts, blobs, local_hits)
+    fresh = {}
+    if to_embed:
+        embeddings = await _arequest_embeddings(to_embed.values(), model)
+        fresh = dict(zip(to_embed, embeddings))
+        new_blobs = _remember(to_embed, embeddings)
+
+        try:
+            pipe = client.pipeline(transaction=False)
+            for key, blob in new_blobs.items():
+                pipe.set(key, blob, ex=EMBEDDING_CACHE_TTL)
+            await pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Embedding cache store skipped: {e}")
+
+    return _results(keys, blobs, fresh)
@@ -0,0 +1,92 @@
+import os
+import logging
+
+import redis
+
+from tektome_ocr.async_clients import get_redis
+from tektome_ocr.clients import get_redis_client
+
+
+logger = logging.getLogger(__name__)
+
+# Redis holding the set of ingested file IDs
+r = get_redis_client()
+
+FILE_INDEX_KEY = "ocr:files"
+
+# Reject searches in files that were never ingested, before any other lookup.
+# Off by default: files ingested before the file index existed are only in it
+# once `backfill_file_index` has run or they are processed again
+EXTRACT_REQUIRE_INGESTED = (
+    os.getenv("EXTRACT_REQUIRE_INGESTED", "False") == "True"
+)
+
+
+def add_file(file_id):
+    """
+        Record that a file has vectors in the index.
+
+        :param file_id: ID of the ingested file.
+    """
+    try:
+        r.sadd(FILE_INDEX_KEY, file_id)
+    except redis.RedisError as e:
+        logger.warning(f"File index update of {file_id} skipped: {e}")
+
+
+def existing_files(file_ids):
+    """
+        Check which files were ingested, with a single O(1) lookup per file.
+        Every file is reported as existing when the check is disabled or
+        Redis is unavailable.
+
+        :param file_ids: List of file IDs.
+        :return: List of booleans, one per file.
+    """
+    if not EXTRACT_REQUIRE_INGESTED or not file_ids:
+        return [True] * len(file_ids)
+    try:
+        return [
+            bool(found) for found in r.smismember(FILE_INDEX_KEY, file_ids)
+        ]
+    except redis.RedisError as e:
+        logger.warning(f"File index lookup skipped: {e}")
+        return [True] * len(file_ids)
+
+
+async def afile_exists(file_id):
+    """
+        Check whether a file was ingested, as `existing_files` does.
+
+        :param file_id: ID of the file.
+        :return: Whether the file can be searched.
+    """
+    if not EXTRACT_REQUIRE_INGESTED:
+        return True
+    try:
+        return bool(await get_redis().sismember(FILE_INDEX_KEY, file_id))
+    except redis.RedisError as e:
+        logger.warning(f"File index lookup skipped: {e}")
+        return True
+
+
+def backfill_file_index(index, namespace="ocr"):
+    """
+        Add the files of every vector already in the index, for files
+        ingested before the file index existed. Vector IDs have the form
+        "{file_id}#{chunk_index}". Pod-based Pinecone indexes cannot list
+        their vectors: their files are only added when processed again.
+
+        :param index: Vector index supporting `list` (Pinecone serverless or
+                      the local vector store).
+        :param namespace: Namespace of the vectors.
+        :return: Number of files found.
+    """
+    file_ids = {
+        vector_id.rsplit("#", 1)[0]
+        for page in index.list(namespace=namespace)
+        for vector_id in page
+    }
+    if file_ids:
+        r.sadd(FILE_INDEX_KEY, *file_ids)
+    return len(file_ids)
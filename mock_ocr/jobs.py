@@ -0,0 +1,159 @@
+import os
+import time
+import socket
+import logging
+import ipaddress
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import requests
+from celery.result import AsyncResult
+
+from tektome_ocr.celery import app
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds the worker waits for a webhook to answer
+JOB_WEBHOOK_TIMEOUT = float(os.getenv("JOB_WEBHOOK_TIMEOUT", 10))
+
+# Comma-separated hosts webhooks may be sent to. When empty, webhooks may be
+# sent to any host, as long as it only resolves to public addresses.
+JOB_WEBHOOK_ALLOWED_HOSTS = {
+    host.strip().lower()
+    for host in os.getenv("JOB_WEBHOOK_ALLOWED_HOSTS", "").split(",")
+    if host.strip()
+}
+
+
+class StageTimer:
+    """
+        Seconds spent in each stage of an OCR job (load, chunk, embed,
+        upsert). Time spent in a stage entered several times, like embed and
+        upsert which alternate per batch, is summed. The job state is updated
+        in the result backend the first time each stage starts.
+    """
+
+    def __init__(self, task=None):
+        self.task = task
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name):
+        if name not in self.timings:
+            self.timings[name] = 0.0
+            self._publish(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = round(
+                self.timings[name] + time.perf_counter() - start, 3
+            )
+
+    def _publish(self, stage):
+        # Tasks called directly, e.g. in tests, have no job to update
+        if self.task is None or self.task.request.called_directly:
+            return
+        self.task.update_state(
+            state="PROGRESS",
+            meta={"stage": stage, "timings": dict(self.timings)},
+        )
+
+
+def job_status(job_id, state, info):
+    """
+        Describe a job from its Celery state.
+
+        :param job_id: ID of the job (Celery task ID).
+        :param state: Celery state of the task.
+        :param info: Result of the task, its progress meta, or the exception
+                     raised.
+        :return: Dict with job_id, status, and the stage, timings, result or
+                 error known so far. Unknown job IDs are reported as pending.
+    """
+    job = {"job_id": job_id}
+    if state == "PENDING":
+        job["status"] = "pending"
+    elif state in ("STARTED", "PROGRESS"):
+        job["status"] = "running"
+        if isinstance(info, dict):
+            job["stage"] = info.get("stage")
+            job["timings"] = info.get("timings", {})
+    elif state == "RETRY":
+        job["status"] = "retrying"
+    elif state == "SUCCESS":
+        # The task reports its own errors, e.g. a missing OCR file
+        job["status"] = "failed" if "error" in info else "completed"
+        job["timings"] = info.get("timings", {})
+        job["result"] = {
+            key: value for key, value in info.items() if key != "timings"
+        }
+    else:
+        job["status"] = "failed"
+        job["result"] = {"error": str(info)}
+    return job
+
+
+def get_job(job_id):
+    """
+        Get the status of a job from the Celery result backend.
+    """
+    result = AsyncResult(job_id, app=app)
+    return job_status(job_id, result.state, result.info)
+
+
+def validate_webhook_url(url):
+    """
+        Check that a webhook URL cannot be used to reach internal services
+        from the workers: its host must be in JOB_WEBHOOK_ALLOWED_HOSTS when
+        set, otherwise it must only resolve to public addresses.
+
+        :param url: Webhook URL.
+        :raises ValueError: If the webhook URL is not allowed.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ValueError("Webhook URL must be an http or https URL.")
+    host = parsed.hostname.lower()
+    if JOB_WEBHOOK_ALLOWED_HOSTS:
+        if host not in JOB_WEBHOOK_ALLOWED_HOSTS:
+            raise ValueError(f"Webhook host {host} is not allowed.")
+        return
+
+    try:
+        addresses = {
+            info[4][0]
+            for info in socket.getaddrinfo(
+                host, parsed.port, proto=socket.IPPROTO_TCP
+            )
+        }
+    except socket.gaierror:
+        raise ValueError(f"Webhook host {host} cannot be resolved.")
+    for address in addresses:
+        # Private, loopback, link-local and reserved addresses are not global
+        ip = ipaddress.ip_address(address.split("%")[0])
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError(f"Webhook host {host} is not a public host.")
+
+
+def notify_webhook(url, job):
+    """
+        POST the final status of a job to the webhook given when it was
+        submitted. Failures are logged, they do not fail the job.
+
+        The URL is validated again before sending, as its host may resolve to
+        other addresses since the job was submitted, and redirects are not
+        followed.
+
+        :param url: Webhook URL.
+        :param job: Job status, as returned by `job_status`.
+    """
+    try:
+        validate_webhook_url(url)
+        response = requests.post(
+            url, json=job, timeout=JOB_WEBHOOK_TIMEOUT, allow_redirects=False
+        )
+        response.raise_for_status()
+    except (ValueError, requests.RequestException) as e:
+        logger.warning(f"Webhook of job {job['job_id']} failed: {e}")
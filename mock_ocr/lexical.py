@@ -0,0 +1,313 @@
+import os
+import re
+import time
+import logging
+
+import msgpack
+import numpy as np
+import redis
+
+from mock_ocr.embeddings import normalize_text
+from mock_ocr.shard_cache import shard_cache
+from tektome_ocr.clients import get_redis_client
+from tektome_ocr.lru import LocalLRU
+
+
+logger = logging.getLogger(__name__)
+
+# Redis holding one BM25 segment per file
+r = get_redis_client()
+
+BM25_K1 = float(os.getenv("BM25_K1", 1.2))
+BM25_B = float(os.getenv("BM25_B", 0.75))
+
+# Memory bound and lifetime of the segments cached by each process
+LEXICAL_CACHE_MAX_BYTES = int(
+    os.getenv("LEXICAL_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+)
+LEXICAL_CACHE_TTL = int(os.getenv("LEXICAL_CACHE_TTL", 300))
+
+# Words, and codes such as A-101, 2024-05-01, 12/03 or 4.5 kept whole
+TOKEN_PATTERN = re.compile(r"\w+(?:[-./:]\w+)*")
+PART_PATTERN = re.compile(r"\w+")
+
+
+def segment_key(file_id):
+    return f"bm25:{file_id}"
+
+
+def pending_segment_key(file_id, job_id):
+    return f"bm25:pending:{file_id}:{job_id}"
+
+
+def tokenize(text):
+    """
+        Split text into casefolded terms. Codes are indexed whole and by
+        their parts, so that "A-101" matches "a-101" exactly and "101" partly.
+
+        :param text: Text to split.
+        :return: List of terms.
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall(normalize_text(text).casefold()):
+        terms.append(token)
+        parts = PART_PATTERN.findall(token)
+        if len(parts) > 1:
+            terms.extend(parts)
+    return terms
+
+
+class Segment:
+    """
+        BM25 inverted index of the chunks of a single file. The posting lists
+        of the sorted terms are stored back to back in two arrays (chunk rows
+        and term frequencies), delimited by `offsets`.
+    """
+
+    def __init__(self, terms, offsets, rows, tfs, lengths, ids, metadata):
+        self.terms = terms
+        self.offsets = offsets
+        self.rows = rows
+        self.tfs = tfs
+        self.lengths = lengths
+        self.ids = ids
+        self.metadata = metadata
+        self._term_index = {term: i for i, term in enumerate(terms)}
+        self.loaded_at = time.monotonic()
+        self.nbytes = (
+            offsets.nbytes
+            + rows.nbytes
+            + tfs.nbytes
+            + lengths.nbytes
+            + sum(len(term) for term in terms)
+            + sum(len(meta.get("text", "")) for meta in metadata)
+        )
+
+    @classmethod
+    def build(cls, vectors):
+        """
+            Index the text of vectors.
+
+            :param vectors: Iterable of (vector ID, metadata) pairs, the text
+                            being the "text" field of the metadata.
+            :return: Segment.
+        """
+        ids, metadata, lengths = [], [], []
+        postings = {}
+        for row, (vector_id, meta) in enumerate(vectors):
+            ids.append(vector_id)
+            metadata.append(meta)
+            terms = tokenize(meta.get("text", ""))
+            lengths.append(len(terms))
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                postings.setdefault(term, []).append((row, count))
+
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.uint32)
+        offsets[1:] = np.cumsum([len(postings[term]) for term in terms])
+        flat = [posting for term in terms for posting in postings[term]]
+        rows = np.array([row for row, _ in flat], dtype=np.uint32)
+        tfs = np.minimum([count for _, count in flat], 65535).astype(np.uint16)
+        return cls(
+            terms,
+            offsets,
+            rows,
+            tfs,
+            np.array(lengths, dtype=np.uint32),
+            ids,
+            metadata,
+        )
+
+    def encode(self):
+        return msgpack.packb(
+            [
+                self.terms,
+                self.offsets.tobytes(),
+                self.rows.tobytes(),
+                self.tfs.tobytes(),
+                self.lengths.tobytes(),
+                self.ids,
+                self.metadata,
+            ]
+        )
+
+    @classmethod
+    def decode(cls, blob):
+        terms, offsets, rows, tfs, lengths, ids, metadata = msgpack.unpackb(
+            blob
+        )
+        return cls(
+            terms,
+            np.frombuffer(offsets, dtype=np.uint32),
+            np.frombuffer(rows, dtype=np.uint32),
+            np.frombuffer(tfs, dtype=np.uint16),
+            np.frombuffer(lengths, dtype=np.uint32),
+            ids,
+            metadata,
+        )
+
+    def search(self, query, top_k=5):
+        """
+            Rank the chunks of the file by their BM25 score for a query.
+
+            :return: List of matches with id, score and metadata, only
+                     chunks containing a query term.
+        """
+        if not self.ids:
+            return []
+        count = len(self.ids)
+        average_length = max(float(self.lengths.mean()), 1.0)
+        scores = np.zeros(count, dtype=np.float32)
+        for term in set(tokenize(query)):
+            i = self._term_index.get(term)
+            if i is None:
+                continue
+            start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+            rows = self.rows[start:end]
+            tfs = self.tfs[start:end].astype(np.float32)
+            df = end - start
+            idf = np.log(1 + (count - df + 0.5) / (df + 0.5))
+            norms = tfs + BM25_K1 * (
+                1 - BM25_B + BM25_B * self.lengths[rows] / average_length
+            )
+            scores[rows] += idf * tfs * (BM25_K1 + 1) / norms
+
+        matched = np.flatnonzero(scores)
+        if len(matched) > top_k:
+            matched = matched[
+                np.argpartition(-scores[matched], top_k - 1)[:top_k]
+            ]
+        matched = matched[np.argsort(-scores[matched], kind="stable")]
+        return [
+            {
+                "id": self.ids[row],
+                "score": float(scores[row]),
+                "metadata": self.metadata[row],
+            }
+            for row in matched
+        ]
+
+
+def store_segment(file_id, segment, job_id=None, ttl=None):
+    """
+        Save the segment of a file, replacing the segment of its previous
+        version.
+
+        :param job_id: Keep the segment aside for `publish_segment` instead,
+                       e.g. until every vector of the file is upserted.
+        :param ttl: Seconds the segment is kept, unlimited by default.
+    """
+    if job_id is None:
+        key = segment_key(file_id)
+    else:
+        key = pending_segment_key(file_id, job_id)
+    try:
+        r.set(key, segment.encode(), ex=ttl)
+    except redis.RedisError as e:
+        logger.warning(f"Lexical index update of {file_id} skipped: {e}")
+
+
+def publish_segment(file_id, job_id):
+    """
+        Replace the segment of a file by the one saved aside by a job. The
+        segment is kept until the next version replaces it.
+    """
+    try:
+        # RENAME keeps the expiry of the pending segment
+        pipe = r.pipeline()
+        pipe.rename(pending_segment_key(file_id, job_id), segment_key(file_id))
+        pipe.persist(segment_key(file_id))
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Lexical index update of {file_id} skipped: {e}")
+
+
+def load_segment(file_id):
+    """
+        :return: Segment of a file, or None if the file has none or Redis
+                 is unavailable.
+    """
+    try:
+        blob = r.get(segment_key(file_id))
+    except redis.RedisError as e:
+        logger.warning(f"Lexical index lookup of {file_id} skipped: {e}")
+        return None
+    return Segment.decode(blob) if blob is not None else None
+
+
+class SegmentCache:
+    """
+        Process-local LRU of decoded segments, bounded by memory. Segments
+        are dropped with the shards of the same file when it is ingested
+        again, and loaded again after LEXICAL_CACHE_TTL seconds in any case.
+    """
+
+    def __init__(
+        self, max_bytes=LEXICAL_CACHE_MAX_BYTES, ttl=LEXICAL_CACHE_TTL
+    ):
+        self.ttl = ttl
+        self._segments = LocalLRU(
+            max_bytes, sizeof=lambda segment: segment.nbytes
+        )
+        shard_cache.add_listener(self._on_invalidation)
+
+    def get(self, file_id):
+        shard_cache.listen()
+        segment = self._segments.get(file_id)
+        if (
+            segment is not None
+            and time.monotonic() - segment.loaded_at < self.ttl
+        ):
+            return segment
+        segment = load_segment(file_id)
+        if segment is not None:
+            self._segments.put(file_id, segment)
+        return segment
+
+    def _on_invalidation(self, file_id):
+        if file_id is None:
+            self._segments.clear()
+        else:
+            self._segments.pop(file_id)
+
+
+segment_cache = SegmentCache()
+
+
+def lexical_search(query, file_id, top_k=5):
+    """
+        Search the chunks of a file for the terms of a query.
+
+        :return: List of matches with id, BM25 score and metadata, or None
+                 if the file has no lexical index (ingested before it existed).
+    """
+    segment = segment_cache.get(file_id)
+    if segment is None:
+        return None
+    return segment.search(query, top_k)
+
+
+def fuse_results(result_lists, top_k=5, k=60):
+    """
+        Merge ranked lists with reciprocal rank fusion: every match scores
+        1 / (k + rank) in each list it appears in.
+
+        :param result_lists: Lists of matches, best first.
+        :return: Top matches with their fused score.
+    """
+    fused = {}
+    for results in result_lists:
+        for rank, match in enumerate(results, start=1):
+            entry = fused.setdefault(
+                match["id"],
+                {
+                    "id": match["id"],
+                    "score": 0.0,
+                    "metadata": match["metadata"],
+                },
+            )
+            entry["score"] += 1 / (k + rank)
+    return sorted(fused.values(), key=lambda match: -match["score"])[:top_k]
@@ -0,0 +1,50 @@
+import ijson
+
+from mock_ocr.chunking import content_units, page_units, paragraph_units
+
+
+def _stream(path, prefix):
+    # Parse one array or value of the file at a time, never the whole document
+    with open(path, "rb") as f:
+        yield from ijson.items(f, prefix, use_float=True)
+
+
+def _first(path, prefix, default=None):
+    return next(_stream(path, prefix), default)
+
+
+def read_ocr_units(path):
+    """
+        Stream the smallest text units (paragraphs, else lines, else page
+        spans) of an Azure-style OCR JSON file, each tagged with its page
+        number and its character offset/length within
+        `analyzeResult.content`. The file is not loaded in memory: only one
+        paragraph or page (with its words and polygons) is held at a time.
+        The file is read again for each layout it falls back to.
+
+        :param path: Path of the OCR JSON file, holding an `analyzeResult`
+                     object.
+        :return: Generator of unit dicts with text, page, offset and length.
+    """
+    found = False
+    for unit in paragraph_units(
+        _stream(path, "analyzeResult.paragraphs.item")
+    ):
+        found = True
+        yield unit
+    if found:
+        return
+
+    def get_content():
+        return _first(path, "analyzeResult.content") or ""
+
+    for unit in page_units(
+        _stream(path, "analyzeResult.pages.item"), get_content
+    ):
+        found = True
+        yield unit
+    if found:
+        return
+
+    # No layout information, fall back to blank-line separated blocks
+    yield from content_units(get_content())
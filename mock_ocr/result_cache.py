@@ -0,0 +1,390 @@
+import os
+import time
+import uuid
+import asyncio
+import hashlib
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import msgpack
+import redis
+from asgiref.sync import sync_to_async
+
+from mock_ocr.embeddings import normalize_text
+from tektome_ocr.async_clients import get_redis
+from tektome_ocr.clients import get_redis_client
+from tektome_ocr.metrics import count_cache, external_call
+
+
+logger = logging.getLogger(__name__)
+
+# Redis for the shared extract result cache
+r = get_redis_client()
+
+# Seconds results are fresh, then served stale while being refreshed
+EXTRACT_CACHE_TTL = int(os.getenv("EXTRACT_CACHE_TTL", 600))
+EXTRACT_CACHE_STALE_TTL = int(os.getenv("EXTRACT_CACHE_STALE_TTL", 300))
+# Seconds searches without matches are cached, they are not served stale
+EXTRACT_CACHE_NEGATIVE_TTL = int(os.getenv("EXTRACT_CACHE_NEGATIVE_TTL", 60))
+# Seconds a request computing results holds their lock, and other requests
+# wait for them before computing the results themselves
+EXTRACT_CACHE_LOCK_TIMEOUT = int(os.getenv("EXTRACT_CACHE_LOCK_TIMEOUT", 10))
+EXTRACT_CACHE_REFRESH_WORKERS = int(
+    os.getenv("EXTRACT_CACHE_REFRESH_WORKERS", 4)
+)
+
+# Seconds between checks for results computed by another request
+LOCK_POLL_INTERVAL = 0.05
+
+# Delete a lock only if it is still held by the same request
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+release_lock_script = r.register_script(RELEASE_LOCK_SCRIPT)
+
+# Background refreshes of stale results
+refresh_executor = ThreadPoolExecutor(
+    max_workers=EXTRACT_CACHE_REFRESH_WORKERS
+)
+
+CachedResults = namedtuple("CachedResults", ["results", "stale"])
+
+
+def normalize_query(query):
+    """
+        Normalize a query so that unicode, whitespace and case variants share
+        cached results.
+    """
+    return normalize_text(query).casefold()
+
+
+def _digest(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def result_cache_key(query, file_id, mode="vector", generation=0):
+    """
+        Build the fixed-size cache key of the results of a query within a file
+        from hashes of the file ID and of the normalized query, and the
+        generation of the file. Results of other retrieval modes than vector
+        search have their own keys.
+    """
+    key = (
+        f"extract:{_digest(file_id)}:{generation}:"
+        f"{_digest(normalize_query(query))}"
+    )
+    return key if mode == "vector" else f"{key}:{mode}"
+
+
+def generation_key(file_id):
+    return f"extract:generation:{_digest(file_id)}"
+
+
+def bump_generation(file_id):
+    """
+        Move a file to a new generation once it is ingested again, so that
+        the results cached for the previous version, including searches
+        without matches, are no longer read.
+    """
+    try:
+        r.incr(generation_key(file_id))
+    except redis.RedisError as e:
+        logger.warning(f"Result cache invalidation of {file_id} skipped: {e}")
+
+
+def file_generations(file_ids):
+    """
+        Get the generation of several files in a single round trip.
+
+        :return: Dict of generations by file ID, 0 for files never ingested
+                 again or when Redis is unavailable.
+    """
+    if not file_ids:
+        return {}
+    try:
+        generations = r.mget([generation_key(f) for f in file_ids])
+    except redis.RedisError as e:
+        logger.warning(f"Result cache generation lookup skipped: {e}")
+        generations = [None] * len(file_ids)
+    return {
+        file_id: int(generation or 0)
+        for file_id, generation in zip(file_ids, generations)
+    }
+
+
+async def afile_generation(file_id):
+    try:
+        generation = await get_redis().get(generation_key(file_id))
+    except redis.RedisError as e:
+        logger.warning(f"Result cache generation lookup skipped: {e}")
+        return 0
+    return int(generation or 0)
+
+
+def encode_results(results, stored_at=None):
+    """
+        Serialize matches with msgpack as
+        [stored_at, [[id, score, metadata], ...]].
+    """
+    return msgpack.packb(
+        [
+            time.time() if stored_at is None else stored_at,
+            [
+                [match["id"], match["score"], match.get("metadata") or {}]
+                for match in results
+            ],
+        ]
+    )
+
+
+def decode_results(blob):
+    """
+        Deserialize matches encoded with `encode_results`.
+
+        :return: Tuple of (stored_at, list of matches with id, score and
+                 metadata).
+    """
+    stored_at, matches = msgpack.unpackb(blob)
+    return stored_at, [
+        {"id": vector_id, "score": score, "metadata": metadata}
+        for vector_id, score, metadata in matches
+    ]
+
+
+def read_results(keys):
+    """
+        Get cached results of several keys in a single round trip.
+
+        :param keys: Result cache keys.
+        :return: List with a CachedResults or None for every key.
+    """
+    if not keys:
+        return []
+    try:
+        with external_call("redis", "result_cache_read"):
+            blobs = r.mget(keys)
+    except redis.RedisError as e:
+        logger.warning(f"Result cache lookup skipped: {e}")
+        return [None] * len(keys)
+    return _entries(blobs)
+
+
+async def aread_results(keys):
+    try:
+        with external_call("redis", "result_cache_read"):
+            blobs = await get_redis().mget(keys)
+    except redis.RedisError as e:
+        logger.warning(f"Result cache lookup skipped: {e}")
+        return [None] * len(keys)
+    return _entries(blobs)
+
+
+def _entries(blobs):
+    now = time.time()
+    entries = []
+    for blob in blobs:
+        if blob is None:
+            entries.append(None)
+            continue
+        stored_at, results = decode_results(blob)
+        stale = bool(results) and now - stored_at >= EXTRACT_CACHE_TTL
+        entries.append(CachedResults(results, stale))
+    return entries
+
+
+def store_results(key, results):
+    """
+        Cache results, kept for EXTRACT_CACHE_TTL seconds plus the time they
+        may be served stale. Empty results are kept EXTRACT_CACHE_NEGATIVE_TTL
+        seconds.
+    """
+    try:
+        with external_call("redis", "result_cache_write"):
+            r.set(key, encode_results(results), ex=_ttl(results))
+    except redis.RedisError as e:
+        logger.warning(f"Result cache store skipped: {e}")
+
+
+async def astore_results(key, results):
+    try:
+        with external_call("redis", "result_cache_write"):
+            await get_redis().set(
+                key, encode_results(results), ex=_ttl(results)
+            )
+    except redis.RedisError as e:
+        logger.warning(f"Result cache store skipped: {e}")
+
+
+def count_lookups(entries):
+    """
+        Count the cache hits, stale hits and misses of looked up results.
+
+        :param entries: CachedResults or None of every key looked up.
+    """
+    for entry in entries:
+        if entry is None:
+            count_cache("extract_results", "miss")
+        else:
+            count_cache("extract_results", "stale" if entry.stale else "hit")
+
+
+def _ttl(results):
+    if results:
+        return EXTRACT_CACHE_TTL + EXTRACT_CACHE_STALE_TTL
+    return EXTRACT_CACHE_NEGATIVE_TTL
+
+
+def try_lock(key):
+    """
+        Take the lock computing the results of a key.
+
+        :return: Token of the lock, or None if another request holds it.
+                 An empty token is returned when Redis is unavailable.
+    """
+    token = uuid.uuid4().hex
+    try:
+        if r.set(f"lock:{key}", token, nx=True, ex=EXTRACT_CACHE_LOCK_TIMEOUT):
+            return token
+        return None
+    except redis.RedisError as e:
+        logger.warning(f"Result cache lock skipped: {e}")
+        return ""
+
+
+async def atry_lock(key):
+    token = uuid.uuid4().hex
+    try:
+        if await get_redis().set(
+            f"lock:{key}", token, nx=True, ex=EXTRACT_CACHE_LOCK_TIMEOUT
+        ):
+            return token
+        return None
+    except redis.RedisError as e:
+        logger.warning(f"Result cache lock skipped: {e}")
+        return ""
+
+
+def release_lock(key, token):
+    if not token:
+        return
+    try:
+        release_lock_script(keys=[f"lock:{key}"], args=[token], client=r)
+    except redis.RedisError as e:
+        logger.warning(f"Result cache lock release skipped: {e}")
+
+
+async def arelease_lock(key, token):
+    if not token:
+        return
+    try:
+        script = get_redis().register_script(RELEASE_LOCK_SCRIPT)
+        await script(keys=[f"lock:{key}"], args=[token])
+    except redis.RedisError as e:
+        logger.warning(f"Result cache lock release skipped: {e}")
+
+
+def compute_and_store(key, compute, token):
+    """
+        Compute results under a lock taken with `try_lock`, and cache them.
+    """
+    try:
+        results = compute()
+        store_results(key, results)
+        return results
+    finally:
+        release_lock(key, token)
+
+
+async def acompute_and_store(key, compute, token):
+    try:
+        results = await compute()
+        await astore_results(key, results)
+        return results
+    finally:
+        await arelease_lock(key, token)
+
+
+def single_flight(key, compute):
+    """
+        Compute results that are not cached, letting only one request at a
+        time compute the results of a key while the others wait for them.
+
+        :param key: Result cache key.
+        :param compute: Callable returning the list of matches.
+        :return: List of matches.
+    """
+    deadline = time.monotonic() + EXTRACT_CACHE_LOCK_TIMEOUT
+    while True:
+        token = try_lock(key)
+        if token is not None:
+            return compute_and_store(key, compute, token)
+
+        # Another request is computing the same results
+        time.sleep(LOCK_POLL_INTERVAL)
+        entry = read_results([key])[0]
+        if entry is not None:
+            return entry.results
+        if time.monotonic() > deadline:
+            logger.warning(f"Timed out waiting for results of {key}")
+            return compute()
+
+
+async def asingle_flight(key, compute):
+    """
+        Async version of `single_flight`, with an async `compute`.
+    """
+    deadline = time.monotonic() + EXTRACT_CACHE_LOCK_TIMEOUT
+    while True:
+        token = await atry_lock(key)
+        if token is not None:
+            return await acompute_and_store(key, compute, token)
+
+        await asyncio.sleep(LOCK_POLL_INTERVAL)
+        entry = (await aread_results([key]))[0]
+        if entry is not None:
+            return entry.results
+        if time.monotonic() > deadline:
+            logger.warning(f"Timed out waiting for results of {key}")
+            return await compute()
+
+
+def refresh_in_background(key, compute):
+    """
+        Recompute stale results on a background thread, unless another
+        request is already refreshing them.
+    """
+    token = try_lock(key)
+    if token is not None:
+        refresh_executor.submit(compute_and_store, key, compute, token)
+
+
+async def aget_results(query, file_id, compute, refresh, mode="vector"):
+    """
+        Get the results of a query within a file from the cache, computing
+        them on a miss. Stale results are returned immediately and refreshed
+        in the background.
+
+        :param query: Search query.
+        :param file_id: ID of the file to search within.
+        :param compute: Async callable returning the list of matches.
+        :param refresh: Callable returning the list of matches, run on the
+                        refresh thread pool when the results are stale.
+        :param mode: Retrieval mode the results are computed with.
+        :return: Tuple of (list of matches, whether they came from the cache).
+    """
+    generation = await afile_generation(file_id)
+    key = result_cache_key(query, file_id, mode, generation)
+    entry = (await aread_results([key]))[0]
+    count_lookups([entry])
+    if entry is not None:
+        if entry.stale:
+            await sync_to_async(refresh_in_background, thread_sensitive=False)(
+                key, refresh
+            )
+        return entry.results, True
+    return await asingle_flight(key, compute), False
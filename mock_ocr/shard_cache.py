@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import logging
+import threading
+
+import numpy as np
+import redis
+
+from tektome_ocr.clients import get_redis_client
+from tektome_ocr.lru import LocalLRU
+from tektome_ocr.metrics import external_call
+
+
+logger = logging.getLogger(__name__)
+
+# Redis used to broadcast shard invalidations to every web process
+r = get_redis_client()
+
+# Memory bound of the shards cached by each process, 0 (the default) disables
+# the cache. Only enable it for indexes supporting `list` (see `fetch_shard`).
+SHARD_CACHE_MAX_BYTES = int(os.getenv("SHARD_CACHE_MAX_BYTES", 0))
+# Seconds a shard is served before being fetched again, bounding staleness
+# when an invalidation is missed
+SHARD_CACHE_TTL = int(os.getenv("SHARD_CACHE_TTL", 300))
+
+SHARD_INVALIDATION_CHANNEL = "extract:shards:invalidate"
+
+# Vectors fetched per request when loading a shard
+SHARD_FETCH_BATCH_SIZE = 100
+
+# Seconds between attempts to start the invalidation listener
+LISTENER_RETRY_DELAY = 30
+
+
+class Shard:
+    """
+        All vectors of a single file as one float32 matrix of L2-normalized
+        rows, searched locally with a single matrix-vector product.
+    """
+
+    def __init__(self, ids, vectors, metadata):
+        self.ids = ids
+        self.metadata = metadata
+        self.vectors = np.asarray(vectors, dtype=np.float32)
+        if not ids:
+            self.vectors = self.vectors.reshape(0, 0)
+        norms = np.linalg.norm(self.vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        self.vectors /= norms
+        self.loaded_at = time.monotonic()
+        self.nbytes = (
+            self.vectors.nbytes
+            + sum(len(vector_id) for vector_id in ids)
+            + sum(len(json.dumps(meta)) for meta in metadata)
+        )
+
+    def search(self, query_embedding, top_k=5):
+        """
+            Find the top_k vectors of the file most similar (cosine) to the
+            query.
+
+            :return: List of matches with id, score and metadata.
+        """
+        if not self.ids:
+            return []
+        query = np.asarray(query_embedding, dtype=np.float32)
+        scores = self.vectors @ (query / (np.linalg.norm(query) or 1))
+        k = min(top_k, len(self.ids))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [
+            {
+                "id": self.ids[row],
+                "score": float(scores[row]),
+                "metadata": self.metadata[row],
+            }
+            for row in best
+        ]
+
+
+def fetch_shard(index, file_id, namespace="ocr"):
+    """
+        Fetch every vector of a file from the index. Vector IDs of a file
+        share the "{file_id}#" prefix, which requires an index supporting
+        `list` (Pinecone serverless, or the local vector store).
+
+        :param index: Vector index to read from.
+        :param file_id: ID of the file.
+        :param namespace: Namespace of the vectors.
+        :return: Shard of the file.
+    """
+    with external_call("vector_store", "list"):
+        vector_ids = [
+            vector_id
+            for page in index.list(prefix=f"{file_id}#", namespace=namespace)
+            for vector_id in page
+        ]
+
+    ids, vectors, metadata = [], [], []
+    for start in range(0, len(vector_ids), SHARD_FETCH_BATCH_SIZE):
+        batch = vector_ids[start:start + SHARD_FETCH_BATCH_SIZE]
+        with external_call("vector_store", "fetch"):
+            response = index.fetch(ids=batch, namespace=namespace)
+        for vector_id, vector in response["vectors"].items():
+            ids.append(vector_id)
+            vectors.append(vector["values"])
+            metadata.append(vector.get("metadata") or {})
+
+    return Shard(ids, vectors, metadata)
+
+
+class ShardCache:
+    """
+        Process-local LRU of file shards, bounded by memory. A shard is
+        dropped when `process_ocr_task` publishes that its file was ingested
+        again, and is fetched again after SHARD_CACHE_TTL seconds in any case.
+    """
+
+    def __init__(self, max_bytes=SHARD_CACHE_MAX_BYTES, ttl=SHARD_CACHE_TTL):
+        self.ttl = ttl
+        self._shards = LocalLRU(max_bytes, sizeof=lambda shard: shard.nbytes)
+        # Only one request per file fetches a missing shard
+        self._fetch_locks = [threading.Lock() for _ in range(64)]
+        self._invalidations = 0
+        self._lock = threading.Lock()
+        self._listener_pid = None
+        self._listener_retry_at = 0
+        # Other per-file caches dropped with the shards
+        self._listeners = []
+
+    @property
+    def enabled(self):
+        return self._shards.max_bytes > 0
+
+    def __len__(self):
+        return len(self._shards)
+
+    @property
+    def nbytes(self):
+        return self._shards.size
+
+    def get(self, index, file_id, namespace="ocr"):
+        """
+            Get the shard of a file, fetching it from the index on a miss.
+
+            :param index: Vector index to fetch missing shards from.
+            :param file_id: ID of the file.
+            :param namespace: Namespace of the vectors.
+            :return: Shard of the file, or None if its vectors cannot be
+                     listed, in which case the file should be searched with
+                     `index.query`.
+        """
+        self.listen()
+        shard = self._fresh(file_id)
+        if shard is not None:
+            return shard
+
+        with self._fetch_locks[hash(file_id) % len(self._fetch_locks)]:
+            shard = self._fresh(file_id)
+            if shard is not None:
+                return shard
+
+            invalidations = self._invalidations
+            try:
+                shard = fetch_shard(index, file_id, namespace)
+            except Exception as e:
+                logger.warning(f"Fetching the shard of {file_id} failed: {e}")
+                return None
+            if not shard.ids:
+                # Pod-based indexes list nothing, as do files whose vector IDs
+                # predate the "{file_id}#" prefix: never cache an empty shard
+                return None
+            logger.info(
+                f"Fetched shard of {file_id} with {len(shard.ids)} vectors"
+            )
+            # Do not cache a shard that may predate an invalidation
+            if invalidations == self._invalidations:
+                self._shards.put(file_id, shard)
+            return shard
+
+    def _fresh(self, file_id):
+        shard = self._shards.get(file_id)
+        if shard is not None and time.monotonic() - shard.loaded_at < self.ttl:
+            return shard
+        return None
+
+    def invalidate(self, file_id):
+        with self._lock:
+            self._invalidations += 1
+        self._shards.pop(file_id)
+        for listener in self._listeners:
+            listener(file_id)
+
+    def clear(self):
+        with self._lock:
+            self._invalidations += 1
+        self._shards.clear()
+        for listener in self._listeners:
+            listener(None)
+
+    def add_listener(self, listener):
+        """
+            Call `listener(file_id)` whenever a file is invalidated, and
+            `listener(None)` when every file is.
+        """
+        self._listeners.append(listener)
+
+    def listen(self):
+        """
+            Start the thread receiving invalidations, once per process.
+        """
+        if (
+            self._listener_pid == os.getpid()
+            or time.monotonic() < self._listener_retry_at
+        ):
+            return
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            try:
+                pubsub = r.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(
+                    **{SHARD_INVALIDATION_CHANNEL: self._on_message}
+                )
+                pubsub.run_in_thread(
+                    sleep_time=1,
+                    daemon=True,
+                    exception_handler=self._on_listener_error,
+                )
+                self._listener_pid = os.getpid()
+            except redis.RedisError as e:
+                # Cached shards still expire after SHARD_CACHE_TTL
+                logger.warning(f"Shard invalidation listener not started: {e}")
+                self._listener_retry_at = (
+                    time.monotonic() + LISTENER_RETRY_DELAY
+                )
+
+    def _on_message(self, message):
+        self.invalidate(message["data"].decode())
+
+    def _on_listener_error(self, error, pubsub, thread):
+        # Invalidations may have been missed while disconnected
+        logger.warning(f"Shard invalidation listener error: {error}")
+        self.clear()
+        time.sleep(1)
+
+
+shard_cache = ShardCache()
+
+
+def publish_invalidation(file_id):
+    """
+        Tell every process to drop its cached shard of a file.
+
+        :param file_id: ID of the file that was ingested again.
+    """
+    try:
+        r.publish(SHARD_INVALIDATION_CHANNEL, file_id)
+    except redis.RedisError as e:
+        logger.warning(f"Shard invalidation of {file_id} not published: {e}")
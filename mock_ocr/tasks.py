@@ -2,17 +2,60 @@
 
 import openai
 import os
-import json
-import time
+import uuid
 import logging
-from celery import shared_task
+from celery import chord, group, shared_task
+from celery.exceptions import Retry
+from celery.result import allow_join_result
 from openai.error import RateLimitError
-from pinecone import Pinecone
+from django.conf import settings
+
+from mock_ocr.chunking import chunk_units, estimate_tokens
+from mock_ocr.ocr_reader import read_ocr_units
+from mock_ocr.embeddings import EMBEDDING_BATCH_SIZE, embed_texts, iter_batches
+from mock_ocr.upserts import VectorUpserter
+from mock_ocr.result_cache import bump_generation
+from mock_ocr.shard_cache import publish_invalidation
+from mock_ocr.file_index import add_file
+from mock_ocr.lexical import Segment, publish_segment, store_segment
+from mock_ocr.jobs import StageTimer, job_status, notify_webhook
+from mock_ocr.documents import (
+    DOCUMENT_INGEST_LEASE,
+    chunk_fingerprint,
+    claim_document,
+    diff_chunks,
+    file_name_from_url,
+    finish_document,
+    get_chunk_fingerprints,
+    hash_stream,
+    release_document,
+    revision_of,
+    store_chunk_fingerprints,
+    upload_hash,
+)
+from mock_ocr.throttle import (
+    OPENAI_MAX_RETRIES,
+    drain_openai_tokens,
+    get_retry_after,
+    reserve_openai_tokens,
+    retry_countdown,
+)
+from tektome_ocr.clients import LazyClient, get_vector_index
+from tektome_ocr.metrics import external_call, observe_ocr_job
 
 
 openai.api_key = os.getenv("OPENAI_API_KEY")
-pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
-index = pc.Index(os.getenv("PINECONE_INDEX"))
+index = LazyClient(get_vector_index)
+
+# Vectors fetched or deleted per index request when a document is ingested
+# again
+VECTOR_FETCH_BATCH_SIZE = 100
+VECTOR_DELETE_BATCH_SIZE = 1000
+
+# Pages of a document embedded and upserted by each ingest subtask: documents
+# with chunks to upsert in several page ranges are spread across the workers.
+# 0 ingests every document in a single task.
+OCR_FANOUT_PAGES = int(os.getenv("OCR_FANOUT_PAGES", 50))
 
 
 # Configure logging
@@ -22,24 +65,376 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-@shared_task(bind=True)
-def process_ocr_task(self, signed_url: str, retries: int):
+@shared_task(bind=True, max_retries=None)
+def process_ocr_task(
+    self, signed_url: str, retries: int = 0, webhook_url: str = None
+):
     """
         Celery task to process OCR, extract text, generate embeddings,
         and upsert them into Pinecone for a given document.
 
+        Rate limits are handled by rescheduling the task through Celery
+        (`self.retry`) rather than sleeping, so the worker slot is released
+        while the OpenAI quota recovers. The task ID is the job ID returned
+        to clients: the current stage is kept in the result backend while
+        the task runs, and the result includes the seconds spent per stage.
+
+        Documents are ingested once per content: a job for a document that
+        is already ingested, or being ingested by another job, returns
+        without doing anything.
+
+        Documents whose changed chunks span several ranges of
+        OCR_FANOUT_PAGES pages are ingested by a Celery chord instead: this
+        task plans the ingestion and is replaced by one `ingest_pages`
+        subtask per page range, run by any worker, and `finish_ingest`,
+        which completes the job under the same ID.
+
         :param self: Task instance for retrying
         :param signed_url: Signed URL of the PDF document
-        :param retries: Number of retry attempts
-        :return: JSON containing status or error message
+        :param retries: Number of retries made after OpenAI rate limit errors
+        :param webhook_url: Optional URL receiving the job status once the task
+                            is done
+        :return: JSON containing status or error message, and stage timings
+    """
+    timer = StageTimer(self)
+    job_id = self.request.id or uuid.uuid4().hex
+
+    content_hash = document_hash(signed_url)
+    claim = None
+    if content_hash is not None:
+        claim = claim_document(
+            content_hash, job_id, get_document_id(signed_url)
+        )
+
+    if claim is not None and claim.state != "claimed":
+        logger.info(
+            f"Skipping {signed_url}, same content as job {claim.job_id}"
+        )
+        result = {
+            "message": "Document already ingested."
+            if claim.state == "done"
+            else "Document is being ingested by another job.",
+            "document_id": claim.document_id,
+            "duplicate_of": claim.job_id,
+        }
+    else:
+        # Rate limit retries keep the document until the job is rescheduled
+        result = run_ocr_pipeline(self, signed_url, retries, timer)
+        if isinstance(result, chord):
+            # The document stays claimed by the job until `finish_ingest`
+            result.body.kwargs.update(
+                content_hash=content_hash, webhook_url=webhook_url
+            )
+            # Eager runs (tests, task_always_eager) wait for the chord in place
+            with allow_join_result():
+                return self.replace(result)
+    return finish_job(
+        self, job_id, result, content_hash, timer.timings, webhook_url
+    )
+
+
+def finish_job(task, job_id, result, content_hash, timings, webhook_url):
+    """
+        Record the outcome of an ingest job, and notify its webhook.
+
+        :param task: Task completing the job, whose ID is the job ID
+        :param result: Result of the job, without its timings
+        :param content_hash: Content hash of the document claimed by the job,
+                             if any
+        :param timings: Seconds spent per stage
+        :return: Result of the job with its timings
+    """
+    if content_hash is not None and "duplicate_of" not in result:
+        # Upsert failures release the document: the previous version of the
+        # document ID is only replaced once every vector is stored
+        if "error" in result:
+            release_document(content_hash, job_id)
+        else:
+            finish_document(
+                content_hash, job_id, result["chunks"], result["document_id"]
+            )
+    result["timings"] = timings
+    observe_ocr_job(result)
+
+    if webhook_url:
+        notify_webhook(
+            webhook_url, job_status(task.request.id, "SUCCESS", result)
+        )
+    return result
+
+
+def get_ocr_json_path(signed_url):
+    # Simulate the OCR process (retrieve JSON from sample file)
+    file_id = file_name_from_url(signed_url).replace(".pdf", "")
+    return file_id, os.path.join(os.getcwd(), "sample_ocr", f"{file_id}.json")
+
+
+def get_document_id(signed_url):
+    # Stable across signed URLs of the same file, which differ by their query
+    # string, and kept by the revisions uploaded to replace the file
+    name = file_name_from_url(signed_url)
+    return revision_of(name) or f"document_{name}"
+
+
+def document_hash(signed_url):
+    """
+        Content hash of the document behind a signed URL: the hash taken when
+        the file was uploaded, otherwise the hash of its current OCR result.
+
+        :return: Hex SHA-256, or None if the OCR result does not exist.
+    """
+    name = file_name_from_url(signed_url)
+    content_hash = upload_hash(name)
+    if content_hash is not None:
+        return content_hash
+
+    _, ocr_json_path = get_ocr_json_path(signed_url)
+    if not os.path.exists(ocr_json_path):
+        return None
+    with open(ocr_json_path, "rb") as f:
+        return hash_stream(f)
+
+
+def fetch_embeddings(index, moved):
+    """
+        Fetch the embeddings of the previous version of a document that new
+        chunks with the same text can reuse.
+
+        :param index: Vector index holding the previous version.
+        :param moved: Dict of previous vector IDs by new vector ID.
+        :return: Dict of embeddings by new vector ID, without the vectors
+                 that were not found.
+    """
+    values = {}
+    for ids in iter_batches(
+        sorted(set(moved.values())), VECTOR_FETCH_BATCH_SIZE
+    ):
+        with external_call("vector_store", "fetch"):
+            response = index.fetch(ids=ids, namespace="ocr")
+        for vector_id, vector in response["vectors"].items():
+            values[vector_id] = vector["values"]
+    return {
+        vector_id: values[previous_id]
+        for vector_id, previous_id in moved.items()
+        if previous_id in values
+    }
+
+
+def chunk_vector_id(document_id, chunk):
+    return f"{document_id}#{chunk['chunk_index']}"
+
+
+def chunk_metadata(document_id, chunk):
+    # Location of the chunk in the document
+    return {
+        "file_id": document_id,
+        "page": chunk["page"],
+        "offset": chunk["offset"],
+        "length": chunk["length"],
+        "text": chunk["text"],
+    }
+
+
+def split_pages(chunks, pages):
+    """
+        Group chunks by ranges of pages, from the page each chunk starts on.
+
+        :param chunks: Chunks of a document.
+        :param pages: Pages per range.
+        :return: List of the chunks of each range, in page order, without
+                 empty ranges.
+    """
+    ranges = {}
+    for chunk in chunks:
+        ranges.setdefault((chunk["page"] - 1) // pages, []).append(chunk)
+    return [ranges[key] for key in sorted(ranges)]
+
+
+def quota_guard(task, args):
+    """
+        :param task: Task embedding the texts
+        :param args: Arguments the task is rescheduled with
+        :return: `before_request` callback of `embed_texts` rescheduling the
+                 task before the shared OpenAI quota is exceeded.
+    """
+
+    def hold_back(texts):
+        wait = reserve_openai_tokens(sum(map(estimate_tokens, texts)))
+        if wait > 0:
+            logger.info(f"OpenAI quota exhausted. Rescheduling in {wait:.1f}s")
+            raise task.retry(args=args, countdown=retry_countdown(0, wait))
+
+    return hold_back
+
+
+def retry_rate_limited(task, error, retries, args):
+    """
+        Reschedule a task after an OpenAI rate limit error, making the other
+        workers back off too.
+
+        :param task: Task that hit the rate limit
+        :param error: RateLimitError raised by OpenAI
+        :param retries: Number of retries already made
+        :param args: Arguments the task is rescheduled with
+        :return: Error result once OPENAI_MAX_RETRIES retries were made.
+    """
+    logger.warning("Rate limit exceeded. Retrying after a delay...")
+    if retries >= OPENAI_MAX_RETRIES:
+        logger.error("Max retries reached. Aborting task.")
+        return {"error": "Max retries reached"}
+
+    retry_after = get_retry_after(error)
+    countdown = retry_countdown(retries, retry_after)
+    drain_openai_tokens(retry_after or countdown)
+
+    logger.info(f"Retrying in {countdown:.1f}s... attempt {retries + 1}")
+    raise task.retry(args=args, countdown=countdown)
+
+
+def embed_and_upsert(
+    document_id, reused, to_embed, timer, before_request=None
+):
+    """
+        Upsert one vector per chunk, reusing the embeddings found in the
+        previous version and embedding the other chunks.
+
+        :param document_id: ID of the document.
+        :param reused: List of (chunk, embedding) of the chunks whose text is
+                       found in the previous version, fetched before any
+                       vector of the new version is upserted.
+        :param to_embed: Chunks to embed.
+        :param timer: StageTimer recording the time spent per stage.
+        :param before_request: Called with the texts of each OpenAI request.
+        :return: Upsert report, with the number of embeddings reused and of
+                 chunks embedded.
+    """
+    logger.info(
+        f"{len(reused)} embeddings reused, {len(to_embed)} chunks to embed "
+        f"for document_id: {document_id}"
+    )
+
+    def to_vector(chunk, embedding):
+        # One vector per chunk, keeping its location in the document
+        return (
+            chunk_vector_id(document_id, chunk),
+            embedding,
+            chunk_metadata(document_id, chunk),
+        )
+
+    # Upserts run on a bounded thread pool while the next chunks are embedded,
+    # the upsert stage only counts the time spent waiting for them
+    with VectorUpserter(index, namespace="ocr") as upserter:
+        with timer.stage("upsert"):
+            upserter.add(
+                to_vector(chunk, embedding) for chunk, embedding in reused
+            )
+
+        for batch in iter_batches(to_embed, EMBEDDING_BATCH_SIZE):
+            texts = [chunk["text"] for chunk in batch]
+
+            # Make one OpenAI API call per batch for the chunks not cached yet
+            with timer.stage("embed"):
+                embeddings = embed_texts(texts, before_request=before_request)
+
+            with timer.stage("upsert"):
+                upserter.add(map(to_vector, batch, embeddings))
+
+        with timer.stage("upsert"):
+            upserter.close()
+
+    return dict(upserter.report, reused=len(reused), recomputed=len(to_embed))
+
+
+def complete_ingest(
+    document_id, report, counts, fingerprints, deleted, save_segment, timer
+):
+    """
+        Make the new version of a document searchable once its vectors are
+        upserted. The vectors and lexical index of the previous version are
+        only replaced when every vector was upserted.
+
+        :param report: Upsert report of the new version.
+        :param counts: Number of chunks, of chunks unchanged since the previous
+                       version and of chunks embedded.
+        :param fingerprints: Fingerprints of the chunks by vector ID.
+        :param deleted: IDs of the vectors the new version no longer has.
+        :param save_segment: Stores the lexical index of the new version.
+        :param timer: StageTimer recording the time spent per stage.
+        :return: Result of the ingestion.
+    """
+    if not report["failed"]:
+        # Drop the chunks the new version no longer has, then remember it
+        with timer.stage("upsert"):
+            for ids in iter_batches(deleted, VECTOR_DELETE_BATCH_SIZE):
+                with external_call("vector_store", "delete"):
+                    index.delete(ids=ids, namespace="ocr")
+        store_chunk_fingerprints(document_id, fingerprints)
+
+        # Every chunk of the new version goes into the lexical index of the
+        # file
+        with timer.stage("upsert"):
+            save_segment()
+
+    # Web processes drop their cached vectors of the document, and the
+    # results cached for the previous version are no longer read
+    publish_invalidation(document_id)
+    bump_generation(document_id)
+
+    if report["upserted"] or counts["unchanged"]:
+        # The document can now be searched
+        add_file(document_id)
+        schedule_index_training()
+
+    if report["failed"]:
+        logger.error(
+            f"{len(report['failed'])} upsert batches failed "
+            f"for document_id: {document_id}"
+        )
+        return {
+            "error": "Failed to upsert some embeddings.",
+            "document_id": document_id,
+            "upserted": report["upserted"],
+            "failed": report["failed"],
+        }
+
+    logger.info(
+        f"{report['upserted']} embeddings upserted into Pinecone index in "
+        f"{report['batches']} batches for document_id: {document_id}"
+    )
+
+    return {
+        "message": "OCR and embedding process completed.",
+        "document_id": document_id,
+        "chunks": counts["chunks"],
+        "reused": counts["chunks"] - counts["recomputed"],
+        "recomputed": counts["recomputed"],
+        "deleted": len(deleted),
+    }
+
+
+def schedule_index_training():
+    # The IVF index of the local vector store is trained by its own task, so
+    # that ingest jobs do not wait on the write lock of the store meanwhile
+    if settings.VECTOR_STORE_BACKEND != "local":
+        return
+    if index.needs_training(namespace="ocr"):
+        train_vector_index.delay("ocr")
+
+
+def run_ocr_pipeline(task, signed_url, retries, timer):
+    """
+        Body of `process_ocr_task`.
+
+        :param task: Task instance for retrying
+        :param timer: StageTimer recording the time spent per stage
+        :return: Result of the ingestion, or the chord ingesting the document
+                 across workers, which the task is replaced with.
     """
     logger.info(
         f"Starting OCR processing task for signed_url: {signed_url} with retries: {retries}"
     )
 
-    # Simulate the OCR process (retrieve JSON from sample file)
-    file_id = signed_url.split("/")[-1].replace(".pdf", "")
-    ocr_json_path = os.path.join(os.getcwd(), "sample_ocr", f"{file_id}.json")
+    file_id, ocr_json_path = get_ocr_json_path(signed_url)
 
     if not os.path.exists(ocr_json_path):
         logger.error(f"OCR file not found for file_id: {file_id}")
@@ -48,49 +443,253 @@ def process_ocr_task(self, signed_url: str, retries: int):
     logger.info(f"OCR file found: {ocr_json_path}")
 
     try:
-        # Read OCR data from the JSON file
-        with open(ocr_json_path, "r") as f:
-            ocr_data = json.load(f)
-
-        # Extract OCR text
-        ocr_text = ocr_data["analyzeResult"]["content"]
-        logger.info(f"OCR text extracted for file_id: {file_id}")
+        # Stream the text of the OCR JSON file, skipping words and polygons
+        with timer.stage("load"):
+            units = list(read_ocr_units(ocr_json_path))
 
-        # Make OpenAI API call for embedding
-        embedding_response = openai.Embedding.create(
-            input=ocr_text, model="text-embedding-ada-002"
+        # Split the OCR result into page-aware chunks
+        with timer.stage("chunk"):
+            chunks = list(chunk_units(units))
+        if not chunks:
+            logger.error(f"OCR result contains no text for file_id: {file_id}")
+            return {"error": "OCR result contains no text."}
+        logger.info(
+            f"Split OCR text into {len(chunks)} chunks for file_id: {file_id}"
         )
 
-        # Handle response
-        embeddings = embedding_response["data"][0]["embedding"]
-        document_id = f"document_{signed_url.split('/')[-1]}"
-        logger.info(f"Generated embeddings for document_id: {document_id}")
+        document_id = get_document_id(signed_url)
 
-        # Upsert the embeddings into the Pinecone index
-        index.upsert(
-            vectors=[(document_id, embeddings, {"file_id": document_id})],
-            namespace="ocr",
-        )
+        # Only chunks whose text is new since the previous version are embedded
+        chunk_by_id = {
+            chunk_vector_id(document_id, chunk): chunk for chunk in chunks
+        }
+        fingerprints = {
+            vector_id: chunk_fingerprint(chunk)
+            for vector_id, chunk in chunk_by_id.items()
+        }
+        diff = diff_chunks(get_chunk_fingerprints(document_id), fingerprints)
+        unchanged = set(diff.unchanged)
+
+        # Every reusable embedding is fetched before any vector is upserted:
+        # the vectors they come from may be overwritten by the new version
+        with timer.stage("embed"):
+            reused_by_id = fetch_embeddings(index, diff.moved)
+        reused = [
+            (chunk_by_id[vector_id], embedding)
+            for vector_id, embedding in reused_by_id.items()
+        ]
+        to_embed = [
+            chunk
+            for vector_id, chunk in chunk_by_id.items()
+            if vector_id not in unchanged and vector_id not in reused_by_id
+        ]
         logger.info(
-            f"Embeddings upserted into Pinecone index for document_id: {document_id}"
+            f"{len(unchanged)} chunks unchanged, {len(reused)} moved, "
+            f"{len(to_embed)} to embed for document_id: {document_id}"
         )
 
-        return {
-            "message": "OCR and embedding process completed.",
-            "document_id": document_id,
-        }
+        def build_segment():
+            return Segment.build(
+                (vector_id, chunk_metadata(document_id, chunk))
+                for vector_id, chunk in chunk_by_id.items()
+            )
+
+        page_ranges = [to_embed]
+        if OCR_FANOUT_PAGES:
+            page_ranges = split_pages(to_embed, OCR_FANOUT_PAGES)
+        if len(page_ranges) > 1 and not task.request.called_directly:
+            logger.info(
+                f"Ingesting {len(page_ranges)} page ranges of document_id: "
+                f"{document_id} in parallel"
+            )
+            # Reused embeddings are upserted here, subtasks only embed new text
+            report = {
+                "upserted": 0,
+                "batches": 0,
+                "failed": [],
+                "recomputed": 0,
+            }
+            if reused:
+                report = embed_and_upsert(document_id, reused, [], timer)
+                task.update_state(
+                    state="PROGRESS",
+                    meta={"stage": "embed", "timings": dict(timer.timings)},
+                )
+            # Kept aside until every subtask is done
+            store_segment(
+                document_id,
+                build_segment(),
+                job_id=task.request.id,
+                ttl=DOCUMENT_INGEST_LEASE,
+            )
+            return chord(
+                group(
+                    ingest_pages.s(document_id, page_range)
+                    for page_range in page_ranges
+                ),
+                finish_ingest.s(
+                    document_id=document_id,
+                    counts={
+                        "chunks": len(chunks),
+                        "unchanged": len(unchanged),
+                    },
+                    fingerprints=fingerprints,
+                    deleted=diff.deleted,
+                    # Already counted in the timings of this task
+                    reused=dict(report, timings={}),
+                    timings=dict(timer.timings),
+                ),
+            )
+
+        report = embed_and_upsert(
+            document_id,
+            reused,
+            to_embed,
+            timer,
+            before_request=quota_guard(task, (signed_url, retries)),
+        )
+        return complete_ingest(
+            document_id,
+            report,
+            {
+                "chunks": len(chunks),
+                "unchanged": len(unchanged),
+                "recomputed": report["recomputed"],
+            },
+            fingerprints,
+            diff.deleted,
+            lambda: store_segment(document_id, build_segment()),
+            timer,
+        )
 
-    except RateLimitError:
-        logger.warning("Rate limit exceeded. Retrying after a delay...")
-        if retries >= 5:
-            logger.error("Max retries reached. Aborting task.")
-            return {"error": "Max retries reached"}
+    except Retry:
+        raise
 
-        retries += 1
-        logger.info(f"Retrying... attempt {retries}")
-        time.sleep(10)
-        return process_ocr_task(self, signed_url, retries)
+    except RateLimitError as e:
+        return retry_rate_limited(task, e, retries, (signed_url, retries + 1))
 
     except Exception as e:
         logger.error(f"An error occurred: {e}")
         return {"error": str(e)}
+
+
+@shared_task(bind=True, max_retries=None)
+def ingest_pages(self, document_id, chunks, retries=0):
+    """
+        Subtask of `process_ocr_task` embedding and upserting the chunks of
+        a range of pages of a document. Rate limits reschedule the subtask
+        alone; other errors fail its chunks without failing the chord.
+
+        :param self: Task instance for retrying
+        :param document_id: ID of the document
+        :param chunks: Chunks of the page range to embed
+        :param retries: Number of retries made after OpenAI rate limit errors
+        :return: Upsert report with the stage timings
+    """
+    timer = StageTimer()
+    args = (document_id, chunks)
+    try:
+        report = embed_and_upsert(
+            document_id,
+            [],
+            chunks,
+            timer,
+            before_request=quota_guard(self, args + (retries,)),
+        )
+    except Retry:
+        raise
+    except Exception as e:
+        if isinstance(e, RateLimitError):
+            error = retry_rate_limited(
+                self, e, retries, args + (retries + 1,)
+            )["error"]
+        else:
+            logger.error(f"An error occurred: {e}")
+            error = str(e)
+        ids = [chunk_vector_id(document_id, chunk) for chunk in chunks]
+        report = {
+            "upserted": 0,
+            "batches": 0,
+            "failed": [{"ids": ids, "error": error}],
+            "recomputed": 0,
+        }
+    report["timings"] = timer.timings
+    return report
+
+
+@shared_task(bind=True)
+def finish_ingest(
+    self,
+    reports,
+    document_id,
+    counts,
+    fingerprints,
+    deleted,
+    reused,
+    timings,
+    content_hash=None,
+    webhook_url=None,
+):
+    """
+        Chord callback of `process_ocr_task`, run under the job ID once the
+        subtasks of every page range are done: make the document searchable
+        and complete the job.
+
+        :param self: Task instance
+        :param reports: Results of the `ingest_pages` subtasks
+        :param document_id: ID of the document
+        :param counts: Number of chunks, and of chunks unchanged since the
+                       previous version
+        :param fingerprints: Fingerprints of the chunks by vector ID
+        :param deleted: IDs of the vectors the new version no longer has
+        :param reused: Upsert report of the reused embeddings, upserted before
+                       the subtasks ran
+        :param timings: Seconds spent per stage before the subtasks ran
+        :param content_hash: Content hash of the document claimed by the job,
+                             if any
+        :param webhook_url: Optional URL receiving the job status
+        :return: JSON containing status or error message, and stage timings
+    """
+    reports = [reused, *reports]
+    # Stage timings add up the time spent by every subtask
+    timer = StageTimer(self)
+    timer.timings = dict(timings)
+    for part in reports:
+        for stage, seconds in part["timings"].items():
+            timer.timings[stage] = round(
+                timer.timings.get(stage, 0.0) + seconds, 3
+            )
+
+    report = {
+        "upserted": sum(part["upserted"] for part in reports),
+        "batches": sum(part["batches"] for part in reports),
+        "failed": [batch for part in reports for batch in part["failed"]],
+    }
+    counts = dict(
+        counts, recomputed=sum(part["recomputed"] for part in reports)
+    )
+    result = complete_ingest(
+        document_id,
+        report,
+        counts,
+        fingerprints,
+        deleted,
+        lambda: publish_segment(document_id, self.request.id),
+        timer,
+    )
+    return finish_job(
+        self, self.request.id, result, content_hash, timer.timings, webhook_url
+    )
+
+
+@shared_task
+def train_vector_index(namespace):
+    """
+        Celery task (re)training the IVF index of a namespace of the local
+        vector store, once it has grown enough since the last training, after
+        compacting the vectors deleted from it.
+
+        :param namespace: Namespace of the vector store.
+        :return: Boolean indicating if the index was trained.
+    """
+    return index.train(namespace=namespace)
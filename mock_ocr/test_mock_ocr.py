@@ -1,52 +1,141 @@
 import pytest
 import json
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, AsyncMock, MagicMock
+from asgiref.sync import async_to_sync
 from django.test import RequestFactory
 from mock_ocr.views import ocr_endpoint
 from mock_ocr.views import extract
 from ninja.errors import HttpError
 
 
+@pytest.fixture(autouse=True)
+def embedding_cache():
+    # Start every test with empty embedding caches
+    from mock_ocr import embeddings
+
+    embeddings.local_cache.clear()
+    with patch("mock_ocr.embeddings.r") as mock_cache_redis:
+        mock_cache_redis.mget.side_effect = lambda keys: [None] * len(keys)
+        yield mock_cache_redis
+
+
+@pytest.fixture(autouse=True)
+def rate_limit_redis():
+    # Allow every request unless a test configures the rate limiter
+    with patch("auth.rate_limit.r") as mock_rate_limit_redis:
+        mock_rate_limit_redis.evalsha.return_value = [1, 0]
+        yield mock_rate_limit_redis
+
+
+@pytest.fixture(autouse=True)
+def shard_cache():
+    # Search Pinecone directly unless a test enables the shard cache
+    from mock_ocr.shard_cache import shard_cache
+
+    shard_cache.clear()
+    with patch("mock_ocr.shard_cache.r") as mock_shard_redis, patch.object(
+        shard_cache._shards, "max_bytes", 0
+    ):
+        yield mock_shard_redis
+
+
+@pytest.fixture(autouse=True)
+def result_cache_redis():
+    # Start every test with an empty result cache
+    with patch("mock_ocr.result_cache.r") as mock_result_redis:
+        mock_result_redis.mget.side_effect = lambda keys: [None] * len(keys)
+        mock_result_redis.set.return_value = True
+        yield mock_result_redis
+
+
+@pytest.fixture(autouse=True)
+def file_index_redis():
+    # Every file has been ingested unless a test says otherwise
+    with patch("mock_ocr.file_index.r") as mock_file_redis:
+        mock_file_redis.smismember.side_effect = lambda key, members: [
+            1
+        ] * len(members)
+        yield mock_file_redis
+
+
+@pytest.fixture(autouse=True)
+def document_registry():
+    # Start every test with an empty document registry
+    import fakeredis
+
+    fake_server = fakeredis.FakeServer()
+    server = fakeredis.FakeStrictRedis(server=fake_server)
+    with patch("mock_ocr.documents.r", server), patch(
+        "mock_ocr.documents.get_redis",
+        lambda: fakeredis.aioredis.FakeRedis(server=fake_server),
+    ):
+        yield server
+
+
+@pytest.fixture(autouse=True)
+def lexical_index():
+    # Files have no lexical index unless a test stores one
+    import fakeredis
+    from mock_ocr.lexical import segment_cache
+
+    segment_cache._segments.clear()
+    server = fakeredis.FakeStrictRedis()
+    with patch("mock_ocr.lexical.r", server):
+        yield server
+
+
+@pytest.fixture(autouse=True)
+def async_redis():
+    # Async clients of the ASGI endpoints, with the same defaults as above
+    client = MagicMock()
+    client.mget = AsyncMock(side_effect=lambda keys: [None] * len(keys))
+    client.set = AsyncMock(return_value=True)
+    client.get = AsyncMock(return_value=None)
+    client.sismember = AsyncMock(return_value=1)
+    client.register_script.return_value = AsyncMock(return_value=[1, 0])
+    client.pipeline.return_value.execute = AsyncMock()
+    with patch("auth.rate_limit.get_redis", return_value=client), patch(
+        "mock_ocr.embeddings.get_redis", return_value=client
+    ), patch("mock_ocr.embeddings.get_http_session"), patch(
+        "mock_ocr.result_cache.get_redis", return_value=client
+    ), patch("mock_ocr.file_index.get_redis", return_value=client):
+        yield client
+
+
 # Test the /ocr endpoint
 @pytest.mark.django_db
-@patch("mock_ocr.views.r")
 @patch("mock_ocr.views.process_ocr_task")
-def test_ocr_endpoint(mock_celery, mock_redis):
-    # Mock the Redis rate-limiting logic
-    mock_redis.exists.return_value = False
-
+def test_ocr_endpoint(mock_celery):
     # Set up the request object
     factory = RequestFactory()
     request = factory.post("/ocr", {"signed_url": "https://dummyurl.com/document.pdf"})
     request.META["REMOTE_ADDR"] = "127.0.0.1"
 
     # Call the OCR endpoint
-    response = ocr_endpoint(request, signed_url="https://dummyurl.com/document.pdf")
+    response = async_to_sync(ocr_endpoint)(
+        request, signed_url="https://dummyurl.com/document.pdf"
+    )
 
     # Verify that the Celery task was called
-    mock_celery.delay.assert_called_once_with("https://dummyurl.com/document.pdf", 0)
+    mock_celery.delay.assert_called_once_with(
+        "https://dummyurl.com/document.pdf", 0, webhook_url=None
+    )
 
     # Assert the correct response
     assert response == {
-        "message": "OCR task submitted successfully. It will be processed asynchronously."
+        "message": "OCR task submitted successfully. "
+        "It will be processed asynchronously.",
+        "job_id": mock_celery.delay.return_value.id,
     }
 
 
 # Test rate limit exceeded
 @pytest.mark.django_db
 @patch(
-    "mock_ocr.views.check_rate_limit"
+    "mock_ocr.views.acheck_rate_limit"
 )  # Make sure to patch this if it's in a different module
-@patch("mock_ocr.views.r")  # Mock Redis
-def test_ocr_rate_limit_exceeded(mock_redis, mock_check_rate_limit):
-    # Mock the Redis to simulate rate limit exceeded
-    mock_redis.exists.return_value = True
-    mock_redis.hgetall.return_value = {
-        b"count": b"5",
-        b"last_request_time": b"1609459200",
-    }
-
-    # Mock check_rate_limit to return False
+def test_ocr_rate_limit_exceeded(mock_check_rate_limit):
+    # Mock acheck_rate_limit to return False
     mock_check_rate_limit.return_value = False
 
     factory = RequestFactory()
@@ -54,7 +143,9 @@ def test_ocr_rate_limit_exceeded(mock_redis, mock_check_rate_limit):
     request.META["REMOTE_ADDR"] = "127.0.0.1"
 
     with pytest.raises(HttpError) as excinfo:
-        ocr_endpoint(request, signed_url="https://dummyurl.com/document.pdf")
+        async_to_sync(ocr_endpoint)(
+            request, signed_url="https://dummyurl.com/document.pdf"
+        )
 
     # Verify the rate limit error
     assert excinfo.value.status_code == 429
@@ -63,13 +154,10 @@ def test_ocr_rate_limit_exceeded(mock_redis, mock_check_rate_limit):
 
 # Test the /extract endpoint
 @pytest.mark.django_db
-@patch("mock_ocr.views.r")
-@patch("mock_ocr.views.openai.Embedding.create")
-@patch("mock_ocr.views.index.query")
-def test_extract_endpoint(mock_pinecone, mock_openai, mock_redis):
-    # Mock Redis cache behavior
-    mock_redis.get.return_value = None  # No cache found
-
+@patch("mock_ocr.embeddings.openai.Embedding.acreate")
+@patch("mock_ocr.views.index")
+def test_extract_endpoint(mock_index, mock_openai, async_redis):
+    mock_pinecone = mock_index.query
     # Mock OpenAI embedding generation
     mock_openai.return_value = {
         "data": [{"embedding": [0.1, 0.2, 0.3]}]  # Dummy embedding
@@ -91,10 +179,14 @@ def test_extract_endpoint(mock_pinecone, mock_openai, mock_redis):
     request = factory.post("/extract", {"query": "abcd", "file_id": "document_dummy"})
 
     # Call the extract endpoint
-    response = extract(request, query="abcd", file_id="document_dummy")
+    response = async_to_sync(extract)(
+        request, query="abcd", file_id="document_dummy", mode="vector"
+    )
 
     # Verify OpenAI embedding was generated
-    mock_openai.assert_called_once_with(input="abcd", model="text-embedding-ada-002")
+    mock_openai.assert_called_once_with(
+        input=["abcd"], model="text-embedding-ada-002"
+    )
 
     # Verify Pinecone was queried
     mock_pinecone.assert_called_once_with(
@@ -116,27 +208,1790 @@ def test_extract_endpoint(mock_pinecone, mock_openai, mock_redis):
             }
         ],
     }
+    assert async_redis.set.call_count == 2  # Lock, then results
 
 
 # Test for cached results
 @pytest.mark.django_db
-@patch("mock_ocr.views.r")
-def test_extract_with_cached_results(mock_redis):
+def test_extract_with_cached_results(async_redis):
+    from mock_ocr.result_cache import encode_results, result_cache_key
+
     # Mock Redis to simulate cached results
-    mock_redis.get.return_value = json.dumps([{"file_id": "document_dummy"}])
+    cached = [
+        {"id": "document_dummy#0", "score": 0.5, "metadata": {"page": 1}}
+    ]
+    async_redis.mget.side_effect = lambda keys: [encode_results(cached)]
 
     # Create a mock request
     factory = RequestFactory()
     request = factory.post("/extract", {"query": "abcd", "file_id": "document_dummy"})
 
     # Call the extract endpoint
-    response = extract(request, query="abcd", file_id="document_dummy")
+    response = async_to_sync(extract)(
+        request, query="abcd", file_id="document_dummy"
+    )
 
-    # Verify the cache was used
-    mock_redis.get.assert_called_once_with("extract:abcd:document_dummy")
+    # Verify the cache was used, with a key shared by query variants
+    key = result_cache_key("abcd", "document_dummy", mode="hybrid")
+    async_redis.mget.assert_called_once_with([key])
+    assert key == result_cache_key("  ABCD\n", "document_dummy", mode="hybrid")
+    assert key != result_cache_key("abcd", "document_other", mode="hybrid")
+    assert key != result_cache_key("abcd", "document_dummy")
 
     # Assert the response contains the cached result
     assert response == {
         "message": "Results retrieved from cache.",
-        "results": [{"file_id": "document_dummy"}],
+        "results": cached,
+    }
+
+
+# Test page-aware chunking of an Azure-style OCR result
+def test_chunk_units_is_page_aware(tmp_path):
+    from mock_ocr.chunking import chunk_units
+    from mock_ocr.ocr_reader import read_ocr_units
+
+    analyze_result = {
+        "content": "aaaa bbbb\ncccc dddd\neeee",
+        "pages": [
+            {
+                "pageNumber": 1,
+                "lines": [
+                    {
+                        "content": "aaaa bbbb",
+                        "spans": [{"offset": 0, "length": 9}],
+                    },
+                    {
+                        "content": "cccc dddd",
+                        "spans": [{"offset": 10, "length": 9}],
+                    },
+                ],
+            },
+            {
+                "pageNumber": 2,
+                "lines": [
+                    {"content": "eeee", "spans": [{"offset": 20, "length": 4}]}
+                ],
+            },
+        ],
+    }
+
+    path = tmp_path / "ocr.json"
+    path.write_text(json.dumps({"analyzeResult": analyze_result}))
+    chunks = list(
+        chunk_units(read_ocr_units(path), max_tokens=3, overlap_tokens=3)
+    )
+
+    assert [
+        (c["page"], c["text"], c["offset"], c["length"]) for c in chunks
+    ] == [
+        (1, "aaaa bbbb", 0, 9),
+        (1, "cccc dddd", 10, 9),
+        (2, "eeee", 20, 4),
+    ]
+    assert [c["chunk_index"] for c in chunks] == [0, 1, 2]
+
+
+# Test that streaming an OCR file yields the units of each layout
+@pytest.mark.parametrize(
+    "analyze_result, units",
+    [
+        (
+            {
+                "content": "ab\ncd",
+                "pages": [
+                    {"pageNumber": 1, "words": [{"polygon": [0.5, 1.5]}]}
+                ],
+                "paragraphs": [
+                    {
+                        "content": "ab",
+                        "boundingRegions": [
+                            {"pageNumber": 1, "polygon": [0.1] * 8}
+                        ],
+                        "spans": [{"offset": 0, "length": 2}],
+                    },
+                    {"content": "cd", "spans": [{"offset": 3, "length": 2}]},
+                ],
+            },
+            [("ab", 1, 0, 2), ("cd", 1, 3, 2)],
+        ),
+        (
+            {
+                "content": "line one\nline two\nspan",
+                "pages": [
+                    {
+                        "pageNumber": 1,
+                        "lines": [
+                            {
+                                "content": "line one",
+                                "spans": [{"offset": 0, "length": 8}],
+                            },
+                            {
+                                "content": "line two",
+                                "spans": [{"offset": 9, "length": 8}],
+                            },
+                        ],
+                    },
+                    {"pageNumber": 2, "spans": [{"offset": 18, "length": 4}]},
+                ],
+            },
+            [("line one", 1, 0, 8), ("line two", 1, 9, 8), ("span", 2, 18, 4)],
+        ),
+        (
+            {"content": "block one\n\nblock two"},
+            [("block one", 1, 0, 9), ("block two", 1, 11, 9)],
+        ),
+    ],
+)
+def test_read_ocr_units_streams_file(analyze_result, units, tmp_path):
+    from mock_ocr.ocr_reader import read_ocr_units
+
+    path = tmp_path / "ocr.json"
+    path.write_text(
+        json.dumps(
+            {"apiVersion": "2023-07-31", "analyzeResult": analyze_result}
+        )
+    )
+
+    assert [
+        (unit["text"], unit["page"], unit["offset"], unit["length"])
+        for unit in read_ocr_units(path)
+    ] == units
+
+
+# Test that the OCR task embeds chunks in batches and upserts one vector per
+# chunk
+def write_sample_ocr(tmp_path, monkeypatch, analyze_result, file_id="dummy"):
+    (tmp_path / "sample_ocr").mkdir(exist_ok=True)
+    (tmp_path / "sample_ocr" / f"{file_id}.json").write_text(
+        json.dumps({"analyzeResult": analyze_result})
+    )
+    monkeypatch.chdir(tmp_path)
+
+
+@patch("mock_ocr.tasks.EMBEDDING_BATCH_SIZE", 2)
+@patch("mock_ocr.tasks.reserve_openai_tokens", return_value=0)
+@patch("mock_ocr.tasks.index")
+@patch("mock_ocr.embeddings.openai.Embedding.create")
+def test_process_ocr_task_embeds_chunks(
+    mock_openai, mock_index, mock_reserve, tmp_path, monkeypatch
+):
+    from mock_ocr.tasks import process_ocr_task
+
+    paragraphs = [
+        {
+            "content": f"paragraph {i}",
+            "boundingRegions": [{"pageNumber": i + 1}],
+            "spans": [{"offset": i * 12, "length": 11}],
+        }
+        for i in range(3)
+    ]
+    write_sample_ocr(
+        tmp_path, monkeypatch, {"content": "", "paragraphs": paragraphs}
+    )
+
+    mock_openai.side_effect = lambda input, model: {
+        "data": [
+            {"index": i, "embedding": [float(i)]} for i in range(len(input))
+        ]
+    }
+
+    result = process_ocr_task("https://dummyurl.com/dummy", 0)
+
+    assert result["chunks"] == 3
+    assert mock_openai.call_count == 2
+    assert mock_openai.call_args_list[0].kwargs["input"] == [
+        "paragraph 0",
+        "paragraph 1",
+    ]
+
+    vectors = [
+        v
+        for c in mock_index.upsert.call_args_list
+        for v in c.kwargs["vectors"]
+    ]
+    assert [v[0] for v in vectors] == [
+        "document_dummy#0",
+        "document_dummy#1",
+        "document_dummy#2",
+    ]
+    assert vectors[2][2]["page"] == 3
+    assert vectors[2][2]["file_id"] == "document_dummy"
+    assert list(result["timings"]) == ["load", "chunk", "embed", "upsert"]
+
+    # The chunks are indexed for lexical search too
+    from mock_ocr.lexical import lexical_search
+
+    matches = lexical_search("Paragraph 2", "document_dummy")
+    assert matches[0]["id"] == "document_dummy#2"
+    assert matches[0]["metadata"] == vectors[2][2]
+
+    # The IVF index of the local vector store is trained by a separate task
+    write_sample_ocr(
+        tmp_path, monkeypatch, {"content": "other"}, file_id="other"
+    )
+    with patch("mock_ocr.tasks.settings.VECTOR_STORE_BACKEND", "local"), patch(
+        "mock_ocr.tasks.train_vector_index"
+    ) as mock_train:
+        process_ocr_task("https://dummyurl.com/other", 0)
+    mock_index.needs_training.assert_called_once_with(namespace="ocr")
+    mock_train.delay.assert_called_once_with("ocr")
+
+
+# Test that jobs report their progress and notify their webhook once done
+@patch("mock_ocr.jobs.socket.getaddrinfo")
+@patch("mock_ocr.jobs.requests.post")
+@patch("mock_ocr.tasks.reserve_openai_tokens", return_value=0)
+@patch("mock_ocr.tasks.index")
+@patch("mock_ocr.embeddings.openai.Embedding.create")
+def test_ocr_job_status_and_webhook(
+    mock_openai,
+    mock_index,
+    mock_reserve,
+    mock_post,
+    mock_getaddrinfo,
+    tmp_path,
+    monkeypatch,
+):
+    from mock_ocr.jobs import get_job, job_status, notify_webhook
+
+    def resolve(host, port, proto):
+        names = {
+            "hooks.test": "93.184.216.34",
+            "metadata.test": "169.254.169.254",
+        }
+        return [(2, 1, 6, "", (names.get(host, host), port or 0))]
+
+    mock_getaddrinfo.side_effect = resolve
+    from mock_ocr.tasks import process_ocr_task
+
+    write_sample_ocr(tmp_path, monkeypatch, {"content": "some text"})
+    mock_openai.return_value = {"data": [{"embedding": [0.1]}]}
+
+    # Stages are published to the result backend as they start
+    states = []
+    with patch.object(
+        process_ocr_task,
+        "update_state",
+        side_effect=lambda state, meta: states.append(meta["stage"]),
+    ):
+        result = process_ocr_task.apply(
+            args=("https://dummyurl.com/dummy", 0),
+            kwargs={"webhook_url": "https://hooks.test/ocr"},
+            task_id="job-1",
+        ).get()
+
+    assert states == ["load", "chunk", "embed", "upsert"]
+    job = mock_post.call_args.kwargs["json"]
+    assert mock_post.call_args.args == ("https://hooks.test/ocr",)
+    assert job["job_id"] == "job-1"
+    assert job["status"] == "completed"
+    assert job["result"]["document_id"] == "document_dummy"
+    assert job["timings"] == result["timings"]
+    assert mock_post.call_args.kwargs["allow_redirects"] is False
+
+    # Webhooks cannot reach internal addresses, even when resolved differently
+    # later
+    mock_post.reset_mock()
+    notify_webhook("http://metadata.test/latest", job)
+    mock_post.assert_not_called()
+    request = RequestFactory().post("/ocr")
+    for webhook_url in [
+        "ftp://hooks.test/ocr",
+        "http://127.0.0.1:8000/admin",
+        "http://10.0.0.7/hook",
+        "http://[::1]/hook",
+        "http://metadata.test/latest",
+    ]:
+        with pytest.raises(HttpError) as excinfo:
+            async_to_sync(ocr_endpoint)(
+                request,
+                signed_url="https://dummyurl.com/dummy",
+                webhook_url=webhook_url,
+            )
+        assert excinfo.value.status_code == 400
+
+    # Only the allowed hosts can be used when an allowlist is configured
+    with patch("mock_ocr.jobs.JOB_WEBHOOK_ALLOWED_HOSTS", {"internal.test"}):
+        notify_webhook("http://internal.test/ocr", job)
+        notify_webhook("https://hooks.test/ocr", job)
+    assert mock_post.call_args.args == ("http://internal.test/ocr",)
+    assert mock_post.call_count == 1
+
+    # Errors returned by the task fail the job
+    assert job_status(
+        "job-2", "SUCCESS", {"error": "OCR file not found."}
+    ) == {
+        "job_id": "job-2",
+        "status": "failed",
+        "timings": {},
+        "result": {"error": "OCR file not found."},
+    }
+    with patch("mock_ocr.jobs.AsyncResult") as mock_result:
+        mock_result.return_value.state = "PROGRESS"
+        mock_result.return_value.info = {
+            "stage": "embed",
+            "timings": {"load": 0.1},
+        }
+        assert get_job("job-3") == {
+            "job_id": "job-3",
+            "status": "running",
+            "stage": "embed",
+            "timings": {"load": 0.1},
+        }
+
+
+# Test that documents are ingested once per content
+@pytest.mark.django_db
+@patch("mock_ocr.views.process_ocr_task")
+@patch("mock_ocr.tasks.reserve_openai_tokens", return_value=0)
+@patch("mock_ocr.tasks.index")
+@patch("mock_ocr.embeddings.openai.Embedding.create")
+def test_ocr_ingestion_is_deduplicated(
+    mock_openai,
+    mock_index,
+    mock_reserve,
+    mock_celery,
+    tmp_path,
+    monkeypatch,
+):
+    from mock_ocr import documents
+    from mock_ocr.tasks import process_ocr_task
+
+    analyze_result = {"content": "some text"}
+    write_sample_ocr(tmp_path, monkeypatch, analyze_result, file_id="first")
+    write_sample_ocr(tmp_path, monkeypatch, analyze_result, file_id="copy")
+    mock_openai.return_value = {"data": [{"embedding": [0.1]}]}
+
+    # A copy being ingested by another job is skipped
+    content_hash = documents.hash_bytes(
+        (tmp_path / "sample_ocr" / "first.json").read_bytes()
+    )
+    claim = documents.claim_document(content_hash, "job-0", "document_first")
+    assert claim.state == "claimed"
+    result = process_ocr_task("https://dummyurl.com/copy?X-Amz-Signature=1", 0)
+    assert result["message"] == "Document is being ingested by another job."
+    assert result["duplicate_of"] == "job-0"
+    mock_openai.assert_not_called()
+
+    # Once ingested, every resubmission of the content reuses its vectors
+    documents.finish_document(content_hash, "job-0", 1, "document_first")
+    for url in ["https://dummyurl.com/first", "https://dummyurl.com/copy"]:
+        result = process_ocr_task(url, 0)
+        assert result["message"] == "Document already ingested."
+        assert result["document_id"] == "document_first"
+    mock_openai.assert_not_called()
+    mock_index.upsert.assert_not_called()
+
+    # A failed ingestion does not block the next submission
+    documents.release_document(content_hash, "job-0")
+    assert process_ocr_task("https://dummyurl.com/copy", 0)["chunks"] == 1
+    claim = documents.claim_document(content_hash, "job-1", "document_other")
+    assert claim == ("done", claim.job_id, "document_copy")
+
+    # The endpoint answers resubmissions of uploaded files without starting a
+    # job
+    documents.register_upload("copy", content_hash)
+    response = async_to_sync(ocr_endpoint)(
+        RequestFactory().post("/ocr"),
+        signed_url="https://dummyurl.com/copy?sig=2",
+    )
+    assert response["message"] == "Document already ingested."
+    assert response["document_id"] == "document_copy"
+    mock_celery.delay.assert_not_called()
+
+
+# Test that documents spanning several page ranges are ingested by a chord of
+# subtasks
+@patch("mock_ocr.tasks.OCR_FANOUT_PAGES", 2)
+@patch("mock_ocr.tasks.reserve_openai_tokens", return_value=0)
+@patch("mock_ocr.tasks.index")
+@patch("mock_ocr.embeddings.openai.Embedding.create")
+def test_ocr_task_fans_out_page_ranges(
+    mock_openai, mock_index, mock_reserve, tmp_path, monkeypatch, lexical_index
+):
+    from unittest.mock import PropertyMock
+    from celery.backends.cache import CacheBackend
+    from mock_ocr.lexical import lexical_search
+    from mock_ocr.tasks import process_ocr_task
+    from tektome_ocr.celery import app
+
+    def ingest(texts):
+        paragraphs = [
+            {
+                "content": text,
+                "boundingRegions": [{"pageNumber": i + 1}],
+                "spans": [{"offset": i * 12, "length": len(text)}],
+            }
+            for i, text in enumerate(texts)
+        ]
+        write_sample_ocr(
+            tmp_path, monkeypatch, {"content": "", "paragraphs": paragraphs}
+        )
+        return process_ocr_task.apply(
+            args=("https://dummyurl.com/dummy", 0), task_id="job-1"
+        ).get()
+
+    mock_openai.side_effect = lambda input, model: {
+        "data": [
+            {"index": i, "embedding": [float(i)]} for i in range(len(input))
+        ]
+    }
+
+    # The chord keeps the results of the subtasks in the result backend
+    backend = CacheBackend(app=app, backend="memory")
+    states = []
+    with patch.object(
+        type(app), "backend", new_callable=PropertyMock, return_value=backend
+    ), patch.object(
+        process_ocr_task,
+        "update_state",
+        side_effect=lambda state, meta: states.append(meta["stage"]),
+    ):
+        result = ingest([f"paragraph {i}" for i in range(5)])
+
+        # Pages 1-2, 3-4 and 5 are embedded by separate subtasks
+        assert states == ["load", "chunk", "embed"]
+        assert [
+            call.kwargs["input"] for call in mock_openai.call_args_list
+        ] == [
+            ["paragraph 0", "paragraph 1"],
+            ["paragraph 2", "paragraph 3"],
+            ["paragraph 4"],
+        ]
+        vectors = [
+            v[0]
+            for c in mock_index.upsert.call_args_list
+            for v in c.kwargs["vectors"]
+        ]
+        assert sorted(vectors) == [f"document_dummy#{i}" for i in range(5)]
+
+        # The callback completes the job with the totals of every subtask
+        assert (result["chunks"], result["reused"], result["recomputed"]) == (
+            5,
+            0,
+            5,
+        )
+        assert list(result["timings"]) == ["load", "chunk", "embed", "upsert"]
+        assert (
+            lexical_search("paragraph 4", "document_dummy")[0]["id"]
+            == "document_dummy#4"
+        )
+        # The published lexical index does not expire like its pending segment
+        assert lexical_index.ttl("bm25:document_dummy") == -1
+        assert lexical_index.keys("bm25:pending:*") == []
+
+        # Pages inserted on pages 1 and 5 shift the chunks after them: their
+        # embeddings are fetched before any vector they come from is
+        # overwritten
+        mock_openai.reset_mock()
+        mock_index.reset_mock()
+        mock_index.fetch.return_value = {
+            "vectors": {
+                f"document_dummy#{i}": {"values": [float(i)]} for i in range(5)
+            }
+        }
+        result = ingest(
+            ["new a", "paragraph 0", "paragraph 1", "paragraph 2", "new b"]
+            + ["paragraph 3", "paragraph 4"]
+        )
+
+    calls = [name for name, _, _ in mock_index.mock_calls]
+    assert calls.count("fetch") == 1
+    assert calls.index("fetch") < calls.index("upsert")
+    assert [call.kwargs["input"] for call in mock_openai.call_args_list] == [
+        ["new a"],
+        ["new b"],
+    ]
+    vectors = {
+        v[0]: v[1]
+        for c in mock_index.upsert.call_args_list
+        for v in c.kwargs["vectors"]
+    }
+    assert vectors["document_dummy#5"] == [3.0]
+    assert vectors["document_dummy#6"] == [4.0]
+    assert (result["chunks"], result["reused"], result["recomputed"]) == (
+        7,
+        5,
+        2,
+    )
+
+
+# Test that a revised document only embeds the chunks whose text changed
+@patch("mock_ocr.tasks.reserve_openai_tokens", return_value=0)
+@patch("mock_ocr.tasks.index")
+@patch("mock_ocr.embeddings.openai.Embedding.create")
+def test_ocr_reingest_is_incremental(
+    mock_openai,
+    mock_index,
+    mock_reserve,
+    tmp_path,
+    monkeypatch,
+    embedding_cache,
+    result_cache_redis,
+):
+    from mock_ocr import embeddings
+    from mock_ocr.result_cache import generation_key
+    from mock_ocr.tasks import process_ocr_task
+
+    def paragraphs(texts):
+        return {
+            "content": "",
+            "paragraphs": [
+                {
+                    "content": text,
+                    "boundingRegions": [{"pageNumber": i + 1}],
+                    "spans": [{"offset": i * 20, "length": len(text)}],
+                }
+                for i, text in enumerate(texts)
+            ],
+        }
+
+    mock_openai.side_effect = lambda input, model: {
+        "data": [
+            {"index": i, "embedding": [float(len(text))]}
+            for i, text in enumerate(input)
+        ]
+    }
+    write_sample_ocr(
+        tmp_path, monkeypatch, paragraphs(["page a", "page b", "page c"])
+    )
+    assert process_ocr_task("https://dummyurl.com/dummy", 0)["recomputed"] == 3
+
+    # Page b is revised and a page is inserted before page c, which moves
+    embeddings.local_cache.clear()
+    mock_openai.reset_mock()
+    mock_index.reset_mock()
+    mock_index.fetch.return_value = {
+        "vectors": {
+            "document_dummy#2": {"id": "document_dummy#2", "values": [6.0]}
+        }
+    }
+    write_sample_ocr(
+        tmp_path,
+        monkeypatch,
+        paragraphs(["page a", "page b revised", "new page", "page c"]),
+    )
+    result = process_ocr_task("https://dummyurl.com/dummy", 0)
+
+    assert (result["chunks"], result["reused"], result["recomputed"]) == (
+        4,
+        2,
+        2,
+    )
+    assert mock_openai.call_args.kwargs["input"] == [
+        "page b revised",
+        "new page",
+    ]
+    mock_index.fetch.assert_called_once_with(
+        ids=["document_dummy#2"], namespace="ocr"
+    )
+    vectors = {
+        v[0]: v
+        for c in mock_index.upsert.call_args_list
+        for v in c.kwargs["vectors"]
+    }
+    assert sorted(vectors) == [
+        "document_dummy#1",
+        "document_dummy#2",
+        "document_dummy#3",
+    ]
+    assert vectors["document_dummy#3"][1:] == (
+        [6.0],
+        {
+            "file_id": "document_dummy",
+            "page": 4,
+            "offset": 60,
+            "length": 6,
+            "text": "page c",
+        },
+    )
+
+    # Removed chunks are deleted from the index
+    write_sample_ocr(tmp_path, monkeypatch, paragraphs(["page a"]))
+    mock_openai.reset_mock()
+    result = process_ocr_task("https://dummyurl.com/dummy", 0)
+    assert (result["reused"], result["recomputed"], result["deleted"]) == (
+        1,
+        0,
+        3,
+    )
+    mock_openai.assert_not_called()
+    mock_index.delete.assert_called_once_with(
+        ids=["document_dummy#1", "document_dummy#2", "document_dummy#3"],
+        namespace="ocr",
+    )
+    # Every ingestion moves the cached results of the file to a new key
+    assert result_cache_redis.incr.call_count == 3
+    result_cache_redis.incr.assert_called_with(
+        generation_key("document_dummy")
+    )
+
+
+# Test that a revision uploaded to replace a document re-ingests that document
+@pytest.mark.django_db
+@patch("mock_ocr.views.process_ocr_task")
+@patch("mock_ocr.tasks.reserve_openai_tokens", return_value=0)
+@patch("mock_ocr.tasks.index")
+@patch("mock_ocr.embeddings.openai.Embedding.create")
+@patch("file_upload.views.generate_signed_url")
+@patch("file_upload.views.default_storage")
+def test_revision_upload_reingests_document(
+    mock_storage,
+    mock_signed_url,
+    mock_openai,
+    mock_index,
+    mock_reserve,
+    mock_celery,
+    tmp_path,
+    monkeypatch,
+    document_registry,
+):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from file_upload.views import upload_file
+    from mock_ocr import documents
+    from mock_ocr.tasks import process_ocr_task
+
+    # The mock OCR result of a stored file is the content of the file
+    def save(name, file):
+        ocr_json = tmp_path / "sample_ocr" / name.replace(".pdf", ".json")
+        ocr_json.write_bytes(file.read())
+        return name
+
+    def upload(texts, replaces=None):
+        paragraphs = [
+            {
+                "content": text,
+                "boundingRegions": [{"pageNumber": i + 1}],
+                "spans": [{"offset": i * 20, "length": len(text)}],
+            }
+            for i, text in enumerate(texts)
+        ]
+        analyze_result = {"content": "", "paragraphs": paragraphs}
+        content = json.dumps({"analyzeResult": analyze_result}).encode()
+        response = async_to_sync(upload_file)(
+            RequestFactory().post("/upload"),
+            files=[SimpleUploadedFile("drawing.pdf", content)],
+            replaces=replaces,
+        )
+        return response["uploaded_files"][0]
+
+    def submit(url):
+        return async_to_sync(ocr_endpoint)(
+            RequestFactory().post("/ocr"), signed_url=url
+        )
+
+    write_sample_ocr(tmp_path, monkeypatch, {"content": ""})
+    mock_storage.save.side_effect = save
+    mock_signed_url.side_effect = (
+        lambda name: f"https://bucket.s3.amazonaws.com/{name}"
+    )
+    # Jobs submitted by the endpoint run in place
+    results = []
+
+    def delay(url, retries, webhook_url):
+        results.append(process_ocr_task(url, retries))
+        return MagicMock(id=f"job-{len(results)}")
+
+    mock_celery.delay.side_effect = delay
+    mock_openai.side_effect = lambda input, model: {
+        "data": [
+            {"index": i, "embedding": [float(len(text))]}
+            for i, text in enumerate(input)
+        ]
     }
+
+    first_url = upload(["page a", "page b"])
+    submit(first_url)
+    document_id = results[0]["document_id"]
+    assert submit(first_url)["document_id"] == document_id
+    first_key = documents.document_key(
+        documents.upload_hash(documents.file_name_from_url(first_url))
+    )
+    # The registry entry leads to the vector IDs of the document
+    chunks = document_registry.hget(first_key, "chunks")
+    assert sorted(document_registry.hkeys(chunks)) == [
+        f"{document_id}#0".encode(),
+        f"{document_id}#1".encode(),
+    ]
+
+    # A revision whose vectors fail to upsert does not replace the document
+    mock_index.fetch.return_value = {"vectors": {}}
+    mock_index.upsert.side_effect = RuntimeError("Pinecone is unavailable")
+    with patch("mock_ocr.upserts.time.sleep"):
+        submit(upload(["page a", "page b failed"], replaces=document_id))
+    assert results[1]["error"] == "Failed to upsert some embeddings."
+    assert document_registry.hget(first_key, "state") == b"done"
+    mock_index.upsert.side_effect = None
+
+    # The revision is stored under a new name and ingested under the same
+    # document ID
+    mock_openai.reset_mock()
+    revision_url = upload(["page a", "page b revised"], replaces=document_id)
+    assert revision_url != first_url
+    assert submit(revision_url)["job_id"] == "job-3"
+    assert results[2]["document_id"] == document_id
+    assert (results[2]["reused"], results[2]["recomputed"]) == (1, 1)
+    assert document_registry.hget(first_key, "state") == b"replaced"
+    assert mock_openai.call_args.kwargs["input"] == ["page b revised"]
+    assert (
+        mock_index.upsert.call_args.kwargs["vectors"][0][0]
+        == f"{document_id}#1"
+    )
+    assert submit(revision_url)["document_id"] == document_id
+    assert mock_celery.delay.call_count == 3
+
+    # Only documents that were ingested can be replaced
+    with pytest.raises(HttpError) as excinfo:
+        upload(["page c"], replaces="document_unknown.pdf")
+    assert excinfo.value.status_code == 404
+
+
+# Test that upserts are batched by count and bytes and failures are reported
+# per batch
+def test_vector_upserter_batches_and_reports_failures():
+    import json
+    from mock_ocr.upserts import VectorUpserter, estimate_vector_bytes
+
+    vectors = [(f"v{i}", [0.5] * 4, {"file_id": "doc"}) for i in range(5)]
+    size = estimate_vector_bytes(vectors[0])
+    # The estimate bounds the serialized size of any values
+    vector = ("v0", [-2.2250738585072014e-308] * 4, {"file_id": "doc"})
+    assert len(json.dumps(vector, separators=(",", ":"))) <= size
+
+    def batch_sizes(**limits):
+        index = MagicMock()
+        with VectorUpserter(index, "ocr", concurrency=1, **limits) as upserter:
+            upserter.add(vectors[:2])
+            upserter.add(vectors[2:])
+        return [
+            len(call.kwargs["vectors"]) for call in index.upsert.call_args_list
+        ]
+
+    assert batch_sizes(max_count=2) == [2, 2, 1]
+    assert batch_sizes(max_count=10, max_bytes=size * 3) == [3, 2]
+
+    index = MagicMock()
+
+    def upsert(vectors, namespace):
+        if vectors[0][0] == "v2":
+            raise RuntimeError("boom")
+
+    index.upsert.side_effect = upsert
+
+    with VectorUpserter(
+        index, "ocr", max_count=2, concurrency=2, retries=0
+    ) as upserter:
+        upserter.add(vectors[:3])
+        upserter.add(vectors[3:])
+
+    assert upserter.report["upserted"] == 3
+    assert upserter.report["batches"] == 3
+    assert upserter.report["failed"] == [
+        {"ids": ["v2", "v3"], "error": "boom"}
+    ]
+
+
+def test_local_vector_store(tmp_path):
+    from mock_ocr.vector_store import LocalVectorStore
+
+    store = LocalVectorStore(str(tmp_path))
+    store.upsert(
+        [
+            ("a#0", [1.0, 0.0, 0.0], {"file_id": "a", "page": 1}),
+            ("a#1", [0.6, 0.8, 0.0], {"file_id": "a", "page": 2}),
+            ("b#0", [1.0, 0.1, 0.0], {"file_id": "b", "page": 1}),
+        ],
+        namespace="ocr",
+    )
+
+    results = store.query(
+        vector=[1.0, 0.0, 0.0], filter={"file_id": "a"}, top_k=5,
+        include_metadata=True, namespace="ocr",
+    )
+    assert [match["id"] for match in results["matches"]] == ["a#0", "a#1"]
+    assert results["matches"][0]["score"] == pytest.approx(1.0)
+    assert results["matches"][1]["metadata"] == {"file_id": "a", "page": 2}
+
+    # A second instance, like another worker process, reads the saved files
+    reader = LocalVectorStore(str(tmp_path))
+    results = reader.query(vector=[1.0, 0.0, 0.0], top_k=2, namespace="ocr")
+    assert [match["id"] for match in results["matches"]] == ["a#0", "b#0"]
+
+    # Deletes only mark the rows in the log, the vectors are not rewritten
+    vectors_file = tmp_path / "ocr.vectors"
+    inode = vectors_file.stat().st_ino
+    store.delete(["a#0"], namespace="ocr")
+    assert vectors_file.stat().st_ino == inode
+    results = reader.query(vector=[1.0, 0.0, 0.0], top_k=5, namespace="ocr")
+    assert [match["id"] for match in results["matches"]] == ["b#0", "a#1"]
+    store.upsert([("b#0", [0.0, 0.0, 1.0], {"file_id": "b"})], namespace="ocr")
+    results = reader.query(
+        vector=[1.0, 0.0, 0.0], filter={"file_id": {"$in": ["a", "b"]}},
+        top_k=5, namespace="ocr",
+    )
+    assert [match["id"] for match in results["matches"]] == ["a#1", "b#0"]
+    assert (
+        reader.query(vector=[1.0, 0.0, 0.0], namespace="other")["matches"]
+        == []
+    )
+
+    # Writers are not blocked while a query scores the rows
+    import threading
+    from mock_ocr.vector_store import _matches_filter
+
+    def matches_filter(metadata, filter):
+        writer = threading.Thread(
+            target=store.upsert, args=([("c#0", [0.0, 1.0, 0.0])], "ocr")
+        )
+        writer.start()
+        writer.join(timeout=5)
+        assert not writer.is_alive()
+        return _matches_filter(metadata, filter)
+
+    with patch("mock_ocr.vector_store._matches_filter", matches_filter):
+        results = store.query(
+            vector=[1.0, 0.0, 0.0], filter={"page": 2}, namespace="ocr"
+        )
+    assert [match["id"] for match in results["matches"]] == ["a#1"]
+
+    # Training compacts the deleted rows out of the files
+    assert not store.train("ocr")
+    assert vectors_file.stat().st_size == 3 * 3 * 4
+    assert list(reader.list(namespace="ocr")) == [["a#1", "b#0", "c#0"]]
+    results = reader.query(vector=[0.0, 1.0, 0.0], top_k=5, namespace="ocr")
+    assert [match["id"] for match in results["matches"]] == [
+        "c#0", "a#1", "b#0"
+    ]
+
+
+def test_local_vector_store_ivf(tmp_path):
+    import numpy as np
+    from mock_ocr.vector_store import LocalVectorStore
+
+    from mock_ocr import vector_store
+
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(401, 8)).astype(np.float32)
+    store = LocalVectorStore(
+        str(tmp_path), nlist=8, nprobe=2, ivf_min_size=200
+    )
+    reader = LocalVectorStore(str(tmp_path), nprobe=8)
+
+    def upsert(start, end):
+        store.upsert(
+            [
+                (f"v{i}", vectors[i].tolist(), {"file_id": f"f{i % 10}"})
+                for i in range(start, end)
+            ],
+            namespace="ocr",
+        )
+
+    for start in range(0, 300, 100):
+        upsert(start, start + 100)
+        # Readers replay the appended part of the log
+        assert reader.query(vectors[0].tolist(), top_k=1, namespace="ocr")[
+            "matches"
+        ]
+
+    # Upserts never train the index, a separate task does
+    assert reader._load("ocr").centroids is None
+    assert store.needs_training(namespace="ocr")
+
+    # Rows upserted while the clustering runs are assigned to lists as well
+    train_centroids = vector_store._train_centroids
+
+    def train_during_upsert(*args):
+        upsert(300, 400)
+        return train_centroids(*args)
+
+    with patch(
+        "mock_ocr.vector_store._train_centroids", train_during_upsert
+    ), patch("mock_ocr.vector_store.IVF_ASSIGN_SCORES", 8 * 16):
+        assert store.train(namespace="ocr")
+    assert not store.needs_training(namespace="ocr")
+
+    # Later upserts are assigned to the existing lists
+    upsert(400, 401)
+    data = reader._load("ocr")
+    assert data.size == 401
+    assert data.trained_size == 400
+    assert len(data.centroids) == 8
+    assert sorted(set(data.assignments)) == list(range(8))
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    assert (
+        data.assignments == np.argmax(normalized @ data.centroids.T, axis=1)
+    ).all()
+
+    query = rng.normal(size=8)
+    exact = [f"v{i}" for i in np.argsort(-(normalized @ query))[:5]]
+
+    # Probing every list is exhaustive, probing fewer lists scores fewer rows
+    results = reader.query(query.tolist(), top_k=5, namespace="ocr")
+    assert [match["id"] for match in results["matches"]] == exact
+    assert len(data.probe(query / np.linalg.norm(query), 2)) < 400
+
+    # Filtered queries only score the rows of the file
+    results = store.query(
+        query.tolist(), top_k=100, filter={"file_id": "f3"}, namespace="ocr"
+    )
+    assert len(results["matches"]) == 40
+    assert all(int(match["id"][1:]) % 10 == 3 for match in results["matches"])
+
+    # Deleted rows are left out of the lists until training compacts them
+    store.delete(exact[:2], namespace="ocr")
+    results = reader.query(query.tolist(), top_k=3, namespace="ocr")
+    assert [match["id"] for match in results["matches"]] == exact[2:5]
+    assert not store.needs_training(namespace="ocr")
+    store.train(namespace="ocr", force=True)
+    assert reader._load("ocr").size == 399
+    results = reader.query(query.tolist(), top_k=3, namespace="ocr")
+    assert [match["id"] for match in results["matches"]] == exact[2:5]
+
+
+# Test that extract scores cached file shards locally until invalidated
+@patch("mock_ocr.views.index")
+def test_shard_cache(mock_index, tmp_path, shard_cache):
+    from mock_ocr.shard_cache import (
+        SHARD_INVALIDATION_CHANNEL,
+        ShardCache,
+        publish_invalidation,
+    )
+    from mock_ocr.vector_store import LocalVectorStore
+    from mock_ocr.views import search_file
+
+    store = LocalVectorStore(str(tmp_path))
+    store.upsert(
+        [
+            ("doc_a#0", [1.0, 0.0], {"file_id": "doc_a", "text": "first"}),
+            ("doc_a#1", [0.0, 1.0], {"file_id": "doc_a", "text": "second"}),
+            ("doc_b#0", [1.0, 0.0], {"file_id": "doc_b", "text": "other"}),
+        ],
+        namespace="ocr",
+    )
+    mock_index.list.side_effect = store.list
+    mock_index.fetch.side_effect = store.fetch
+
+    cache = ShardCache(max_bytes=10**6)
+    with patch("mock_ocr.views.shard_cache", cache):
+        for _ in range(3):
+            matches = search_file([0.0, 2.0], "doc_a")
+            assert [match["id"] for match in matches] == ["doc_a#1", "doc_a#0"]
+            assert matches[0]["score"] == pytest.approx(1.0)
+            assert matches[0]["metadata"]["text"] == "second"
+        assert mock_index.fetch.call_count == 1
+        mock_index.query.assert_not_called()
+        shard_cache.pubsub.return_value.subscribe.assert_called_once()
+
+        # A re-ingested file is fetched again
+        store.upsert(
+            [("doc_a#1", [1.0, 1.0], {"file_id": "doc_a"})], namespace="ocr"
+        )
+        cache._on_message({"data": b"doc_a"})
+        assert search_file([0.0, 1.0], "doc_a")[0]["score"] == pytest.approx(
+            0.7071, 1e-3
+        )
+        assert mock_index.fetch.call_count == 2
+
+        # Files that cannot be listed are searched on the index and not cached
+        mock_index.query.return_value = {
+            "matches": [{"id": "legacy_1", "score": 0.5, "metadata": {}}]
+        }
+        for _ in range(2):
+            assert search_file([0.0, 1.0], "legacy")[0]["id"] == "legacy_1"
+        mock_index.list.side_effect = RuntimeError("list is not supported")
+        assert search_file([0.0, 1.0], "doc_b")[0]["id"] == "legacy_1"
+        assert mock_index.query.call_count == 3
+        assert len(cache) == 1
+
+    # Shards are evicted past the memory bound
+    mock_index.list.side_effect = store.list
+    cache = ShardCache(max_bytes=cache.nbytes + 1)
+    cache.get(mock_index, "doc_a")
+    cache.get(mock_index, "doc_b")
+    assert len(cache) == 1
+
+    publish_invalidation("doc_a")
+    shard_cache.publish.assert_called_once_with(
+        SHARD_INVALIDATION_CHANNEL, "doc_a"
+    )
+
+
+# Test BM25 ranking of exact codes and invalidation of cached segments
+def test_lexical_segment(lexical_index):
+    from mock_ocr.lexical import (
+        Segment,
+        segment_cache,
+        store_segment,
+        lexical_search,
+        tokenize,
+    )
+    from mock_ocr.shard_cache import shard_cache
+
+    assert tokenize("Room A-101, 12.5 m") == [
+        "room", "a-101", "a", "101", "12.5", "12", "5", "m"
+    ]
+
+    texts = [
+        "Door schedule for room A-101 and room A-102",
+        "Window W-101 on the north wall",
+        "General notes about the building",
+        "Room A-101 finishes, room A-101 ceiling",
+    ]
+    segment = Segment.build(
+        (f"doc#{i}", {"file_id": "doc", "text": text})
+        for i, text in enumerate(texts)
+    )
+    matches = segment.search("a-101", top_k=5)
+    assert [match["id"] for match in matches] == ["doc#3", "doc#0", "doc#1"]
+    assert matches[0]["score"] > matches[1]["score"] > matches[2]["score"] > 0
+    assert segment.search("unknown", top_k=5) == []
+    assert (
+        Segment.decode(segment.encode()).search("a-101", top_k=1)
+        == matches[:1]
+    )
+
+    # Segments are cached until the file is ingested again
+    assert lexical_search("a-101", "doc") is None
+    store_segment("doc", segment)
+    assert lexical_search("a-101", "doc", top_k=1)[0]["id"] == "doc#3"
+    store_segment("doc", Segment.build([("doc#0", {"text": "A-101"})]))
+    assert lexical_search("a-101", "doc", top_k=1)[0]["id"] == "doc#3"
+    shard_cache.invalidate("doc")
+    assert lexical_search("a-101", "doc") == [
+        {
+            "id": "doc#0",
+            "score": pytest.approx(0.863, 1e-3),
+            "metadata": {"text": "A-101"},
+        }
+    ]
+    assert len(segment_cache._segments) == 1
+
+
+# Test the retrieval modes of the extract endpoint
+@pytest.mark.django_db
+@patch("mock_ocr.embeddings.openai.Embedding.acreate")
+@patch("mock_ocr.views.index")
+def test_extract_hybrid_and_lexical_modes(
+    mock_index, mock_openai, async_redis
+):
+    from mock_ocr.lexical import Segment, fuse_results, store_segment
+
+    mock_pinecone = mock_index.query
+
+    mock_openai.return_value = {"data": [{"embedding": [0.1, 0.2, 0.3]}]}
+    mock_pinecone.return_value = {
+        "matches": [
+            {
+                "id": f"doc#{i}",
+                "score": 0.9 - i / 10,
+                "metadata": {"text": f"t{i}"},
+            }
+            for i in range(3)
+        ]
+    }
+    request = RequestFactory().post("/extract")
+
+    # Files ingested before the lexical index get their vector matches
+    response = async_to_sync(extract)(request, query="A-101", file_id="doc")
+    assert response["message"] == "Hybrid search completed."
+    assert [match["id"] for match in response["results"]] == [
+        "doc#0",
+        "doc#1",
+        "doc#2",
+    ]
+    assert mock_pinecone.call_args.kwargs["top_k"] == 20
+
+    # Exact codes missed by the vector search are ranked in by fusion
+    store_segment(
+        "doc",
+        Segment.build(
+            [("doc#2", {"text": "t2"}), ("doc#7", {"text": "Room A-101"})]
+        ),
+    )
+    response = async_to_sync(extract)(request, query="A-101", file_id="doc")
+    assert [match["id"] for match in response["results"]] == [
+        "doc#0", "doc#7", "doc#1", "doc#2"
+    ]
+    assert response["results"][1]["score"] == pytest.approx(1 / 61)
+
+    # Lexical search needs no query embedding
+    mock_openai.reset_mock()
+    mock_pinecone.reset_mock()
+    response = async_to_sync(extract)(
+        request, query="a-101", file_id="doc", mode="lexical"
+    )
+    assert response["message"] == "Lexical search completed."
+    assert [match["id"] for match in response["results"]] == ["doc#7"]
+    mock_openai.assert_not_called()
+    mock_pinecone.assert_not_called()
+
+    with pytest.raises(HttpError) as excinfo:
+        async_to_sync(extract)(
+            request, query="a-101", file_id="doc", mode="fuzzy"
+        )
+    assert excinfo.value.status_code == 400
+
+    # The lexical search runs while the query is embedded
+    import asyncio
+    import threading
+    from mock_ocr.views import lexical_search
+
+    started = threading.Event()
+
+    def lexical(*args):
+        started.set()
+        return lexical_search(*args)
+
+    async def embed(**kwargs):
+        assert await asyncio.to_thread(started.wait, 5)
+        raise RuntimeError("OpenAI is unavailable")
+
+    mock_openai.side_effect = embed
+    with patch("mock_ocr.views.lexical_search", lexical):
+        # Hybrid searches fall back to the lexical matches when embedding fails
+        response = async_to_sync(extract)(
+            request, query="room a-101", file_id="doc"
+        )
+        assert response["message"] == "Lexical search completed."
+        assert [match["id"] for match in response["results"]] == ["doc#7"]
+
+        with pytest.raises(RuntimeError):
+            async_to_sync(extract)(
+                request, query="room a-101", file_id="doc", mode="vector"
+            )
+
+    # Matches found by both retrievers rank first
+    fused = fuse_results(
+        [
+            [{"id": "a", "metadata": {}}, {"id": "b", "metadata": {}}],
+            [{"id": "b", "metadata": {}}],
+        ]
+    )
+    assert [match["id"] for match in fused] == ["b", "a"]
+
+
+# Test that OpenAI rate limits reschedule the task honoring Retry-After
+@patch("mock_ocr.tasks.drain_openai_tokens")
+@patch("mock_ocr.tasks.reserve_openai_tokens", return_value=0)
+@patch("mock_ocr.embeddings.openai.Embedding.create")
+def test_process_ocr_task_retries_on_rate_limit(
+    mock_openai, mock_reserve, mock_drain, tmp_path, monkeypatch
+):
+    from celery.exceptions import Retry
+    from openai.error import RateLimitError
+    from mock_ocr.tasks import process_ocr_task
+
+    write_sample_ocr(tmp_path, monkeypatch, {"content": "some text"})
+    mock_openai.side_effect = RateLimitError(
+        "slow down", headers={"Retry-After": "20"}
+    )
+
+    with patch.object(
+        process_ocr_task, "retry", side_effect=Retry()
+    ) as mock_retry:
+        with pytest.raises(Retry):
+            process_ocr_task("https://dummyurl.com/dummy", 2)
+
+    assert mock_retry.call_args.kwargs["args"] == (
+        "https://dummyurl.com/dummy",
+        3,
+    )
+    assert 20 <= mock_retry.call_args.kwargs["countdown"] <= 22
+    mock_drain.assert_called_once_with(20.0)
+
+
+# Test that an exhausted shared quota reschedules the task before calling
+# OpenAI
+@patch("mock_ocr.tasks.reserve_openai_tokens", return_value=5.0)
+@patch("mock_ocr.embeddings.openai.Embedding.create")
+def test_process_ocr_task_waits_for_quota(
+    mock_openai, mock_reserve, tmp_path, monkeypatch
+):
+    from celery.exceptions import Retry
+    from mock_ocr.tasks import process_ocr_task
+
+    write_sample_ocr(tmp_path, monkeypatch, {"content": "some text"})
+
+    with patch.object(
+        process_ocr_task, "retry", side_effect=Retry()
+    ) as mock_retry:
+        with pytest.raises(Retry):
+            process_ocr_task("https://dummyurl.com/dummy", 0)
+
+    mock_openai.assert_not_called()
+    assert mock_retry.call_args.kwargs["args"] == (
+        "https://dummyurl.com/dummy",
+        0,
+    )
+    assert mock_retry.call_args.kwargs["countdown"] >= 5.0
+
+
+# Test that embeddings are served from the local and Redis caches
+@patch("mock_ocr.embeddings.openai.Embedding.create")
+def test_embed_texts_uses_cache(mock_openai, embedding_cache):
+    from mock_ocr import embeddings
+
+    redis_key = embeddings.embedding_cache_key("from redis")
+    redis_blob = embeddings.encode_embedding([0.5, 0.25])
+    embedding_cache.mget.side_effect = lambda keys: [
+        redis_blob if key == redis_key else None for key in keys
+    ]
+    mock_openai.return_value = {
+        "data": [{"index": 0, "embedding": [1.0, 2.0]}]
+    }
+
+    assert embeddings.embed_texts(["new  text", "from redis", "new text"]) == [
+        [1.0, 2.0],
+        [0.5, 0.25],
+        [1.0, 2.0],
+    ]
+    mock_openai.assert_called_once_with(
+        input=["new text"], model="text-embedding-ada-002"
+    )
+    stored_key, stored_blob = embedding_cache.pipeline().set.call_args.args
+    assert stored_key == embeddings.embedding_cache_key("new text")
+    assert stored_blob == embeddings.encode_embedding([1.0, 2.0])
+
+    # Whitespace variants are now served by the in-process cache
+    assert embeddings.embed_texts([" new text "]) == [[1.0, 2.0]]
+    assert mock_openai.call_count == 1
+    assert embeddings.get_embedding_cache_stats()["local_hits"] >= 1
+
+
+# Test that the rate limiter is exact under concurrent requests
+def test_rate_limit_is_exact_under_concurrency(rate_limit_redis, monkeypatch):
+    import fakeredis
+    from concurrent.futures import ThreadPoolExecutor
+    from auth import rate_limit
+
+    fake_server = fakeredis.FakeServer()
+    server = fakeredis.FakeStrictRedis(server=fake_server)
+    monkeypatch.setattr(rate_limit, "r", server)
+    monkeypatch.setenv("RATE_LIMIT_EXTRACT_THRESHOLD", "50")
+    monkeypatch.setenv("RATE_LIMIT_EXTRACT_TIME_WINDOW", "3600")
+
+    def hit(i):
+        # Two IPs share one user, so the user limit is the binding one
+        return rate_limit.check_rate_limit(
+            f"10.0.0.{i % 2}", 7, endpoint="extract"
+        )
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(executor.map(hit, range(200)))
+
+    assert results.count(True) == 50
+
+    # Other users and endpoints have their own limits
+    assert rate_limit.check_rate_limit("10.0.0.9", 8, endpoint="extract")
+    assert rate_limit.check_rate_limit("10.0.0.0", 7, endpoint="ocr")
+
+    # Async endpoints share the same limits, the script is registered once
+    # per client of the event loop
+    clients = []
+
+    def get_redis():
+        if not clients:
+            clients.append(fakeredis.aioredis.FakeRedis(server=fake_server))
+            clients[0].register_script = MagicMock(
+                wraps=clients[0].register_script
+            )
+        return clients[0]
+
+    async def acheck_rate_limits():
+        return [
+            await rate_limit.acheck_rate_limit("10.0.0.9", 7, "extract"),
+            await rate_limit.acheck_rate_limit("10.0.0.9", 9, "extract"),
+        ]
+
+    monkeypatch.setattr(rate_limit, "get_redis", get_redis)
+    assert async_to_sync(acheck_rate_limits)() == [False, True]
+    clients[0].register_script.assert_called_once_with(rate_limit.GCRA_SCRIPT)
+
+
+# Test that concurrent misses compute once and stale results are refreshed
+def test_result_cache_single_flight_and_stale_refresh(monkeypatch):
+    import time
+    import threading
+    import fakeredis
+    from asgiref.sync import async_to_sync
+    from concurrent.futures import ThreadPoolExecutor
+    from mock_ocr import result_cache
+
+    fake_server = fakeredis.FakeServer()
+    server = fakeredis.FakeStrictRedis(server=fake_server)
+    monkeypatch.setattr(result_cache, "r", server)
+    monkeypatch.setattr(
+        result_cache,
+        "get_redis",
+        lambda: fakeredis.aioredis.FakeRedis(server=fake_server),
+    )
+
+    calls = []
+    lock = threading.Lock()
+
+    def compute():
+        with lock:
+            calls.append(1)
+        time.sleep(0.2)
+        return [{"id": "doc#0", "score": 0.9, "metadata": {"page": 1}}]
+
+    async def acompute():
+        return compute()
+
+    key = result_cache.result_cache_key("query 0", "doc")
+    assert key == result_cache.result_cache_key(" Query  0", "doc")
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        responses = list(
+            executor.map(
+                lambda i: result_cache.single_flight(key, compute), range(8)
+            )
+        )
+
+    assert len(calls) == 1
+    assert all(results == compute() for results in responses)
+    calls.clear()
+
+    # Expired results are served stale while one request refreshes them
+    old = time.time() - result_cache.EXTRACT_CACHE_TTL - 1
+    previous = [{"id": "doc#1", "score": 0.1, "metadata": {}}]
+    server.set(key, result_cache.encode_results(previous, stored_at=old))
+    for _ in range(3):
+        assert async_to_sync(result_cache.aget_results)(
+            "query 0", "doc", acompute, compute
+        ) == (previous, True)
+    result_cache.refresh_executor.submit(lambda: None).result()
+    time.sleep(0.3)
+    assert len(calls) == 1
+    assert result_cache.read_results([key])[0] == (compute(), False)
+    assert not server.exists(f"lock:{key}")
+
+
+# Test that unknown files are rejected and empty results are cached briefly
+@pytest.mark.django_db
+@patch("mock_ocr.embeddings.openai.Embedding.acreate")
+@patch("mock_ocr.views.index")
+def test_extract_negative_caching(
+    mock_index, mock_openai, monkeypatch, file_index_redis
+):
+    mock_pinecone = mock_index.query
+    mock_pinecone.return_value = {"matches": []}
+    import fakeredis
+    from mock_ocr import file_index, result_cache
+    from mock_ocr.views import extract_batch, BatchExtractRequest
+
+    # The sync and async clients share one fake server
+    fake_server = fakeredis.FakeServer()
+    server = fakeredis.FakeStrictRedis(server=fake_server)
+    monkeypatch.setattr(file_index, "r", server)
+    monkeypatch.setattr(file_index, "EXTRACT_REQUIRE_INGESTED", True)
+    monkeypatch.setattr(result_cache, "r", server)
+    for module in (file_index, result_cache):
+        monkeypatch.setattr(
+            module,
+            "get_redis",
+            lambda: fakeredis.aioredis.FakeRedis(server=fake_server),
+        )
+    mock_openai.return_value = {"data": [{"embedding": [0.1]}]}
+    request = RequestFactory().post("/extract")
+
+    # Files that were never ingested cost a single set lookup
+    with pytest.raises(HttpError) as excinfo:
+        async_to_sync(extract)(
+            request, query="abcd", file_id="document_unknown"
+        )
+    assert excinfo.value.status_code == 404
+    mock_openai.assert_not_called()
+    mock_pinecone.assert_not_called()
+
+    # Searches without matches are cached with the shorter TTL
+    file_index.add_file("document_empty")
+    for _ in range(3):
+        response = async_to_sync(extract)(
+            request, query="abcd", file_id="document_empty", mode="vector"
+        )
+        assert response == {"message": "No matches found.", "results": []}
+    assert mock_openai.call_count == 1
+    assert mock_pinecone.call_count == 1
+    key = result_cache.result_cache_key("abcd", "document_empty")
+    assert 0 < server.ttl(key) <= result_cache.EXTRACT_CACHE_NEGATIVE_TTL
+
+    # Ingesting the file again invalidates its cached results
+    result_cache.bump_generation("document_empty")
+    async_to_sync(extract)(
+        request, query="abcd", file_id="document_empty", mode="vector"
+    )
+    assert mock_pinecone.call_count == 2
+
+    response = extract_batch(
+        request,
+        BatchExtractRequest(
+            queries=["abcd"],
+            file_ids=["document_empty", "document_unknown"],
+            mode="vector",
+        ),
+    )
+    assert response["results"] == {"abcd": {"document_empty": []}}
+    assert response["missing_file_ids"] == ["document_unknown"]
+    assert mock_pinecone.call_count == 2
+
+
+# Test that the files of vectors ingested before the file index are added
+def test_backfill_file_index(tmp_path, monkeypatch):
+    import fakeredis
+    from mock_ocr import file_index
+    from mock_ocr.vector_store import LocalVectorStore
+
+    server = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(file_index, "r", server)
+    monkeypatch.setattr(file_index, "EXTRACT_REQUIRE_INGESTED", True)
+    store = LocalVectorStore(str(tmp_path))
+    store.upsert(
+        [
+            ("a#0", [1.0, 0.0], {"file_id": "a"}),
+            ("a#1", [0.0, 1.0], {"file_id": "a"}),
+            ("b#c#0", [1.0, 1.0], {"file_id": "b#c"}),
+        ],
+        namespace="ocr",
+    )
+
+    assert file_index.existing_files(["a", "b#c"]) == [False, False]
+    assert file_index.backfill_file_index(store) == 2
+    assert file_index.existing_files(["a", "b#c", "d"]) == [True, True, False]
+
+
+# Test that the rate limit applies to the extract endpoint
+@pytest.mark.django_db
+@patch("mock_ocr.views.acheck_rate_limit", return_value=False)
+def test_extract_rate_limit_exceeded(mock_check_rate_limit):
+    request = RequestFactory().post("/extract")
+    request.META["REMOTE_ADDR"] = "127.0.0.1"
+    request.auth = MagicMock(id=3)
+
+    with pytest.raises(HttpError) as excinfo:
+        async_to_sync(extract)(request, query="abcd", file_id="document_dummy")
+
+    assert excinfo.value.status_code == 429
+    mock_check_rate_limit.assert_called_once_with(
+        "127.0.0.1", 3, endpoint="extract"
+    )
+
+
+# Test the Prometheus metrics of the extract hot path and the /metrics endpoint
+@pytest.mark.django_db
+@patch("mock_ocr.embeddings.openai.Embedding.acreate")
+@patch("mock_ocr.views.index")
+def test_metrics(mock_index, mock_openai, async_redis):
+    from prometheus_client import REGISTRY
+    from mock_ocr.result_cache import encode_results
+    from tektome_ocr.celery import app
+    from tektome_ocr.metrics import metrics_view
+
+    mock_pinecone = mock_index.query
+
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def samples():
+        return {
+            "miss": sample(
+                "cache_requests_total", cache="extract_results", result="miss"
+            ),
+            "hit": sample(
+                "cache_requests_total", cache="extract_results", result="hit"
+            ),
+            "embed": sample(
+                "external_call_seconds_count",
+                service="openai",
+                operation="embed",
+            ),
+            "query": sample(
+                "external_call_seconds_count",
+                service="vector_store",
+                operation="query",
+            ),
+            "rejected": sample(
+                "rate_limit_rejections_total", endpoint="extract"
+            ),
+        }
+
+    before = samples()
+    mock_openai.return_value = {"data": [{"embedding": [0.1, 0.2, 0.3]}]}
+    mock_pinecone.return_value = {"matches": []}
+    request = RequestFactory().post("/extract")
+
+    async_to_sync(extract)(request, query="abcd", file_id="doc", mode="vector")
+    async_redis.mget.side_effect = lambda keys: [encode_results([])] * len(
+        keys
+    )
+    async_to_sync(extract)(request, query="abcd", file_id="doc", mode="vector")
+
+    async_redis.register_script.return_value.return_value = [0, 1000]
+    with pytest.raises(HttpError):
+        async_to_sync(extract)(
+            request, query="abcd", file_id="doc", mode="vector"
+        )
+
+    after = samples()
+    assert {name: after[name] - before[name] for name in after} == {
+        "miss": 1,
+        "hit": 1,
+        "embed": 1,
+        "query": 1,
+        "rejected": 1,
+    }
+
+    # Queue lengths are read from the broker when metrics are scraped
+    with patch.object(app, "connection_for_read") as mock_connection:
+        channel = (
+            mock_connection.return_value.__enter__.return_value.default_channel
+        )
+        channel.queue_declare.return_value = ("celery", 3, 0)
+        response = metrics_view(RequestFactory().get("/metrics"))
+    content = response.content.decode()
+    assert 'celery_queue_length{queue="celery"} 3.0' in content
+    assert (
+        'cache_requests_total{cache="extract_results",result="hit"}' in content
+    )
+    channel.queue_declare.assert_called_once_with(queue="celery", passive=True)
+
+
+# Test that the span of an OCR task continues the trace of the request
+# submitting it
+def test_task_span_continues_request_trace(monkeypatch):
+    pytest.importorskip("opentelemetry.sdk")
+    from types import SimpleNamespace
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import (
+        InMemorySpanExporter,
+    )
+    from tektome_ocr import tracing
+
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    monkeypatch.setattr(tracing, "tracer", provider.get_tracer("test"))
+
+    # The trace context of the request is sent in the task message headers
+    headers = {}
+    with tracing.span("POST mock_ocr/ocr", kind="server"):
+        tracing.inject_task_context(headers=headers)
+    assert "traceparent" in headers
+
+    # The worker runs the task, and its external calls, in the same trace
+    task = SimpleNamespace(
+        name="process_ocr_task", request=SimpleNamespace(**headers)
+    )
+    tracing.start_task_span(task_id="job-1", task=task)
+    with tracing.span("openai.embed"):
+        pass
+    tracing.end_task_span(task_id="job-1", state="SUCCESS")
+
+    request_span, embed_span, task_span = exporter.get_finished_spans()
+    assert task_span.name == "process_ocr_task"
+    assert task_span.context.trace_id == request_span.context.trace_id
+    assert task_span.parent.span_id == request_span.context.span_id
+    assert embed_span.parent.span_id == task_span.context.span_id
+    assert task_span.attributes["celery.state"] == "SUCCESS"
+
+
+# Test the batch extract endpoint
+@pytest.mark.django_db
+@patch("mock_ocr.embeddings.openai.Embedding.create")
+@patch("mock_ocr.views.index")
+def test_extract_batch(mock_index, mock_openai, result_cache_redis):
+    from mock_ocr.lexical import Segment, store_segment
+    from mock_ocr.result_cache import encode_results, result_cache_key
+    from mock_ocr.views import extract_batch, BatchExtractRequest
+
+    mock_pinecone = mock_index.query
+
+    # Only the first query is cached for the first file
+    cached = [{"id": "cached", "score": 1.0, "metadata": {}}]
+    cached_key = result_cache_key("q1", "doc_a", mode="hybrid")
+    result_cache_redis.mget.side_effect = lambda keys: [
+        encode_results(cached) if key == cached_key else None for key in keys
+    ]
+    mock_openai.return_value = {
+        "data": [
+            {"index": 0, "embedding": [1.0]},
+            {"index": 1, "embedding": [2.0]},
+        ]
+    }
+
+    def query(vector, filter, **kwargs):
+        if filter["file_id"] == "doc_b" and vector == [2.0]:
+            return {"matches": []}
+        return {
+            "matches": [
+                {
+                    "id": f"{filter['file_id']}#0",
+                    "score": vector[0],
+                    "metadata": {},
+                }
+            ]
+        }
+
+    mock_pinecone.side_effect = query
+
+    request = RequestFactory().post("/extract_batch")
+    response = extract_batch(
+        request,
+        BatchExtractRequest(queries=["q1", "q2"], file_ids=["doc_a", "doc_b"]),
+    )
+
+    # Both queries needed a search, and were embedded in a single request
+    mock_openai.assert_called_once_with(
+        input=["q1", "q2"], model="text-embedding-ada-002"
+    )
+    assert mock_pinecone.call_count == 3
+    assert mock_pinecone.call_args.kwargs["top_k"] == 20
+    assert response["message"] == "Hybrid search completed."
+
+    assert response["results"] == {
+        "q1": {
+            "doc_a": cached,
+            "doc_b": [{"id": "doc_b#0", "score": 1.0, "metadata": {}}],
+        },
+        "q2": {
+            "doc_a": [{"id": "doc_a#0", "score": 2.0, "metadata": {}}],
+            "doc_b": [],
+        },
+    }
+    # The generations of the files, then the results of every pair, are
+    # looked up in one round trip each, and every search result is stored
+    assert result_cache_redis.mget.call_count == 2
+    stored = [
+        call.args[0]
+        for call in result_cache_redis.set.call_args_list
+        if not call.args[0].startswith("lock:")
+    ]
+    assert sorted(stored) == sorted(
+        [
+            result_cache_key("q1", "doc_b", mode="hybrid"),
+            result_cache_key("q2", "doc_a", mode="hybrid"),
+            result_cache_key("q2", "doc_b", mode="hybrid"),
+        ]
+    )
+
+    # Without the query embeddings, hybrid searches fall back to the lexical
+    # matches of files that have a lexical index, left uncached
+    store_segment("doc_a", Segment.build([("doc_a#5", {"text": "Room q3"})]))
+    mock_openai.side_effect = RuntimeError("OpenAI is unavailable")
+    result_cache_redis.set.reset_mock()
+    response = extract_batch(
+        request, BatchExtractRequest(queries=["q3"], file_ids=["doc_a"])
+    )
+    assert response["message"] == "Lexical search completed."
+    assert [match["id"] for match in response["results"]["q3"]["doc_a"]] == [
+        "doc_a#5"
+    ]
+    assert all(
+        call.args[0].startswith("lock:")
+        for call in result_cache_redis.set.call_args_list
+    )
+    with pytest.raises(RuntimeError):
+        extract_batch(
+            request,
+            BatchExtractRequest(queries=["q3"], file_ids=["doc_a", "doc_b"]),
+        )
+
+    # Lexical searches need no embedding
+    response = extract_batch(
+        request,
+        BatchExtractRequest(
+            queries=["q3"], file_ids=["doc_a", "doc_b"], mode="lexical"
+        ),
+    )
+    assert response["results"]["q3"]["doc_b"] == []
+    assert mock_pinecone.call_count == 3
+
+    with pytest.raises(HttpError) as excinfo:
+        extract_batch(
+            request,
+            BatchExtractRequest(queries=["q3"], file_ids=[], mode="fuzzy"),
+        )
+    assert excinfo.value.status_code == 400
+
+
+# Test that a worker process, from Django setup to the app imported, starts
+# within the cold start budget without building any client or needing the
+# Redis, Pinecone and OpenAI settings
+def test_import_time_budget():
+    import os
+    import subprocess
+    import sys
+
+    script = """
+import sys, time
+start = time.perf_counter()
+import django
+django.setup()
+import auth.jwt_auth
+auth_only = [m for m in sys.modules if m.startswith(("mock_ocr", "openai"))]
+import tektome_ocr.urls, mock_ocr.tasks
+elapsed = (time.perf_counter() - start) * 1000
+from tektome_ocr import clients
+print(elapsed, "pinecone" in sys.modules, "boto3" in sys.modules)
+print(sorted(auth_only))
+print(sorted(clients._clients))
+"""
+    env = {
+        name: value
+        for name, value in os.environ.items()
+        if not name.startswith(("REDIS_", "PINECONE_", "OPENAI_"))
+    }
+    env["DJANGO_SETTINGS_MODULE"] = "tektome_ocr.settings"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    timings = []
+    # Best of three runs, to leave out the noise of other processes
+    for _ in range(3):
+        output = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=root,
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.splitlines()
+        elapsed, pinecone_imported, boto3_imported = output[0].split()
+        assert pinecone_imported == "False"
+        # boto3 is only imported with the first S3 client or storage
+        assert boto3_imported == "False"
+        # The auth app does not depend on the OCR app
+        assert output[1] == "[]"
+        # Only the Redis client is built at import (for its scripts), it
+        # connects on use
+        assert output[2] == "['redis']"
+        timings.append(float(elapsed))
+    assert min(timings) < int(os.getenv("IMPORT_TIME_BUDGET_MS", 1500))
+
+
+# Test that forked workers build their own clients, and lazy clients are built
+# on use
+def test_clients_are_rebuilt_after_fork():
+    import os
+    from tektome_ocr.clients import get_redis_client
+
+    parent_client = get_redis_client()
+    assert get_redis_client() is parent_client
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.write(
+            write_fd, b"1" if get_redis_client() is not parent_client else b"0"
+        )
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.read(read_fd, 1) == b"1"
+
+    # Introspecting a lazy client does not build it
+    import copy
+    from tektome_ocr.clients import LazyClient
+
+    factory = MagicMock()
+    client = LazyClient(factory)
+    assert not hasattr(client, "__func__")
+    copy.copy(client)
+    factory.assert_not_called()
+    assert client.query is factory.return_value.query
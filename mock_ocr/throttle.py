@@ -0,0 +1,139 @@
+import os
+import random
+import logging
+
+import redis
+
+from tektome_ocr.clients import get_redis_client
+
+
+logger = logging.getLogger(__name__)
+
+# Redis shared by all Celery workers for the OpenAI quota
+r = get_redis_client()
+
+# OpenAI embedding quota shared by all workers
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", 1000000))
+OPENAI_QUOTA_KEY = "openai:embedding:tokens"
+
+# Retry parameters for OpenAI rate limit errors
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 5))
+OPENAI_RETRY_BACKOFF = float(os.getenv("OPENAI_RETRY_BACKOFF", 2))
+OPENAI_RETRY_BACKOFF_MAX = float(os.getenv("OPENAI_RETRY_BACKOFF_MAX", 300))
+
+# Token bucket refilled continuously at `rate` tokens per second.
+# Returns the number of seconds to wait before `requested` tokens are
+# available, or "0" when they were taken from the bucket.
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local requested = math.min(tonumber(ARGV[3]), capacity)
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+# Drains the bucket so every worker holds back for ARGV[1] seconds
+DRAIN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local seconds = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+redis.call('HSET', KEYS[1],
+    'tokens', tostring(-seconds * rate), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(seconds) + 60)
+return 1
+"""
+
+
+def reserve_openai_tokens(tokens):
+    """
+        Take tokens from the OpenAI quota shared by all workers.
+
+        :param tokens: Number of tokens the next request will consume.
+        :return: Seconds to wait before retrying, 0 if the tokens were
+                 reserved.
+    """
+    rate = OPENAI_TOKENS_PER_MINUTE / 60
+    try:
+        wait = r.eval(
+            TOKEN_BUCKET_SCRIPT,
+            1,
+            OPENAI_QUOTA_KEY,
+            OPENAI_TOKENS_PER_MINUTE,
+            rate,
+            tokens,
+        )
+        return float(wait)
+    except redis.RedisError as e:
+        # Never block ingestion because the quota store is unavailable
+        logger.warning(f"OpenAI quota check skipped: {e}")
+        return 0.0
+
+
+def drain_openai_tokens(seconds):
+    """
+        Empty the shared OpenAI quota after a rate limit error, so that other
+        workers hold back instead of hitting the same limit.
+
+        :param seconds: Number of seconds the quota should stay exhausted.
+    """
+    try:
+        r.eval(
+            DRAIN_BUCKET_SCRIPT,
+            1,
+            OPENAI_QUOTA_KEY,
+            OPENAI_TOKENS_PER_MINUTE / 60,
+            seconds,
+        )
+    except redis.RedisError as e:
+        logger.warning(f"OpenAI quota drain skipped: {e}")
+
+
+def get_retry_after(error):
+    """
+        Read the Retry-After header of an OpenAI error, if any.
+
+        :param error: Exception raised by the OpenAI client.
+        :return: Delay in seconds requested by the API, or None.
+    """
+    headers = getattr(error, "headers", None) or {}
+    for name, value in headers.items():
+        if name.lower() == "retry-after":
+            try:
+                return max(0.0, float(value))
+            except (TypeError, ValueError):
+                return None
+    return None
+
+
+def retry_countdown(retries, retry_after=None):
+    """
+        Compute the delay before the next retry using jittered exponential
+        backoff, or the server-provided Retry-After plus a small jitter.
+
+        :param retries: Number of retries already made.
+        :param retry_after: Delay requested by the API, if any.
+        :return: Delay in seconds.
+    """
+    if retry_after is not None:
+        return retry_after + random.uniform(0, max(1.0, retry_after * 0.1))
+    return random.uniform(
+        OPENAI_RETRY_BACKOFF,
+        min(OPENAI_RETRY_BACKOFF_MAX, OPENAI_RETRY_BACKOFF * 2**retries),
+    )
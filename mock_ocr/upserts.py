@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from tektome_ocr.metrics import external_call
+
+logger = logging.getLogger(__name__)
+
+# Upsert batching parameters (Pinecone rejects requests larger than 2 MB)
+PINECONE_UPSERT_BATCH_SIZE = int(os.getenv("PINECONE_UPSERT_BATCH_SIZE", 100))
+PINECONE_UPSERT_MAX_BYTES = int(
+    os.getenv("PINECONE_UPSERT_MAX_BYTES", 2 * 1000 * 1000)
+)
+PINECONE_UPSERT_CONCURRENCY = int(os.getenv("PINECONE_UPSERT_CONCURRENCY", 4))
+PINECONE_UPSERT_RETRIES = int(os.getenv("PINECONE_UPSERT_RETRIES", 3))
+
+# Base delay in seconds between retries of a failed batch
+UPSERT_RETRY_DELAY = 0.5
+
+# Longest JSON float (e.g. -2.2250738585072014e-308) and its separator, and
+# the brackets and separators around the values of a vector
+FLOAT_JSON_BYTES = 25
+VECTOR_JSON_OVERHEAD = 4
+
+
+def estimate_vector_bytes(vector):
+    """
+        Estimate the request payload size of a single (id, values, metadata)
+        vector without serializing its values: each value counts as the
+        longest JSON float, only the id and metadata are serialized.
+
+        :param vector: Vector tuple as accepted by `index.upsert`.
+        :return: Upper bound of the size in bytes.
+    """
+    vector_id, values, *metadata = vector
+    return (
+        len(values) * FLOAT_JSON_BYTES
+        + len(json.dumps([vector_id, *metadata], separators=(",", ":")))
+        + VECTOR_JSON_OVERHEAD
+    )
+
+
+def upsert_batch(index, batch, namespace, retries=PINECONE_UPSERT_RETRIES):
+    """
+        Upsert a single batch, retrying with exponential backoff on failure.
+
+        :param index: Pinecone index to write to.
+        :param batch: List of vector tuples.
+        :param namespace: Pinecone namespace.
+        :param retries: Number of retries after the first attempt.
+    """
+    for attempt in range(retries + 1):
+        try:
+            with external_call("vector_store", "upsert"):
+                index.upsert(vectors=batch, namespace=namespace)
+            return
+        except Exception as e:
+            if attempt >= retries:
+                raise
+            delay = UPSERT_RETRY_DELAY * 2**attempt
+            logger.warning(
+                f"Upsert of {len(batch)} vectors failed ({e}). "
+                f"Retrying in {delay}s..."
+            )
+            time.sleep(delay)
+
+
+class VectorUpserter:
+    """
+        Pipelined upsert stage. Vectors added with `add` are grouped into
+        size-bounded batches which are sent to the index on a bounded thread
+        pool while the caller keeps producing more vectors.
+
+        Usage:
+            with VectorUpserter(index, namespace="ocr") as upserter:
+                upserter.add(vectors)
+            report = upserter.report
+    """
+
+    def __init__(
+        self,
+        index,
+        namespace,
+        max_count=PINECONE_UPSERT_BATCH_SIZE,
+        max_bytes=PINECONE_UPSERT_MAX_BYTES,
+        concurrency=PINECONE_UPSERT_CONCURRENCY,
+        retries=PINECONE_UPSERT_RETRIES,
+    ):
+        self.index = index
+        self.namespace = namespace
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.retries = retries
+        self.report = {"upserted": 0, "batches": 0, "failed": []}
+
+        # Vectors of the next batch, and their estimated payload size
+        self._pending = []
+        self._pending_bytes = 0
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+        # Bound the number of batches queued or in flight to keep memory flat
+        self._slots = threading.BoundedSemaphore(concurrency * 2)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def add(self, vectors):
+        """
+            Queue vectors for upserting, submitting every batch that is full.
+            The last, possibly incomplete, batch waits for the next call.
+
+            :param vectors: Iterable of vector tuples.
+        """
+        for vector in vectors:
+            vector_bytes = estimate_vector_bytes(vector)
+            if self._pending and (
+                len(self._pending) >= self.max_count
+                or self._pending_bytes + vector_bytes > self.max_bytes
+            ):
+                self._submit(self._pending)
+                self._pending = []
+                self._pending_bytes = 0
+            self._pending.append(vector)
+            self._pending_bytes += vector_bytes
+
+    def close(self):
+        """
+            Flush remaining vectors and wait for all in-flight batches.
+
+            :return: Report with upserted vector count, batch count and failed
+                     batches.
+        """
+        if self._pending:
+            self._submit(self._pending)
+            self._pending = []
+            self._pending_bytes = 0
+        self._executor.shutdown(wait=True)
+        return self.report
+
+    def _submit(self, batch):
+        self._slots.acquire()
+        future = self._executor.submit(
+            upsert_batch, self.index, batch, self.namespace, self.retries
+        )
+        future.add_done_callback(lambda f: self._done(f, batch))
+
+    def _done(self, future, batch):
+        with self._lock:
+            self.report["batches"] += 1
+            error = future.exception()
+            if error is None:
+                self.report["upserted"] += len(batch)
+            else:
+                logger.error(f"Upsert of {len(batch)} vectors failed: {error}")
+                self.report["failed"].append(
+                    {
+                        "ids": [vector[0] for vector in batch],
+                        "error": str(error),
+                    }
+                )
+        self._slots.release()
@@ -0,0 +1,791 @@
+import os
+import json
+import fcntl
+import logging
+import threading
+from functools import lru_cache
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+# IVF (inverted file) index parameters of the local vector store. Namespaces
+# smaller than VECTOR_STORE_IVF_MIN_SIZE are searched exhaustively; larger ones
+# are clustered into VECTOR_STORE_NLIST lists (0 picks 4 * sqrt(size)) and a
+# query scans the VECTOR_STORE_NPROBE lists closest to it.
+VECTOR_STORE_IVF_MIN_SIZE = int(os.getenv("VECTOR_STORE_IVF_MIN_SIZE", 10000))
+VECTOR_STORE_NLIST = int(os.getenv("VECTOR_STORE_NLIST", 0))
+VECTOR_STORE_NPROBE = int(os.getenv("VECTOR_STORE_NPROBE", 8))
+
+# Retrain the clustering once a namespace has grown this much since training
+IVF_RETRAIN_GROWTH = 4
+# Training rows sampled per list, at most IVF_TRAIN_MAX_SAMPLES in total, and
+# k-means iterations
+IVF_TRAIN_SAMPLES_PER_LIST = 64
+IVF_TRAIN_MAX_SAMPLES = 65536
+IVF_TRAIN_ITERATIONS = 10
+# Scores computed per matrix product when assigning rows to lists, to bound
+# temporary memory (64 MB)
+IVF_ASSIGN_SCORES = 1 << 24
+# Rows copied at a time when a namespace is compacted
+COMPACT_ROWS = 65536
+
+
+def _matches_filter(metadata, filter):
+    """
+        Check metadata against a Pinecone-style filter. Supports equality,
+        `$eq`, `$ne` and `$in` conditions combined with an implicit AND.
+    """
+    for field, condition in (filter or {}).items():
+        value = metadata.get(field)
+        if isinstance(condition, dict):
+            if "$eq" in condition and value != condition["$eq"]:
+                return False
+            if "$ne" in condition and value == condition["$ne"]:
+                return False
+            if "$in" in condition and value not in condition["$in"]:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _assign(vectors, centroids):
+    """
+        Get the IVF list of each vector: the closest centroid, computed a
+        chunk of rows at a time.
+    """
+    chunk = max(1, IVF_ASSIGN_SCORES // len(centroids))
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), chunk):
+        scores = vectors[start:start + chunk] @ centroids.T
+        assignments[start:start + chunk] = np.argmax(scores, axis=1)
+    return assignments
+
+
+def _train_centroids(vectors, nlist, iterations=IVF_TRAIN_ITERATIONS, seed=0):
+    """
+        Cluster vectors into `nlist` lists with spherical k-means on a sample
+        of the rows.
+
+        :return: The centroids of the lists.
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = min(
+        nlist * IVF_TRAIN_SAMPLES_PER_LIST, IVF_TRAIN_MAX_SAMPLES
+    )
+    sample_size = min(len(vectors), max(nlist, sample_size))
+    sample = vectors[
+        np.sort(rng.choice(len(vectors), sample_size, replace=False))
+    ]
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)]
+
+    for _ in range(iterations):
+        labels = _assign(sample, centroids)
+        counts = np.bincount(labels, minlength=nlist)
+        # Lists left empty keep their previous centroid
+        nonempty = np.flatnonzero(counts)
+        starts = (np.cumsum(counts) - counts)[nonempty]
+        sums = np.add.reduceat(
+            sample[np.argsort(labels, kind="stable")], starts
+        )
+        centroids = centroids.copy()
+        centroids[nonempty] = _normalize(sums)
+    return centroids
+
+
+class Namespace:
+    """
+        Vectors of a single namespace: a memory-mapped float32 matrix of
+        L2-normalized rows, their ids and metadata, and an index of rows per
+        file_id. The rows of deleted vectors stay in the matrix, with None as
+        id and metadata, until the namespace is compacted.
+
+        Once trained, `centroids` holds the IVF cluster centres and
+        `assignments` the list of every row.
+    """
+
+    def __init__(self):
+        self.vectors = None
+        self.ids = []
+        self.metadata = []
+        self.rows = {}
+        self.file_rows = {}
+        self.deleted = set()
+        self.centroids = None
+        self.assignments = None
+        self.trained_size = 0
+        self._lists = None
+        self._deleted_rows = None
+
+    @property
+    def size(self):
+        return len(self.ids)
+
+    def _set(self, row, vector_id, metadata):
+        if row < len(self.ids) and row not in self.deleted:
+            self.file_rows[self.metadata[row].get("file_id")].remove(row)
+        if vector_id is None:
+            # Tombstone of a deleted vector
+            del self.rows[self.ids[row]]
+            self.ids[row] = None
+            self.metadata[row] = None
+            self.deleted.add(row)
+            self._deleted_rows = None
+            self._lists = None
+            return
+        if row == len(self.ids):
+            self.ids.append(vector_id)
+            self.metadata.append(metadata)
+            self.rows[vector_id] = row
+        else:
+            self.metadata[row] = metadata
+        self.file_rows.setdefault(metadata.get("file_id"), []).append(row)
+
+    def replay(self, entries):
+        """
+            Apply (row, id, metadata) entries read from the namespace log.
+        """
+        for row, vector_id, metadata in entries:
+            self._set(row, vector_id, metadata)
+
+    def upsert(self, vectors):
+        """
+            Give each (id, values, metadata) vector a row, reusing the row of
+            an existing id.
+
+            :return: List of (row, id, metadata) log entries.
+        """
+        entries = []
+        for vector_id, values, metadata in vectors:
+            row = self.rows.get(vector_id, len(self.ids))
+            self._set(row, vector_id, metadata)
+            entries.append((row, vector_id, metadata))
+        return entries
+
+    def delete(self, ids):
+        """
+            Mark vectors as deleted by id, keeping their rows.
+
+            :return: List of (row, None, None) log entries.
+        """
+        entries = []
+        for vector_id in ids:
+            row = self.rows.get(vector_id)
+            if row is not None:
+                self._set(row, None, None)
+                entries.append((row, None, None))
+        return entries
+
+    def deleted_rows(self):
+        """
+            Get the rows of deleted vectors, sorted.
+        """
+        if self._deleted_rows is None:
+            self._deleted_rows = np.array(sorted(self.deleted), dtype=np.int64)
+        return self._deleted_rows
+
+    def needs_compaction(self):
+        """
+            Check if at least half the rows belong to deleted vectors.
+        """
+        return bool(self.deleted) and 2 * len(self.deleted) >= self.size
+
+    def compact(self):
+        """
+            Drop the rows of deleted vectors, renumbering the remaining rows.
+
+            :return: The previous rows that are kept.
+        """
+        kept = np.array(
+            [row for row in range(self.size) if row not in self.deleted],
+            dtype=np.int64,
+        )
+        ids = [self.ids[row] for row in kept]
+        metadata = [self.metadata[row] for row in kept]
+        self.__init__()
+        self.replay(zip(range(len(ids)), ids, metadata))
+        return kept
+
+    def assign(self, vectors):
+        """
+            Get the IVF list of each vector: the closest centroid.
+        """
+        return _assign(vectors, self.centroids)
+
+    def needs_training(self, min_size=VECTOR_STORE_IVF_MIN_SIZE):
+        """
+            Check if the IVF index should be trained: once the namespace is
+            large enough, then when it has grown IVF_RETRAIN_GROWTH times
+            since the last training.
+        """
+        if self.size < max(min_size, 1):
+            return False
+        if self.centroids is None:
+            return True
+        return self.size >= self.trained_size * IVF_RETRAIN_GROWTH
+
+    def lists(self):
+        """
+            Get the rows of every IVF list, in row order, leaving out the
+            rows of deleted vectors.
+        """
+        if self._lists is None:
+            rows = np.setdiff1d(
+                np.arange(self.size), self.deleted_rows(), assume_unique=True
+            )
+            assignments = self.assignments[rows]
+            order = rows[np.argsort(assignments, kind="stable")]
+            counts = np.bincount(assignments, minlength=len(self.centroids))
+            self._lists = np.split(order, np.cumsum(counts)[:-1])
+        return self._lists
+
+    def probe(self, query, nprobe):
+        """
+            Get the rows of the `nprobe` IVF lists closest to the query.
+        """
+        lists = self.lists()
+        nprobe = max(1, min(nprobe, len(lists)))
+        nearest = np.argpartition(-(self.centroids @ query), nprobe - 1)[
+            :nprobe
+        ]
+        # Sorted rows read the memory-mapped matrix sequentially
+        return np.sort(np.concatenate([lists[i] for i in nearest]))
+
+    def prefilter(self, filter):
+        """
+            Narrow the rows to search using the file_id index.
+
+            :return: Tuple of (candidate rows, or None when the filter has no
+                     indexed file_id condition, remaining filter conditions).
+        """
+        filter = dict(filter or {})
+        condition = filter.pop("file_id", None)
+        if condition is None:
+            return None, filter
+        if not isinstance(condition, dict):
+            rows = self.file_rows.get(condition, [])
+        elif set(condition) == {"$eq"}:
+            rows = self.file_rows.get(condition["$eq"], [])
+        elif set(condition) == {"$in"}:
+            rows = [
+                row
+                for file_id in condition["$in"]
+                for row in self.file_rows.get(file_id, [])
+            ]
+        else:
+            filter["file_id"] = condition
+            return None, filter
+        return np.sort(np.asarray(rows, dtype=np.int64)), filter
+
+
+class LocalVectorStore:
+    """
+        In-process vector index with the same `upsert`/`query`/`delete`
+        interface as a Pinecone index, persisted under `path` and shared by
+        worker processes.
+
+        Each namespace is stored as:
+            {namespace}.vectors    float32 rows, memory-mapped by readers
+            {namespace}.log        JSON lines of (row, id, metadata)
+            {namespace}.centroids.npy, {namespace}.lists
+                                   IVF centroids and the list of every row
+            {namespace}.json       manifest, written last on every change
+
+        Upserts append to the files in place, so readers only replay the new
+        part of the log. Deletes only append tombstones to the log: queries
+        skip the rows of deleted vectors until `train` compacts the namespace
+        into new files, a slice of rows at a time.
+
+        Small namespaces are searched exhaustively. Larger ones are clustered
+        into IVF lists by `train` and a query only scores the `nprobe` lists
+        closest to it, trading recall for latency. Queries filtered by file_id
+        only score the rows of those files. Queries only hold the lock of the
+        store while catching up with the files, not while scoring.
+    """
+
+    def __init__(
+        self,
+        path,
+        nlist=VECTOR_STORE_NLIST,
+        nprobe=VECTOR_STORE_NPROBE,
+        ivf_min_size=VECTOR_STORE_IVF_MIN_SIZE,
+    ):
+        self.path = path
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.ivf_min_size = ivf_min_size
+        self._namespaces = {}
+        self._manifests = {}
+        self._versions = {}
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, namespace, suffix):
+        return os.path.join(self.path, f"{namespace or 'default'}.{suffix}")
+
+    def _version(self, namespace):
+        # Every change replaces the manifest, giving it a new inode
+        try:
+            stat = os.stat(self._file(namespace, "json"))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _lock_file(self):
+        return open(os.path.join(self.path, ".lock"), "w")
+
+    def _read_log(self, namespace, start, end):
+        with open(self._file(namespace, "log"), "rb") as f:
+            f.seek(start)
+            lines = f.read(end - start).splitlines()
+        return [json.loads(line) for line in lines]
+
+    def _attach(self, namespace, data, manifest):
+        # Map the arrays of the manifest, the files may hold unlisted rows
+        size, dimension = manifest["size"], manifest["dimension"]
+        data.vectors = None
+        data.centroids = None
+        data.assignments = None
+        data.trained_size = manifest["trained_size"]
+        data._lists = None
+        if size:
+            data.vectors = np.memmap(
+                self._file(namespace, "vectors"),
+                np.float32,
+                "r",
+                shape=(size, dimension),
+            )
+        if size and data.trained_size:
+            data.centroids = np.load(
+                self._file(namespace, "centroids.npy"), mmap_mode="r"
+            )
+            data.assignments = np.memmap(
+                self._file(namespace, "lists"), np.int32, "r", shape=(size,)
+            )
+
+    def _load(self, namespace, locked=False):
+        """
+            Get a namespace, catching up with the changes made by other
+            processes since it was last read.
+        """
+        version = self._version(namespace)
+        if (
+            namespace in self._namespaces
+            and self._versions.get(namespace) == version
+        ):
+            return self._namespaces[namespace]
+
+        if not locked:
+            # Do not read the files while a writer is changing them
+            with self._lock_file() as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_SH)
+                return self._load(namespace, locked=True)
+
+        version = self._version(namespace)
+        manifest = {
+            "generation": 0,
+            "dimension": 0,
+            "size": 0,
+            "trained_size": 0,
+            "log_bytes": 0,
+        }
+        if version is not None:
+            with open(self._file(namespace, "json")) as f:
+                manifest = json.load(f)
+
+        data = self._namespaces.get(namespace)
+        previous = self._manifests.get(namespace)
+        if (
+            data is None
+            or previous is None
+            or previous["generation"] != manifest["generation"]
+        ):
+            data = Namespace()
+            previous = None
+        start = previous["log_bytes"] if previous else 0
+        if manifest["log_bytes"] > start:
+            data.replay(
+                self._read_log(namespace, start, manifest["log_bytes"])
+            )
+        self._attach(namespace, data, manifest)
+
+        self._namespaces[namespace] = data
+        self._manifests[namespace] = manifest
+        self._versions[namespace] = version
+        return data
+
+    @contextmanager
+    def _writing(self, namespace):
+        # Serialize writers across threads and worker processes
+        with self._lock, self._lock_file() as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            data = self._load(namespace, locked=True)
+            manifest = dict(self._manifests[namespace])
+            try:
+                yield data, manifest
+            except Exception:
+                # Drop the partly applied change, the manifest was not written
+                self._namespaces.pop(namespace, None)
+                self._manifests.pop(namespace, None)
+                raise
+            self._replace(
+                self._file(namespace, "json"), json.dumps(manifest).encode()
+            )
+            self._attach(namespace, data, manifest)
+            self._manifests[namespace] = manifest
+            self._versions[namespace] = self._version(namespace)
+
+    @staticmethod
+    def _replace(path, content):
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(content)
+        os.replace(f"{path}.tmp", path)
+
+    @staticmethod
+    def _copy_rows(path, array, rows):
+        # A slice of rows at a time, instead of the whole array in memory
+        with open(f"{path}.tmp", "wb") as f:
+            for start in range(0, len(rows), COMPACT_ROWS):
+                chunk = array[rows[start:start + COMPACT_ROWS]]
+                f.write(np.ascontiguousarray(chunk).tobytes())
+        os.replace(f"{path}.tmp", path)
+
+    def _append_log(self, namespace, manifest, entries):
+        with open(self._file(namespace, "log"), "ab") as f:
+            f.truncate(manifest["log_bytes"])
+            for entry in entries:
+                f.write(json.dumps(entry).encode() + b"\n")
+            return f.tell()
+
+    @staticmethod
+    def _write_rows(path, rows, values, row_bytes, size):
+        open(path, "ab").close()
+        with open(path, "r+b") as f:
+            # Drop rows left behind by an interrupted write
+            f.truncate(size * row_bytes)
+            for row, value in zip(rows, values):
+                f.seek(row * row_bytes)
+                f.write(value.tobytes())
+
+    def _save_ivf(self, namespace, data):
+        with open(self._file(namespace, "centroids.npy.tmp"), "wb") as f:
+            np.save(f, np.ascontiguousarray(data.centroids))
+        os.replace(
+            self._file(namespace, "centroids.npy.tmp"),
+            self._file(namespace, "centroids.npy"),
+        )
+        self._replace(
+            self._file(namespace, "lists"),
+            data.assignments[: data.size].tobytes(),
+        )
+
+    def upsert(self, vectors, namespace=""):
+        """
+            Insert or overwrite (id, values, metadata) vectors.
+        """
+        vectors = [(v[0], v[1], v[2] if len(v) > 2 else {}) for v in vectors]
+        if not vectors:
+            return {"upserted_count": 0}
+
+        values = _normalize([vector[1] for vector in vectors])
+        with self._writing(namespace) as (data, manifest):
+            dimension = manifest["dimension"] or values.shape[1]
+            if values.shape[1] != dimension:
+                raise ValueError(
+                    f"Vector dimension {values.shape[1]} does not match the "
+                    f"namespace dimension {dimension}"
+                )
+            size = manifest["size"]
+            entries = data.upsert(vectors)
+            rows = [entry[0] for entry in entries]
+
+            self._write_rows(
+                self._file(namespace, "vectors"),
+                rows,
+                values,
+                dimension * 4,
+                size,
+            )
+            if data.centroids is not None:
+                self._write_rows(
+                    self._file(namespace, "lists"),
+                    rows,
+                    data.assign(values),
+                    4,
+                    size,
+                )
+            log_bytes = self._append_log(namespace, manifest, entries)
+
+            manifest.update(
+                dimension=dimension, size=data.size, log_bytes=log_bytes
+            )
+        return {"upserted_count": len(vectors)}
+
+    def needs_training(self, namespace=""):
+        """
+            Check if the IVF index of a namespace should be (re)trained, or
+            the rows of its deleted vectors compacted.
+        """
+        with self._lock:
+            data = self._load(namespace)
+            return (
+                data.needs_training(self.ivf_min_size)
+                or data.needs_compaction()
+            )
+
+    def train(self, namespace="", force=False):
+        """
+            Cluster a namespace into IVF lists and assign every row to its
+            list.
+
+            Upserts only assign new rows to the existing lists: training is
+            left to a separate task. The rows of deleted vectors are compacted
+            first. The clustering runs on a snapshot of the namespace without
+            holding the write lock, which is only taken to assign the rows
+            upserted in the meantime and save the index.
+
+            :param force: Train even if the namespace has not grown enough.
+            :return: Boolean indicating if the index was trained.
+        """
+        with self._lock:
+            deleted = bool(self._load(namespace).deleted)
+        if deleted:
+            self._compact(namespace)
+
+        with self._lock:
+            data = self._load(namespace)
+            if not data.size or not (
+                force or data.needs_training(self.ivf_min_size)
+            ):
+                return False
+            vectors = data.vectors
+            snapshot = dict(self._manifests[namespace])
+
+        size = snapshot["size"]
+        nlist = max(1, min(self.nlist or int(4 * np.sqrt(size)), size))
+        centroids = _train_centroids(vectors, nlist)
+        assignments = _assign(vectors, centroids)
+
+        with self._writing(namespace) as (data, manifest):
+            if not data.size:
+                return False
+            if manifest["generation"] != snapshot["generation"]:
+                # Rows were renumbered by a compaction
+                assignments = _assign(data.vectors, centroids)
+            elif manifest["log_bytes"] > snapshot["log_bytes"]:
+                # Assign the rows upserted since the snapshot
+                rows = sorted(
+                    {
+                        entry[0]
+                        for entry in self._read_log(
+                            namespace,
+                            snapshot["log_bytes"],
+                            manifest["log_bytes"],
+                        )
+                    }
+                )
+                assignments = np.resize(assignments, data.size)
+                assignments[rows] = _assign(data.vectors[rows], centroids)
+
+            data.centroids = centroids
+            data.assignments = assignments
+            self._save_ivf(namespace, data)
+            manifest["trained_size"] = data.size
+        logger.info(
+            f"Trained IVF index of {manifest['trained_size']} vectors into "
+            f"{nlist} lists in namespace {namespace!r}"
+        )
+        return True
+
+    def delete(self, ids, namespace=""):
+        """
+            Delete vectors by id. Their rows are marked as deleted in the log
+            and left in the files until the namespace is compacted.
+        """
+        with self._writing(namespace) as (data, manifest):
+            entries = data.delete(ids)
+            if entries:
+                manifest["log_bytes"] = self._append_log(
+                    namespace, manifest, entries
+                )
+        return {}
+
+    def _compact(self, namespace):
+        """
+            Rewrite a namespace without the rows of deleted vectors.
+        """
+        with self._writing(namespace) as (data, manifest):
+            if not data.deleted:
+                return
+            vectors, assignments = data.vectors, data.assignments
+            dropped = len(data.deleted)
+            kept = data.compact()
+
+            self._copy_rows(self._file(namespace, "vectors"), vectors, kept)
+            if assignments is not None:
+                self._copy_rows(
+                    self._file(namespace, "lists"), assignments, kept
+                )
+            log = self._file(namespace, "log")
+            with open(f"{log}.tmp", "wb") as f:
+                for row in range(data.size):
+                    entry = [row, data.ids[row], data.metadata[row]]
+                    f.write(json.dumps(entry).encode() + b"\n")
+                log_bytes = f.tell()
+            os.replace(f"{log}.tmp", log)
+
+            # A new generation makes readers reload the compacted files
+            manifest.update(
+                generation=manifest["generation"] + 1,
+                size=data.size,
+                log_bytes=log_bytes,
+            )
+        logger.info(
+            f"Compacted {dropped} deleted vectors out of namespace "
+            f"{namespace!r}"
+        )
+
+    def list(self, prefix="", namespace="", limit=100):
+        """
+            List the vector ids starting with `prefix`.
+
+            :return: Generator of pages of up to `limit` ids.
+        """
+        with self._lock:
+            data = self._load(namespace)
+            ids = [
+                vector_id
+                for vector_id in data.ids
+                if vector_id is not None and vector_id.startswith(prefix)
+            ]
+        for start in range(0, len(ids), limit):
+            yield ids[start:start + limit]
+
+    def fetch(self, ids, namespace=""):
+        """
+            Get vectors by id.
+
+            :return: Dict of the found vectors by id, with values and metadata.
+        """
+        with self._lock:
+            data = self._load(namespace)
+            vectors = {}
+            for vector_id in ids:
+                row = data.rows.get(vector_id)
+                if row is not None:
+                    vectors[vector_id] = {
+                        "id": vector_id,
+                        "values": data.vectors[row].tolist(),
+                        "metadata": data.metadata[row],
+                    }
+        return {"vectors": vectors, "namespace": namespace}
+
+    def query(
+        self,
+        vector,
+        top_k=10,
+        filter=None,
+        include_metadata=False,
+        namespace="",
+        nprobe=None,
+        **kwargs,
+    ):
+        """
+            Find the top_k vectors most similar (cosine) to `vector`, among the
+            vectors whose metadata match `filter`.
+
+            :param nprobe: Number of IVF lists to scan, defaults to the
+                           store's.
+            :return: Dict with a list of matches with id, score and metadata.
+        """
+        empty = {"matches": [], "namespace": namespace}
+        query = _normalize(vector)
+        with self._lock:
+            data = self._load(namespace)
+            if data.size == len(data.deleted):
+                return empty
+            # Writers append rows past `size` to these or replace them
+            # altogether, so they are scored without holding the lock
+            size, vectors = data.size, data.vectors
+            ids, metadata = data.ids, data.metadata
+            deleted = data.deleted_rows()
+            rows, remaining = data.prefilter(filter)
+            if rows is None and data.centroids is not None:
+                rows = data.probe(query, nprobe or self.nprobe)
+
+        if remaining:
+            candidates = range(size) if rows is None else rows
+            rows = np.array(
+                [
+                    row
+                    for row in candidates
+                    if metadata[row] is not None
+                    and _matches_filter(metadata[row], remaining)
+                ],
+                dtype=np.int64,
+            )
+
+        if rows is None:
+            rows = np.arange(size)
+            scores = vectors[:size] @ query
+            # The rows of deleted vectors are ranked last and left out
+            scores[deleted] = -np.inf
+            count = size - len(deleted)
+        elif not len(rows):
+            return empty
+        else:
+            scores = vectors[rows] @ query
+            count = len(rows)
+
+        k = min(top_k, count)
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+
+        matches = []
+        for position in best:
+            row = int(rows[position])
+            if ids[row] is None:
+                # Deleted since the snapshot
+                continue
+            match = {"id": ids[row], "score": float(scores[position])}
+            if include_metadata:
+                match["metadata"] = metadata[row]
+            matches.append(match)
+        return {"matches": matches, "namespace": namespace}
+
+
+@lru_cache(maxsize=None)
+def get_vector_store():
+    """
+        Get the vector index selected by the VECTOR_STORE_BACKEND setting.
+
+        :return: A Pinecone index, or a LocalVectorStore with the same
+                 interface.
+    """
+    if settings.VECTOR_STORE_BACKEND == "local":
+        logger.info(
+            f"Using the local vector store in {settings.VECTOR_STORE_PATH}"
+        )
+        return LocalVectorStore(settings.VECTOR_STORE_PATH)
+
+    # Imported here: processes using the local store never load the client
+    from pinecone import Pinecone
+
+    pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
+    return pc.Index(os.getenv("PINECONE_INDEX"))
+
+
+# Forked workers open their own index instead of sharing the parent's sockets
+os.register_at_fork(after_in_child=get_vector_store.cache_clear)
@@ -1,14 +1,43 @@
-from ninja import NinjaAPI
-
-from auth.jwt_auth import JWTAuth
+from ninja import NinjaAPI, Schema
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+
+from asgiref.sync import sync_to_async
+
+from auth.jwt_auth import AsyncJWTAuth, JWTAuth
+from auth.rate_limit import (
+    acheck_rate_limit,
+    check_rate_limit,
+    client_identity,
+)
 from mock_ocr.tasks import process_ocr_task
+from mock_ocr.jobs import get_job, validate_webhook_url
+from mock_ocr.documents import afind_document, file_name_from_url
+from mock_ocr.embeddings import (
+    aembed_texts,
+    embed_texts,
+    get_embedding_cache_stats,
+)
+from mock_ocr.shard_cache import shard_cache
+from mock_ocr.file_index import afile_exists, existing_files
+from mock_ocr.lexical import fuse_results, lexical_search
+from mock_ocr.result_cache import (
+    aget_results,
+    compute_and_store,
+    count_lookups,
+    file_generations,
+    read_results,
+    refresh_in_background,
+    release_lock,
+    result_cache_key,
+    single_flight,
+    try_lock,
+)
+from tektome_ocr.clients import LazyClient, get_vector_index
+from tektome_ocr.metrics import external_call
 from ninja.errors import HttpError
-import time
 import os
-import openai
-from pinecone import Pinecone
-import redis
-import json
 
 import logging
 
@@ -21,144 +50,133 @@ logger = logging.getLogger(__name__)
 
 api = NinjaAPI(urls_namespace="mock_ocr")
 
-# Redis for rate-limiting and caching
-r = redis.StrictRedis.from_url(os.getenv("REDIS_URL"))
-
-# Rate limiting parameters
-RATE_LIMIT_THRESHOLD = os.getenv("RATE_LIMIT_THRESHOLD")
-RATE_LIMIT_TIME_WINDOW = os.getenv("RATE_LIMIT_TIME_WINDOW")
-
-pc = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
-index = pc.Index(os.getenv("PINECONE_INDEX"))
+index = LazyClient(get_vector_index)
 
+# Batch extraction parameters
+EXTRACT_BATCH_MAX_PAIRS = int(os.getenv("EXTRACT_BATCH_MAX_PAIRS", 1000))
+EXTRACT_BATCH_CONCURRENCY = int(os.getenv("EXTRACT_BATCH_CONCURRENCY", 8))
 
+# Threads running vector searches for async endpoints, Pinecone has no async
+# client
+EXTRACT_SEARCH_THREADS = int(os.getenv("EXTRACT_SEARCH_THREADS", 64))
+search_executor = ThreadPoolExecutor(max_workers=EXTRACT_SEARCH_THREADS)
 
-def check_rate_limit(client_ip):
-    """
-        Check if the client has exceeded the rate limit.
-
-        :param client_ip: IP address of the client making the request.
-        :return: Boolean indicating if the rate limit is exceeded.
-    """
-    current_time = int(time.time())
-
-    if r.exists(client_ip):
-        request_data = r.hgetall(client_ip)
-        request_count = int(request_data[b"count"])
-        last_request_time = int(request_data[b"last_request_time"])
-
-        if current_time - last_request_time < int(RATE_LIMIT_TIME_WINDOW):
-            if request_count >= int(RATE_LIMIT_THRESHOLD):
-                return False
-            else:
-                r.hincrby(client_ip, "count", 1)
-        else:
-            # Reset count and time if the time window has passed
-            r.hset(client_ip, "count", 1)
-            r.hset(client_ip, "last_request_time", current_time)
-    else:
-        # First request from the client in this time window
-        r.hset(client_ip, "count", 1)
-        r.hset(client_ip, "last_request_time", current_time)
+# Retrieval modes of /extract, and the candidates each retriever contributes
+# to hybrid results before reciprocal rank fusion
+EXTRACT_MODES = ("hybrid", "vector", "lexical")
+EXTRACT_HYBRID_CANDIDATES = int(os.getenv("EXTRACT_HYBRID_CANDIDATES", 20))
+EXTRACT_RRF_K = int(os.getenv("EXTRACT_RRF_K", 60))
 
-    return True
+EXTRACT_MESSAGES = {
+    "hybrid": "Hybrid search completed.",
+    "vector": "Vector search completed.",
+    "lexical": "Lexical search completed.",
+}
 
 
-@api.post("/ocr", auth=JWTAuth())
-def ocr_endpoint(request, signed_url: str):
+@api.post("/ocr", auth=AsyncJWTAuth())
+async def ocr_endpoint(request, signed_url: str, webhook_url: str = None):
     """
         Endpoint to start the OCR processing task.
 
-        :param request: HTTP request containing client IP for rate limiting.
+        :param request: HTTP request containing client IP and user for rate
+                        limiting.
         :param signed_url: Signed URL to the file to be processed.
-        :return: JSON response indicating that the OCR task was submitted.
+        :param webhook_url: Optional URL receiving the job status once the task
+                            is done.
+        :return: JSON response with the ID of the job, to follow it on
+                 /jobs/{job_id}. Files whose content was already submitted
+                 return the job and document IDs of that submission instead.
     """
-    # Get the client IP from the META information
-    client_ip = request.META.get("REMOTE_ADDR")
-
-    # Check if the client is exceeding the rate limit
-    if not check_rate_limit(client_ip):
+    # Check if the client IP or user is exceeding the rate limit
+    if not await acheck_rate_limit(*client_identity(request), endpoint="ocr"):
         raise HttpError(429, "Rate limit exceeded. Please try again later.")
 
-    # Start asynchronous OCR processing
-    process_ocr_task.delay(signed_url, 0)
+    if webhook_url:
+        try:
+            # Resolving the host of the webhook blocks, off the event loop
+            await sync_to_async(validate_webhook_url, thread_sensitive=False)(
+                webhook_url
+            )
+        except ValueError as e:
+            raise HttpError(400, str(e))
 
-    return {
-        "message": "OCR task submitted successfully. It will be processed asynchronously."
-    }
+    return await submit_document(signed_url, webhook_url)
 
 
-# Cache results for 10 minutes
-def cache_query_results(query_key, results):
+async def submit_document(signed_url, webhook_url=None):
     """
-        Cache search query results in Redis.
+        Start the OCR job of a file, unless its content is already ingested
+        or being ingested by another job.
 
-        :param query_key: Unique key combining query and file_id.
-        :param results: Results of the query to be cached.
+        :param signed_url: Signed URL to the file to be processed.
+        :param webhook_url: Optional URL receiving the job status once the task
+                            is done.
+        :return: JSON response with the ID of the job, and the document ID of
+                 the submission a resubmission duplicates.
     """
-    serializable_results = []
-    for result in results:
-        # Extract only the serializable attributes (e.g., 'id' and 'metadata')
-        serializable_results.append(
-            {
-                "id": result.get("id"),
-                "score": result.get("score"),
-                "metadata": result.get("metadata"),
-            }
-        )
+    # Resubmissions of a file already ingested, or being ingested, cost one
+    # lookup
+    document = await afind_document(file_name_from_url(signed_url))
+    if document is not None:
+        return {
+            "message": "Document already ingested."
+            if document["state"] == "done"
+            else "Document is being ingested by another job.",
+            "job_id": document["job_id"],
+            "document_id": document["document_id"],
+        }
+
+    # Start asynchronous OCR processing, publishing to the broker off the event
+    # loop
+    task = await sync_to_async(process_ocr_task.delay, thread_sensitive=False)(
+        signed_url, 0, webhook_url=webhook_url
+    )
 
-    r.set(query_key, json.dumps(serializable_results), ex=600)
+    return {
+        "message": "OCR task submitted successfully. "
+        "It will be processed asynchronously.",
+        "job_id": task.id,
+    }
 
 
-# Function to retrieve cached results from Redis
-def get_cached_results(query_key):
+@api.get("/jobs/{job_id}", auth=JWTAuth())
+def job_endpoint(request, job_id: str):
     """
-        Get cached query results from Redis.
+        Endpoint to follow an OCR job.
 
-        :param query_key: Unique key combining query and file_id.
-        :return: Cached results or None if not found.
+        :param request: HTTP request.
+        :param job_id: ID returned by /ocr.
+        :return: JSON response with the status of the job (pending, running,
+                 retrying, completed or failed), its current stage and the
+                 seconds spent per stage, and the task result once done.
     """
-    cached_data = r.get(query_key)
-    if cached_data:
-        return json.loads(cached_data)
-    return None
+    return get_job(job_id)
 
 
-@api.post("/extract", auth=JWTAuth())
-def extract(request, query: str, file_id: str):
+def search_file(query_embedding, file_id, top_k=5):
     """
-        Endpoint to perform vector-based text extraction using Pinecone.
+        Perform a vector search within a single file, on the cached shard of
+        the file when the shard cache is enabled and the vectors of the file
+        can be listed, otherwise on Pinecone.
 
-        :param request: HTTP request object.
-        :param query: Search query for the extracted text.
+        :param query_embedding: Embedding of the search query.
         :param file_id: ID of the file to search within.
-        :return: JSON response containing the search results.
+        :param top_k: Number of matches to retrieve.
+        :return: List of serializable matches with id, score and metadata.
     """
-    # Create a unique cache key using the query and file_id
-    cache_key = f"extract:{query}:{file_id}"
-
-    # Check if the results for this query are already cached
-    cached_results = get_cached_results(cache_key)
-    if cached_results:
-        logging.info("Results retrieved from cache.")
-        return {"message": "Results retrieved from cache.", "results": cached_results}
-
-    # Use OpenAI to generate embeddings for the query
-    embedding_response = openai.Embedding.create(
-        input=query, model="text-embedding-ada-002"
-    )
-    query_embedding = embedding_response["data"][0]["embedding"]
-
-    logging.info(f"Generated query embedding: {query_embedding}")
-
-    # Perform a vector search on Pinecone using the query embedding and file_id filter
-    search_results = index.query(
-        vector=query_embedding,
-        filter={"file_id": file_id},  # Filter by file ID
-        top_k=5,  # Retrieve top 5 matches
-        include_metadata=True,
-        namespace="ocr",
-    )
+    shard = shard_cache.get(index, file_id) if shard_cache.enabled else None
+    if shard is not None:
+        return shard.search(query_embedding, top_k=top_k)
+
+    with external_call("vector_store", "query"):
+        search_results = index.query(
+            vector=query_embedding,
+            filter={"file_id": file_id},  # Filter by file ID
+            top_k=top_k,
+            include_metadata=True,
+            namespace="ocr",
+        )
 
     logging.info(f"Search results from Pinecone: {search_results}")
 
@@ -177,11 +195,305 @@ def extract(request, query: str, file_id: str):
     else:
         logging.warning("No matches found in search results.")
 
+    return matching_attributes
+
+
+def hybrid_search(query_embedding, query, file_id):
+    """
+        Fuse the vector and lexical matches of a query within a file. Files
+        without a lexical index get their vector matches only.
+    """
+    vector_matches = search_file(
+        query_embedding, file_id, EXTRACT_HYBRID_CANDIDATES
+    )
+    lexical_matches = lexical_search(query, file_id, EXTRACT_HYBRID_CANDIDATES)
+    return fuse(vector_matches, lexical_matches)
+
+
+def fuse(vector_matches, lexical_matches):
+    if lexical_matches is None:
+        return vector_matches[:5]
+    return fuse_results(
+        [vector_matches, lexical_matches], top_k=5, k=EXTRACT_RRF_K
+    )
+
+
+@api.post("/extract", auth=AsyncJWTAuth())
+async def extract(request, query: str, file_id: str, mode: str = "hybrid"):
+    """
+        Endpoint to perform text extraction within a file, by vector search
+        on Pinecone, BM25 search on the lexical index of the file, or both
+        fused by reciprocal rank.
+
+        :param request: HTTP request object.
+        :param query: Search query for the extracted text.
+        :param file_id: ID of the file to search within.
+        :param mode: Retrieval mode, "hybrid" (default), "vector" or "lexical".
+                     Lexical search matches exact codes and numbers and needs
+                     no query embedding: hybrid searches return the lexical
+                     matches alone when the query cannot be embedded.
+        :return: JSON response containing the search results.
+    """
+    if mode not in EXTRACT_MODES:
+        raise HttpError(
+            400, f"Mode must be one of {', '.join(EXTRACT_MODES)}."
+        )
+
+    # Check if the client IP or user is exceeding the rate limit
+    if not await acheck_rate_limit(
+        *client_identity(request), endpoint="extract"
+    ):
+        raise HttpError(429, "Rate limit exceeded. Please try again later.")
+
+    # Files that were never ingested have nothing to search
+    if not await afile_exists(file_id):
+        raise HttpError(404, "File has not been processed.")
+
+    loop = asyncio.get_running_loop()
+
+    def run(func, *args):
+        return loop.run_in_executor(search_executor, func, *args)
+
+    # Lexical matches of a hybrid search, kept to answer when the vector search
+    # fails
+    lexical = None
+
+    async def search():
+        nonlocal lexical
+        if mode == "lexical":
+            return await run(lexical_search, query, file_id) or []
+
+        # The lexical search needs no embedding, it runs while the query is
+        # embedded
+        if mode == "hybrid":
+            lexical = run(
+                lexical_search, query, file_id, EXTRACT_HYBRID_CANDIDATES
+            )
+
+        # Use OpenAI to generate embeddings for the query, unless already
+        # cached
+        query_embedding = (await aembed_texts([query]))[0]
+
+        logging.info(f"Generated query embedding: {query_embedding}")
+
+        # Perform a vector search using the query embedding and file_id filter
+        if mode == "vector":
+            return await run(search_file, query_embedding, file_id)
+
+        vector_matches = await run(
+            search_file, query_embedding, file_id, EXTRACT_HYBRID_CANDIDATES
+        )
+        return fuse(vector_matches, await lexical)
+
+    def refresh():
+        if mode == "lexical":
+            return lexical_search(query, file_id) or []
+        query_embedding = embed_texts([query])[0]
+        if mode == "vector":
+            return search_file(query_embedding, file_id)
+        return hybrid_search(query_embedding, query, file_id)
+
+    # Reuse cached results, only one request computes results that are missing
+    message = EXTRACT_MESSAGES[mode]
+    try:
+        matching_attributes, cached = await aget_results(
+            query, file_id, search, refresh, mode=mode
+        )
+    except Exception as e:
+        # Without the query embedding, hybrid searches fall back to the
+        # lexical matches of files that have a lexical index, left uncached
+        lexical_matches = await lexical if lexical is not None else None
+        if lexical_matches is None:
+            raise
+        logging.warning(
+            f"Vector search failed, returning lexical matches: {e}"
+        )
+        matching_attributes, cached = lexical_matches[:5], False
+        message = EXTRACT_MESSAGES["lexical"]
+
     # Check if there are any matches to return
     if not matching_attributes:
         return {"message": "No matches found.", "results": []}
 
-    # Cache the results to improve performance for repeated queries
-    cache_query_results(cache_key, matching_attributes)
+    if cached:
+        logging.info("Results retrieved from cache.")
+        return {
+            "message": "Results retrieved from cache.",
+            "results": matching_attributes,
+        }
+
+    return {"message": message, "results": matching_attributes}
+
 
-    return {"message": "Vector search completed.", "results": matching_attributes}
+@api.get("/embedding_cache/stats", auth=JWTAuth())
+def embedding_cache_stats(request):
+    """
+        Endpoint to inspect the embedding cache of this process.
+
+        :param request: HTTP request object.
+        :return: JSON response with the hit/miss counters and the local cache
+                 size.
+    """
+    return get_embedding_cache_stats()
+
+
+class BatchExtractRequest(Schema):
+    queries: List[str]
+    file_ids: List[str]
+    mode: str = "hybrid"
+
+
+@api.post("/extract_batch", auth=JWTAuth())
+def extract_batch(request, payload: BatchExtractRequest):
+    """
+        Endpoint to run several queries against several files in one call,
+        with the retrieval modes of `/extract`. Uncached queries are embedded
+        with a single OpenAI request and the searches run concurrently.
+
+        :param request: HTTP request object.
+        :param payload: JSON body with the list of queries, the list of file
+                        IDs and the retrieval mode, "hybrid" (default),
+                        "vector" or "lexical".
+        :return: JSON response with the matches of every file, grouped by
+                 query, and the requested files that were never processed.
+    """
+    mode = payload.mode
+    if mode not in EXTRACT_MODES:
+        raise HttpError(
+            400, f"Mode must be one of {', '.join(EXTRACT_MODES)}."
+        )
+
+    # Check if the client IP or user is exceeding the rate limit
+    if not check_rate_limit(*client_identity(request), endpoint="extract"):
+        raise HttpError(429, "Rate limit exceeded. Please try again later.")
+
+    queries = list(dict.fromkeys(payload.queries))
+    file_ids = list(dict.fromkeys(payload.file_ids))
+    if len(queries) * len(file_ids) > EXTRACT_BATCH_MAX_PAIRS:
+        raise HttpError(
+            400,
+            f"At most {EXTRACT_BATCH_MAX_PAIRS} query and file pairs "
+            "are allowed",
+        )
+
+    # Files that were never ingested are reported instead of searched
+    exists = existing_files(file_ids)
+    missing_file_ids = [
+        file_id for file_id, found in zip(file_ids, exists) if not found
+    ]
+    file_ids = [file_id for file_id, found in zip(file_ids, exists) if found]
+
+    results = {query: {} for query in queries}
+
+    def search(query, file_id, query_embedding=None):
+        if mode == "lexical":
+            return lexical_search(query, file_id) or []
+        if query_embedding is None:
+            query_embedding = embed_texts([query])[0]
+        if mode == "vector":
+            return search_file(query_embedding, file_id)
+        return hybrid_search(query_embedding, query, file_id)
+
+    def search_one(query, file_id):
+        return lambda: search(query, file_id)
+
+    # Reuse the cached results of every query and file pair in one round trip
+    pairs = [(query, file_id) for query in queries for file_id in file_ids]
+    generations = file_generations(file_ids)
+    keys = [
+        result_cache_key(query, file_id, mode, generations[file_id])
+        for query, file_id in pairs
+    ]
+    misses = []
+    waiting = []
+    entries = read_results(keys)
+    count_lookups(entries)
+    for (query, file_id), key, entry in zip(pairs, keys, entries):
+        if entry is not None:
+            results[query][file_id] = entry.results
+            if entry.stale:
+                refresh_in_background(key, search_one(query, file_id))
+            continue
+        # Pairs being computed by another request are waited for
+        token = try_lock(key)
+        if token is None:
+            waiting.append((query, file_id, key))
+        else:
+            misses.append((query, file_id, key, token))
+
+    # Embed every query that still needs a vector search in one batched
+    # request
+    message = EXTRACT_MESSAGES[mode]
+    query_embeddings = {}
+    missing_queries = []
+    if mode != "lexical":
+        missing_queries = list(dict.fromkeys(query for query, *_ in misses))
+    if missing_queries:
+        try:
+            query_embeddings = dict(
+                zip(missing_queries, embed_texts(missing_queries))
+            )
+        except Exception as e:
+            for *_, key, token in misses:
+                release_lock(key, token)
+            if mode != "hybrid":
+                raise
+            # Without the query embeddings, hybrid searches fall back to the
+            # lexical matches of files that have a lexical index, left
+            # uncached
+            pending = [
+                (query, file_id) for query, file_id, *_ in misses + waiting
+            ]
+            lexical_matches = [
+                lexical_search(query, file_id) for query, file_id in pending
+            ]
+            if any(matches is None for matches in lexical_matches):
+                raise
+            logging.warning(
+                f"Vector search failed, returning lexical matches: {e}"
+            )
+            for (query, file_id), matches in zip(pending, lexical_matches):
+                results[query][file_id] = matches
+            message = EXTRACT_MESSAGES["lexical"]
+            misses, waiting = [], []
+
+    if misses or waiting:
+
+        def search_miss(miss):
+            query, file_id, key, token = miss
+            return compute_and_store(
+                key,
+                lambda: search(query, file_id, query_embeddings.get(query)),
+                token,
+            )
+
+        def wait(pair):
+            query, file_id, key = pair
+            return single_flight(key, search_one(query, file_id))
+
+        with ThreadPoolExecutor(
+            max_workers=min(
+                EXTRACT_BATCH_CONCURRENCY, len(misses) + len(waiting)
+            )
+        ) as executor:
+            searched = executor.map(search_miss, misses)
+            waited = executor.map(wait, waiting)
+            for (query, file_id, *_), matching_attributes in zip(
+                misses, searched
+            ):
+                results[query][file_id] = matching_attributes
+            for (query, file_id, _), matching_attributes in zip(
+                waiting, waited
+            ):
+                results[query][file_id] = matching_attributes
+
+    logging.info(
+        f"Batch extraction of {len(queries)} queries "
+        f"over {len(file_ids)} files, {len(misses)} searches"
+    )
+
+    return {
+        "message": message,
+        "results": results,
+        "missing_file_ids": missing_file_ids,
+    }
@@ -0,0 +1,19 @@
+"""
+ASGI config for tektome_ocr project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Run it with uvicorn workers so that async endpoints share one event loop:
+
+    gunicorn tektome_ocr.asgi:application -k uvicorn.workers.UvicornWorker
+
+For more information on this file, see
+https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tektome_ocr.settings")
+
+application = get_asgi_application()
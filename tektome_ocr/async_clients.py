@@ -0,0 +1,55 @@
+import os
+import asyncio
+import weakref
+
+import aiohttp
+import redis.asyncio as aioredis
+
+
+# Connection pool sizes of each event loop
+ASYNC_REDIS_MAX_CONNECTIONS = int(
+    os.getenv("ASYNC_REDIS_MAX_CONNECTIONS", 100)
+)
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.getenv("ASYNC_HTTP_MAX_CONNECTIONS", 100))
+
+# Async connections can only be used from the event loop that opened them,
+# so clients are kept per loop: a single set per ASGI worker.
+_clients = weakref.WeakKeyDictionary()
+
+
+def _loop_clients():
+    loop = asyncio.get_running_loop()
+    clients = _clients.get(loop)
+    if clients is None:
+        clients = _clients[loop] = {}
+    return clients
+
+
+def get_redis():
+    """
+        Get the async Redis client of the running event loop, backed by a
+        pool of up to ASYNC_REDIS_MAX_CONNECTIONS connections.
+    """
+    clients = _loop_clients()
+    client = clients.get("redis")
+    if client is None:
+        client = clients["redis"] = aioredis.StrictRedis.from_url(
+            os.getenv("REDIS_URL"), max_connections=ASYNC_REDIS_MAX_CONNECTIONS
+        )
+    return client
+
+
+def get_http_session():
+    """
+        Get the aiohttp session of the running event loop, keeping up to
+        ASYNC_HTTP_MAX_CONNECTIONS connections alive for reuse.
+    """
+    clients = _loop_clients()
+    session = clients.get("http")
+    if session is None or session.closed:
+        session = clients["http"] = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=ASYNC_HTTP_MAX_CONNECTIONS, ttl_dns_cache=300
+            )
+        )
+    return session
@@ -1,7 +1,10 @@
 import os
 from celery import Celery
 
+from tektome_ocr.tracing import instrument_celery
+
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tektome_ocr.settings")
 app = Celery("tektome_ocr")
 app.config_from_object("django.conf:settings", namespace="CELERY")
 app.autodiscover_tasks()
+instrument_celery()
@@ -0,0 +1,99 @@
+import os
+import threading
+
+import redis
+
+
+# Connections kept by the Redis and S3 pools of each process
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 100))
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", 32))
+
+# Clients are built on first use, once per process: forked children (Celery
+# prefork workers, gunicorn workers started after the app is loaded) do not
+# share the sockets of their parent.
+_clients = {}
+_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    global _lock
+    _clients.clear()
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _get(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = factory()
+    return client
+
+
+def get_redis_client():
+    """
+        Get the Redis client of the process. Every module shares its pool of
+        up to REDIS_MAX_CONNECTIONS connections, opened on first use.
+    """
+    return _get(
+        "redis",
+        lambda: redis.StrictRedis(
+            connection_pool=redis.ConnectionPool.from_url(
+                os.getenv("REDIS_URL") or "redis://localhost:6379/0",
+                max_connections=REDIS_MAX_CONNECTIONS,
+            )
+        ),
+    )
+
+
+def get_vector_index():
+    """
+        Get the vector index of the process (see `get_vector_store`).
+    """
+    from mock_ocr.vector_store import get_vector_store
+
+    return _get("vector_index", get_vector_store)
+
+
+def get_s3_client():
+    """
+        Get the S3 client of the process, keeping up to S3_MAX_POOL_CONNECTIONS
+        connections alive for reuse.
+    """
+
+    def create():
+        import boto3
+        from botocore.config import Config
+        from django.conf import settings
+
+        return boto3.client(
+            "s3",
+            region_name=settings.AWS_S3_REGION_NAME,
+            config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS),
+        )
+
+    return _get("s3", create)
+
+
+class LazyClient:
+    """
+        Module-level stand-in for a client of the registry, built on first
+        attribute access rather than at import time.
+
+        :param factory: Registry function returning the client.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+
+    def __getattr__(self, name):
+        # Only called for missing attributes. Introspection (mock.patch,
+        # copy, pickle, asyncio) probes dunder and private names, and
+        # `_factory` is missing while unpickling: none of them build the client
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._factory(), name)
@@ -0,0 +1,52 @@
+import threading
+from collections import OrderedDict
+
+
+class LocalLRU:
+    """
+        Thread-safe in-process LRU cache of bytes values, evicting the least
+        recently used entries once the total size exceeds `max_bytes`.
+        Other values can be stored by passing a `sizeof` function.
+    """
+
+    def __init__(self, max_bytes, sizeof=len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self.size -= self.sizeof(previous)
+            if self.sizeof(value) > self.max_bytes:
+                return
+            self._data[key] = value
+            self.size += self.sizeof(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+
+    def pop(self, key):
+        with self._lock:
+            value = self._data.pop(key, None)
+            if value is not None:
+                self.size -= self.sizeof(value)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
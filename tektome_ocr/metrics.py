@@ -0,0 +1,217 @@
+import os
+import time
+import logging
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.http import HttpResponse
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+from tektome_ocr.tracing import span
+
+
+logger = logging.getLogger(__name__)
+
+# Web and Celery worker processes write their metrics to this directory,
+# and /metrics reports the sum over all of them. Without it, /metrics only
+# reports the process serving the request.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# Celery queues whose length is reported
+METRICS_QUEUES = os.getenv("METRICS_QUEUES", "celery").split(",")
+
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30
+)
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_seconds",
+    "Time spent serving HTTP requests.",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+EXTERNAL_CALL_SECONDS = Histogram(
+    "external_call_seconds",
+    "Time spent in calls to external services "
+    "(OpenAI, vector store, Redis, S3, database).",
+    ["service", "operation"],
+    buckets=LATENCY_BUCKETS,
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total",
+    "Cache lookups by cache and result (hit, stale, miss).",
+    ["cache", "result"],
+)
+RATE_LIMIT_REJECTIONS = Counter(
+    "rate_limit_rejections_total",
+    "Requests rejected by the rate limiter.",
+    ["endpoint"],
+)
+OCR_TASK_STAGE_SECONDS = Histogram(
+    "ocr_task_stage_seconds",
+    "Time spent by OCR jobs in each stage.",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+OCR_JOBS = Counter(
+    "ocr_jobs_total",
+    "OCR jobs finished, by status (completed, duplicate, failed).",
+    ["status"],
+)
+
+
+@contextmanager
+def external_call(service, operation):
+    """
+        Time a call to an external service, in a tracing span of the same name.
+
+        :param service: Service called, e.g. "openai" or "redis".
+        :param operation: Operation performed, e.g. "embed" or
+                          "result_cache_read".
+    """
+    with span(f"{service}.{operation}"):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            EXTERNAL_CALL_SECONDS.labels(service, operation).observe(
+                time.perf_counter() - start
+            )
+
+
+def count_cache(cache, result, count=1):
+    if count:
+        CACHE_REQUESTS.labels(cache, result).inc(count)
+
+
+def observe_ocr_job(result):
+    """
+        Record the stage timings and the outcome of a finished OCR job.
+
+        :param result: Result of `process_ocr_task`, with its timings.
+    """
+    for stage, seconds in result.get("timings", {}).items():
+        OCR_TASK_STAGE_SECONDS.labels(stage).observe(seconds)
+    if "error" in result:
+        status = "failed"
+    elif "duplicate_of" in result:
+        status = "duplicate"
+    else:
+        status = "completed"
+    OCR_JOBS.labels(status).inc()
+
+
+class QueueLengthCollector:
+    """
+        Length of the Celery queues, read from the broker when metrics are
+        collected.
+    """
+
+    def describe(self):
+        # Nothing is read from the broker when the collector is registered
+        return []
+
+    def collect(self):
+        from tektome_ocr.celery import app
+
+        gauge = GaugeMetricFamily(
+            "celery_queue_length",
+            "Tasks waiting in the Celery queue.",
+            labels=["queue"],
+        )
+        try:
+            with app.connection_for_read() as connection:
+                # A single attempt, the scrape must not wait for the broker
+                connection.ensure_connection(max_retries=1)
+                channel = connection.default_channel
+                for queue in METRICS_QUEUES:
+                    _, length, _ = channel.queue_declare(
+                        queue=queue, passive=True
+                    )
+                    gauge.add_metric([queue], length)
+        except Exception as e:
+            logger.warning(f"Celery queue length not collected: {e}")
+        yield gauge
+
+
+queue_length_collector = QueueLengthCollector()
+if not PROMETHEUS_MULTIPROC_DIR:
+    REGISTRY.register(queue_length_collector)
+
+
+def get_registry():
+    """
+        :return: Registry of the metrics of every process sharing
+                 PROMETHEUS_MULTIPROC_DIR, or of this process.
+    """
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    registry.register(queue_length_collector)
+    return registry
+
+
+def metrics_view(request):
+    """
+        Prometheus scrape endpoint, with the length of the Celery queues.
+    """
+    return HttpResponse(
+        generate_latest(get_registry()), content_type=CONTENT_TYPE_LATEST
+    )
+
+
+class MetricsMiddleware:
+    """
+        Time every request by route, in a tracing span linked to the Celery
+        tasks it submits. Routes are URL patterns (e.g.
+        "mock_ocr/jobs/<job_id>"), so that IDs in paths do not create a series
+        each.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start = time.perf_counter()
+        with span(f"HTTP {request.method}", kind="server") as request_span:
+            response = self.get_response(request)
+            self._observe(request, response, start, request_span)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        with span(f"HTTP {request.method}", kind="server") as request_span:
+            response = await self.get_response(request)
+            self._observe(request, response, start, request_span)
+        return response
+
+    def _observe(self, request, response, start, request_span):
+        match = getattr(request, "resolver_match", None)
+        route = match.route if match is not None else "unmatched"
+        HTTP_REQUEST_SECONDS.labels(
+            request.method, route, response.status_code
+        ).observe(time.perf_counter() - start)
+        if request_span is not None:
+            request_span.update_name(f"{request.method} {route}")
+            request_span.set_attribute("http.route", route)
+            request_span.set_attribute(
+                "http.status_code", response.status_code
+            )
@@ -47,6 +47,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "tektome_ocr.metrics.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -91,6 +92,10 @@ SIMPLE_JWT = {
     "AUTH_HEADER_TYPES": ("Bearer",),
 }
 
+# Authenticate API requests from the verified token claims alone, without
+# reading the user from the database
+JWT_AUTH_STATELESS = os.getenv("JWT_AUTH_STATELESS", "False") == "True"
+
 # Database
 # https://docs.djangoproject.com/en/2.2/ref/settings/#databases
 
@@ -143,7 +148,29 @@ AWS_S3_FILE_OVERWRITE = (
 AWS_DEFAULT_ACL = None  # Ensure default ACLs are managed appropriately
 
 # Use S3 for default file storage
-DEFAULT_FILE_STORAGE = "storages.backends.s3boto3.S3Boto3Storage"
+DEFAULT_FILE_STORAGE = "file_upload.storage.MultipartS3Storage"
+
+# Uploads are streamed to S3 as multipart uploads. At most
+# AWS_S3_MULTIPART_CONCURRENCY parts of AWS_S3_MULTIPART_PART_SIZE bytes are
+# buffered in memory per upload, whatever the size of the file (see
+# file_upload.storage).
+AWS_S3_MULTIPART_PART_SIZE = int(
+    os.getenv("AWS_S3_MULTIPART_PART_SIZE", 8 * 1024 * 1024)
+)
+AWS_S3_MULTIPART_CONCURRENCY = int(
+    os.getenv("AWS_S3_MULTIPART_CONCURRENCY", 4)
+)
+
+# Request bodies larger than this are spooled to a temporary file on disk
+# instead of being held in worker memory
+FILE_UPLOAD_MAX_MEMORY_SIZE = 2621440  # 2.5 MB
+
+# Vector index used for OCR embeddings: "pinecone", or "local" for an
+# in-process NumPy index persisted under VECTOR_STORE_PATH
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "pinecone")
+VECTOR_STORE_PATH = os.getenv("VECTOR_STORE_PATH") or os.path.join(
+    BASE_DIR, "vector_store"
+)
 
 # celery configuration
 
@@ -151,6 +178,14 @@ CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL")
 CELERY_ACCEPT_CONTENT = ["json"]
 CELERY_TASK_SERIALIZER = "json"
 
+# OCR job states and results, read by the /mock_ocr/jobs endpoint
+CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND") or os.getenv(
+    "REDIS_URL"
+)
+CELERY_RESULT_SERIALIZER = "json"
+CELERY_RESULT_EXPIRES = int(os.getenv("JOB_RESULT_TTL", 24 * 60 * 60))
+CELERY_TASK_TRACK_STARTED = True
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/2.2/topics/i18n/
@@ -0,0 +1,96 @@
+import os
+import logging
+from contextlib import nullcontext
+
+try:
+    from opentelemetry import context, propagate, trace
+except ImportError:
+    trace = None
+
+
+logger = logging.getLogger(__name__)
+
+# Requests, external calls and Celery tasks are traced with the opentelemetry
+# packages installed and OTEL_TRACING_ENABLED=True. Spans are exported by the
+# tracer provider of the process, e.g. when it runs under
+# `opentelemetry-instrument`; when disabled, `span` costs a function call.
+TRACING_ENABLED = os.getenv("OTEL_TRACING_ENABLED", "False") == "True"
+
+if TRACING_ENABLED and trace is None:
+    logger.warning(
+        "OTEL_TRACING_ENABLED is set but opentelemetry is not installed"
+    )
+
+tracer = trace.get_tracer("tektome_ocr") if TRACING_ENABLED and trace else None
+
+_no_span = nullcontext()
+
+# task ID -> (span, context token) of the Celery tasks running in this process
+_task_spans = {}
+
+
+def span(name, kind=None, **attributes):
+    """
+        Context manager running a block in a tracing span, yielding the span,
+        or None when tracing is disabled.
+
+        :param name: Name of the span.
+        :param kind: "server", "client", "producer" or "consumer"; internal by
+                     default.
+        :param attributes: Attributes of the span.
+    """
+    if tracer is None:
+        return _no_span
+    kind = (
+        getattr(trace.SpanKind, kind.upper())
+        if kind
+        else trace.SpanKind.INTERNAL
+    )
+    return tracer.start_as_current_span(name, kind=kind, attributes=attributes)
+
+
+def inject_task_context(headers=None, **kwargs):
+    # Sent with the task message, before_task_publish signal handler
+    if headers is not None:
+        propagate.inject(headers)
+
+
+def start_task_span(task_id=None, task=None, **kwargs):
+    # task_prerun signal handler: the task span continues the trace of the
+    # request that submitted it, or of the caller for tasks run eagerly
+    parent = propagate.extract(
+        task.request.__dict__, context=context.get_current()
+    )
+    task_span = tracer.start_span(
+        task.name,
+        context=parent,
+        kind=trace.SpanKind.CONSUMER,
+        attributes={"celery.task_id": task_id},
+    )
+    token = context.attach(trace.set_span_in_context(task_span))
+    _task_spans[task_id] = (task_span, token)
+
+
+def end_task_span(task_id=None, state=None, **kwargs):
+    # task_postrun signal handler
+    entry = _task_spans.pop(task_id, None)
+    if entry is None:
+        return
+    task_span, token = entry
+    if state is not None:
+        task_span.set_attribute("celery.state", state)
+    context.detach(token)
+    task_span.end()
+
+
+def instrument_celery():
+    """
+        Trace the Celery tasks published and run by this process.
+    """
+    if tracer is None:
+        return
+    from celery import signals
+
+    signals.before_task_publish.connect(inject_task_context, weak=False)
+    signals.task_prerun.connect(start_task_span, weak=False)
+    signals.task_postrun.connect(end_task_span, weak=False)
@@ -18,6 +18,7 @@ from django.contrib import admin
 from django.urls import path
 from file_upload.views import api
 from mock_ocr.views import api as mock_ocr_view
+from tektome_ocr.metrics import metrics_view
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
 urlpatterns = [
@@ -26,4 +27,5 @@ urlpatterns = [
     path("mock_ocr/", mock_ocr_view.urls),
     path("api/token/", TokenObtainPairView.as_view(), name="token_obtain_pair"),
     path("api/token/refresh/", TokenRefreshView.as_view(), name="token_refresh"),
+    path("metrics", metrics_view, name="metrics"),
 ]